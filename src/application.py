@@ -20,12 +20,9 @@ class Application(PygubuApp):
 
         self.parser = Parser()
         self.server = Server()
+        self.server.config['workers'] = 4
 
-        self.server.packet_receivers[MSG_GET] = self.parser.onget
-        self.server.packet_receivers[MSG_POST] = self.parser.onpost
-        self.server.packet_receivers[MSG_PUT] = self.parser.onput
-        self.server.packet_receivers[MSG_DELETE] = self.parser.ondelete
-        self.server.packet_receivers[MSG_SEARCH] = self.parser.onsearch
+        self.parser.register(self.server)
 
         self.server.on_reply_sent = self.log_reply
         self.server.on_request_received = self.log_request
@@ -43,6 +40,7 @@ class Application(PygubuApp):
 
     def on_quitapp(self, event=None):
         self.server.stop()
+        self.parser.close()
 
     # Other
 
@@ -0,0 +1,206 @@
+import gc
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from queue import LifoQueue
+from coap import *
+from coap_retransmit import PendingReply
+from coap_server import Server
+from coap_walk import walk
+
+
+DEFAULT_COUNT = 10000
+DEFAULT_TREE_SIZES = [10000, 100000, 1000000]
+TREE_FANOUT = 10  # Subfolders per folder
+TREE_FILES = 90  # Files per folder
+SEARCH_WORKERS = 8
+REPLY_PAYLOAD = bytes('{"client_cmd": "create", "status": "created"}', 'utf-8')
+
+
+def showhelp():
+    name = 'benchmarks.py'
+    print('=== CoAP Server benchmarks ===')
+    print('> Usage:')
+    print('> \'python3 {0} memory [count]\' to measure the memory used by in-flight CON exchanges.'.format(name))
+    print('> \'python3 {0} search [entries ...]\' to compare search tree walkers on synthetic trees.'.format(name))
+    exit(0)
+
+
+# Measures how many bytes are allocated by the objects built with factory(i), for i in range(count)
+def measure(factory, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    objects = [factory(i) for i in range(count)]
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # Don't count the list holding the objects
+    total = after - before - sys.getsizeof(objects)
+    del objects
+
+    return total / count
+
+
+def make_reply(i):
+    reply = Packet(TYPE_CON, MSG_CREATED, i & 0xFFFF, bytes([i & 0xFF, (i >> 8) & 0xFF]))
+    reply.payload = REPLY_PAYLOAD
+    reply.addr = ('127.0.0.1', 1024 + i % 60000)
+    return reply
+
+
+def make_pending(i):
+    packet = make_reply(i)
+    reply = PendingReply(packet.tobytes(), packet.addr, packet.id)
+    reply.wait_time = COMM_ACK_TIMEOUT
+    reply.attempts = COMM_MAX_RETRANSMIT
+    reply.attempts_left = reply.attempts
+    return reply
+
+
+# Measures how many bytes a running server keeps for each CON reply passed to Server.send() until it's ACKed:
+# the encoded message and its PendingReply, the retransmission heap and index entries, and the congestion state
+# of the endpoint (every reply goes to a different endpoint, up to 60000 of them)
+def measure_exchanges(count):
+    server = Server()
+    server.ip = '127.0.0.1'
+    server.port = 0  # Any free port; the replies go to ports nobody listens on, so no ACK ever comes back
+    server.config['max_pending'] = count
+    server.start()
+
+    try:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        # Like a handler, the Packet is dropped once it's sent; only what the server keeps is counted
+        for i in range(count):
+            server.send(make_reply(i))
+
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        server.stop()
+
+    return (after - before) / count
+
+
+def memory(count):
+    print('Measuring', count, 'in-flight exchanges')
+    print()
+    print('Packet:         {0:8.1f} bytes per exchange'.format(measure(make_reply, count)))
+    print('PendingReply:   {0:8.1f} bytes per exchange'.format(measure(make_pending, count)))
+    print('Server.send():  {0:8.1f} bytes per exchange (everything kept until the ACK)'.format(
+        measure_exchanges(count)))
+
+
+# Creates a tree with (at least) the given number of entries, breadth-first
+def make_tree(root, entries):
+    folders = [root]
+    count = 0
+    i = 0
+
+    while count < entries:
+        folder = folders[i]
+        i += 1
+
+        for f in range(TREE_FILES):
+            open(os.path.join(folder, 'file_{0}.txt'.format(f)), 'w').close()
+        count += TREE_FILES
+
+        for d in range(TREE_FANOUT):
+            path = os.path.join(folder, 'dir_{0}'.format(d))
+            os.mkdir(path)
+            folders.append(path)
+        count += TREE_FANOUT
+
+    return count
+
+
+# The walker search used before coap_walk: listdir, then a stat and two normpath calls per entry
+def legacy_search(root, text):
+    results = 0
+    stack = LifoQueue()
+    stack.put(('', os.listdir(root)))
+
+    while not stack.empty():
+        rel_path, folder_contents = stack.get()
+        for obj in folder_contents:
+            full_path = os.path.normpath(os.path.join(root, rel_path, obj)).replace('\\', '/')
+            rel_obj_path = os.path.normpath(os.path.join(rel_path, obj)).replace('\\', '/')
+            object_stats = os.stat(full_path)
+            if stat.S_ISDIR(object_stats.st_mode):
+                stack.put((rel_obj_path, os.listdir(full_path)))
+            if text in obj:
+                results += 1
+
+    return results
+
+
+def scandir_search(root, text, executor=None):
+    results = 0
+    for rel_path, entry in walk(root, executor):
+        entry.is_dir()
+        if text in entry.name:
+            results += 1
+    return results
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def search(sizes):
+    executor = ThreadPoolExecutor(SEARCH_WORKERS)
+
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix='coap_search_bench_')
+        try:
+            print('Creating tree with', size, 'entries...')
+            entries = make_tree(root, size)
+
+            legacy_time, expected = timed(legacy_search, root, 'file_7')
+            scandir_time, found = timed(scandir_search, root, 'file_7')
+            parallel_time, parallel_found = timed(scandir_search, root, 'file_7', executor)
+
+            if found != expected or parallel_found != expected:
+                print('Result mismatch!', expected, found, parallel_found)
+
+            print('{0:>9} entries: listdir+stat {1:8.3f} s | scandir {2:8.3f} s ({3:4.1f}x) | '
+                  'scandir x{4} threads {5:8.3f} s ({6:4.1f}x)'.format(
+                      entries, legacy_time, scandir_time, legacy_time / scandir_time,
+                      SEARCH_WORKERS, parallel_time, legacy_time / parallel_time))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    executor.shutdown()
+
+
+def main():
+    argc = len(sys.argv)
+
+    if argc == 1:
+        showhelp()
+
+    cmd = sys.argv[1]
+
+    if cmd == 'memory' and argc <= 3:
+        memory(int(sys.argv[2]) if argc == 3 else DEFAULT_COUNT)
+    elif cmd == 'search':
+        search([int(size) for size in sys.argv[2:]] if argc > 2 else DEFAULT_TREE_SIZES)
+    else:
+        print('Command was not understood!')
+        showhelp()
+
+
+if __name__ == '__main__':
+    main()
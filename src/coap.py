@@ -1,6 +1,10 @@
 # coap.py
 # Defines many constants and other goodies related to CoAP
 
+import struct
+from array import array
+from typing import Optional, Dict, List
+
 # FIXME: Do we limit ourselves to RFC-7252, or do we also use the updated specifications (such as RFC-8132)? -mario
 
 # Misc Constants
@@ -37,6 +41,7 @@ MSG_DELETED = (2, 2)
 MSG_VALID = (2, 3)
 MSG_CHANGED = (2, 4)
 MSG_CONTENT = (2, 5)
+MSG_CONTINUE = (2, 31)  # RFC-7959
 
 # Client Error Codes
 MSG_BAD_REQUEST = (4, 0)
@@ -73,6 +78,7 @@ OPT_IF_MATCH = 1
 OPT_URI_HOST = 3
 OPT_ETAG = 4
 OPT_IF_NONE_MATCH = 5
+OPT_OBSERVE = 6  # RFC-7641
 OPT_URI_PORT = 7
 OPT_LOCATION_PATH = 8
 OPT_URI_PATH = 11
@@ -81,13 +87,16 @@ OPT_MAX_AGE = 14
 OPT_URI_QUERY = 15
 OPT_ACCEPT = 17
 OPT_LOCATION_QUERY = 20
+OPT_BLOCK2 = 23  # RFC-7959
+OPT_BLOCK1 = 27  # RFC-7959
+OPT_SIZE2 = 28  # RFC-7959
 OPT_PROXY_URI = 35
 OPT_PROXY_SCHEME = 39
 OPT_SIZE1 = 60
 
 # List of Critical Options
 # Critical Options that fail to parse must raise an error
-OPTIONS_CRITICAL = [1, 3, 5, 7, 11, 15, 17, 35, 39]
+OPTIONS_CRITICAL = [1, 3, 5, 7, 11, 15, 17, 23, 27, 35, 39]
 
 # List of Repeatable Options
 # Options that are repeatable can appear more than once
@@ -100,6 +109,7 @@ MEDIA_XML = 41
 MEDIA_OCTET_STREAM = 42
 MEDIA_EXI = 47
 MEDIA_JSON = 50
+MEDIA_CBOR = 60
 
 # Communication parameters
 COMM_ACK_TIMEOUT = 2
@@ -127,32 +137,208 @@ class ParseException(Exception):
         return str(self.msg)
 
 
+_EMPTY_PAYLOAD = bytes(0)
+
+# Header de baza: versiune / tip / lungime token, cod, message ID
+_HEADER = struct.Struct('!BBH')
+
+
+# Number of extra bytes needed to encode an option delta or length
+def _ext_size(value: int) -> int:
+    if value <= 12:
+        return 0
+    elif value <= 268:
+        return 1
+    return 2
+
+
+# Splits an option delta or length into its 4 bit nibble and extended value
+def _ext_encode(value: int):
+    if value <= 12:
+        return value, 0
+    elif value <= 268:
+        return 13, value - 13
+    elif value <= 65535 + 269:
+        return 14, value - 269
+    raise ParseException("Option delta or length is too large ({0})".format(value))
+
+
+def _ext_write(data: bytearray, pos: int, nibble: int, ext: int) -> int:
+    if nibble == 13:
+        data[pos] = ext
+        return pos + 1
+    elif nibble == 14:
+        data[pos] = (ext & 0xFF00) >> 8
+        data[pos + 1] = ext & 0xFF
+        return pos + 2
+    return pos
+
+
+# Packs a (class, detail) code tuple into the single byte used on the wire
+def code_to_int(code) -> int:
+    return ((code[0] & 0x7) << 5) | (code[1] & 0x1F)
+
+
+# Shared (class, detail) tuples for every packed code, so code lookups don't allocate
+_CODE_TUPLES = [((value >> 5) & 0x07, value & 0x1F) for value in range(256)]
+
+
 # Clasa pentru definirea unui pachet Co-AP cu toate campurile sale
+# Pachetele folosesc __slots__, iar codul este pastrat ca un singur octet (la fel ca pe fir)
 class Packet:
+    __slots__ = (
+        'version', 'addr',
+        '__type', '__code', '__id', '__token', '__options', '__payload', '__view', '__option_index', '__payload_start',
+        '__wire'
+    )
+
     # Constructor
     def __init__(self, m_type=TYPE_NON, m_code=MSG_EMPTY, m_id=0, m_token=bytes(0)):
 
         # Members
         self.version = COAP_VERSION
-        self.type = m_type
+        self.__type = m_type
         self.code = m_code
-        self.id = m_id
-        self.options = {}
-        self.payload = bytes(0)
-        self.token = m_token
+        self.__id = m_id
+        self.__token = m_token
+
+        # Options and payload are stored behind properties, so that lazily parsed packets
+        # can build them from the received buffer only when they are needed
+        # The options dictionary itself is only created when accessed
+        self.__options = None
+        self.__payload = _EMPTY_PAYLOAD
+
+        # Lazy parse state: a view over the received datagram, plus an index of
+        # (option number, offset, length) triples and the payload offset
+        self.__view: Optional[memoryview] = None
+        self.__option_index: Optional[array] = None
+        self.__payload_start = 0
+
+        # Cached wire image, filled by tobytes()
+        # Every change to the header, the options or the payload drops it (see the setters below)
+        self.__wire: Optional[bytes] = None
 
         # Send / receive address
         self.addr = ('127.0.0.1', 5683)
         return
 
+    @property
+    def type(self) -> int:
+        return self.__type
+
+    @type.setter
+    def type(self, value: int):
+        self.__type = value
+        self.__wire = None
+
+    @property
+    def id(self) -> int:
+        return self.__id
+
+    @id.setter
+    def id(self, value: int):
+        self.__id = value
+        self.__wire = None
+
+    @property
+    def token(self) -> bytes:
+        return self.__token
+
+    @token.setter
+    def token(self, value: bytes):
+        self.__token = value
+        self.__wire = None
+
+    # Message code as a (class, detail) tuple
+    @property
+    def code(self):
+        return _CODE_TUPLES[self.__code]
+
+    @code.setter
+    def code(self, value):
+        if isinstance(value, int):
+            self.__code = value & 0xFF
+        else:
+            self.__code = code_to_int(value)
+        self.__wire = None
+
+    # Message code packed into a single int, as it appears on the wire
+    @property
+    def raw_code(self) -> int:
+        return self.__code
+
+    # The dictionary can be changed in place (reply.options[OPT_X] = ...), so handing it out drops the cached image
+    # Read-only users should call get_option() instead
+    @property
+    def options(self) -> Dict[int, List[bytes]]:
+        if self.__options is None:
+            self.__options = self.__build_options()
+        self.__wire = None
+        return self.__options
+
+    @options.setter
+    def options(self, value: Dict[int, List[bytes]]):
+        self.__options = value
+        self.__option_index = None
+        self.__wire = None
+
+    @property
+    def payload(self) -> bytes:
+        if self.__payload is None:
+            self.__payload = bytes(self.__view[self.__payload_start:])
+        return self.__payload
+
+    @payload.setter
+    def payload(self, value: bytes):
+        self.__payload = value
+        self.__wire = None
+
+    # Returns the payload without copying it out of the received buffer (if the packet was parsed lazily)
+    def payload_view(self) -> memoryview:
+        if self.__payload is None:
+            return self.__view[self.__payload_start:]
+        return memoryview(self.__payload)
+
+    # Returns the values of an option, without building the whole options dictionary
+    def get_option(self, number: int) -> List[bytes]:
+        if self.__options is not None:
+            return self.__options.get(number, [])
+
+        if self.__option_index is None:
+            return []
+
+        index = self.__option_index
+        values = []
+        for i in range(0, len(index), 3):
+            if index[i] == number:
+                values.append(bytes(self.__view[index[i + 1]:(index[i + 1] + index[i + 2])]))
+            elif index[i] > number:
+                break  # Options are sorted by number
+        return values
+
+    # Copies the options and payload out of the received buffer, and drops the reference to it
+    # Must be called before the buffer of a lazily parsed packet is reused
+    def detach(self):
+        if self.__view is None:
+            return
+
+        if self.__options is None:
+            self.__options = self.__build_options()
+        if self.__payload is None:
+            self.__payload = bytes(self.__view[self.__payload_start:])
+
+        self.__view = None
+        self.__option_index = None
+
     # Initializeaza un pachet coap dintr-un sir de octeti
     # Parsarea este facuta dupa RFC7252
-    def parse(self, data):
+    # Daca lazy este True, optiunile si payload-ul raman in buffer-ul primit si sunt construite la cerere
+    def parse(self, data, lazy=False):
         if data is None:
             raise ParseException("No data provided")
 
-        bytecount = len(data)
-        bytesdone = 0
+        view = memoryview(data)
+        bytecount = len(view)
 
         # primii 4 biti sunt obligatorii in orice pachet CoAP
         if bytecount < 4:
@@ -160,151 +346,197 @@ class Packet:
 
         # Header Base
 
-        self.version = (0xC0 & data[0]) >> 6
-        self.type = (0x30 & data[0]) >> 4
-        self.code = ((data[1] >> 5) & 0x07, data[1] & 0x1F)
-        self.id = (data[2] << 8) | data[3]
-
-        token_length = 0x0F & data[0]
+        self.version = (0xC0 & view[0]) >> 6
+        self.__type = (0x30 & view[0]) >> 4
+        self.__code = view[1]
+        self.__id = (view[2] << 8) | view[3]
 
-        bytesdone += 4
+        token_length = 0x0F & view[0]
 
         # Tokens
 
-        if bytecount < bytesdone + token_length:
+        if bytecount < 4 + token_length:
             raise ParseException("Bad packet")
 
-        self.token = bytes(data[4:(4 + token_length)])
+        self.__token = bytes(view[4:(4 + token_length)])
 
-        bytesdone += token_length
+        self.__wire = None
 
         # Options
 
-        saveddelta = 0
+        index = array('I')
+        payload_start = self.__index_options(view, 4 + token_length, index)
+
+        if lazy:
+            self.__view = view
+            self.__option_index = index
+            self.__options = None
+            self.__payload_start = payload_start
+            self.__payload = None
+            return
+
+        self.__view = None
+        self.__option_index = None
+
+        options = {}
+        for i in range(0, len(index), 3):
+            # Pot fi si mai multe optiuni in unele cazuri, deci adaugam valorile parsate intr-o lista
+            if index[i] not in options:
+                options[index[i]] = []
+            options[index[i]].append(data[index[i + 1]:(index[i + 1] + index[i + 2])])
+        self.__options = options
+
+        # The rest of the message is just payload, add it to packet
+        # restul mesajului reprezinta date, adaugam la packet
 
-        while True:
-            if bytecount == bytesdone:
-                return  # End of message found
+        self.__payload = data[payload_start:bytecount]
 
-            delta = (0xF0 & data[bytesdone]) >> 4
-            length = 0x0F & data[bytesdone]
+        return
 
-            bytesdone += 1
+    # Parcurge optiunile din pachet si salveaza (numar, offset, lungime) pentru fiecare in index
+    # Returneaza offset-ul payload-ului
+    @staticmethod
+    def __index_options(view: memoryview, bytesdone: int, index: array) -> int:
+        bytecount = len(view)
+        saveddelta = 0
 
-            if delta == 0xF and length == 0xF:
-                break  # Payload marker found
+        try:
+            while True:
+                if bytecount == bytesdone:
+                    return bytesdone  # End of message found
 
-            if delta == 13:  # Delta extended with 1 byte
-                delta = data[bytesdone] + 13
-                bytesdone += 1
-            elif delta == 14:  # Delta extended with 2 bytes
-                delta = (data[bytesdone] << 8) + data[bytesdone + 1] + 269
-                bytesdone += 2
+                delta = (0xF0 & view[bytesdone]) >> 4
+                length = 0x0F & view[bytesdone]
 
-            if length == 13:  # Length extended with 1 byte
-                length = data[bytesdone] + 13
                 bytesdone += 1
-            elif length == 14:  # Length extended with 2 bytes
-                length = (data[bytesdone] << 8) + data[bytesdone + 1] + 269
-                bytesdone += 2
 
-            # Daca avem optiuni multiple, atunci delta este format din suma delta_precedent si delta_curent
-            deltatouse = saveddelta + delta
-            saveddelta += delta
+                if delta == 0xF and length == 0xF:
+                    return bytesdone  # Payload marker found
 
-            option = data[bytesdone:(bytesdone + length)]
-            bytesdone += length
+                if delta == 13:  # Delta extended with 1 byte
+                    delta = view[bytesdone] + 13
+                    bytesdone += 1
+                elif delta == 14:  # Delta extended with 2 bytes
+                    delta = (view[bytesdone] << 8) + view[bytesdone + 1] + 269
+                    bytesdone += 2
 
-            # Pot fi si mai multe optiuni in unele cazuri, deci adaugam valorile parsate intr-o lista
-            if deltatouse not in self.options:
-                self.options[deltatouse] = []
-            self.options[deltatouse].append(option)
+                if length == 13:  # Length extended with 1 byte
+                    length = view[bytesdone] + 13
+                    bytesdone += 1
+                elif length == 14:  # Length extended with 2 bytes
+                    length = (view[bytesdone] << 8) + view[bytesdone + 1] + 269
+                    bytesdone += 2
 
-        # The rest of the message is just payload, add it to packet
-        # restul mesajului reprezinta date, adaugam la packet
+                # Daca avem optiuni multiple, atunci delta este format din suma delta_precedent si delta_curent
+                saveddelta += delta
 
-        self.payload = data[bytesdone:bytecount]
+                if bytesdone + length > bytecount:
+                    raise ParseException("Option exceeds packet length")
 
-        return
+                index.append(saveddelta)
+                index.append(bytesdone)
+                index.append(length)
 
-    # Functie de convertire a unui pachet coap la un sir de octeti / operatiunea inversa parsarii
-    def tobytes(self):
-        # Write base header
+                bytesdone += length
+        except IndexError:
+            raise ParseException("Bad packet")
+
+    def __build_options(self) -> Dict[int, List[bytes]]:
+        options = {}
+        index = self.__option_index
+        view = self.__view
+
+        if index is None:
+            return options
+
+        for i in range(0, len(index), 3):
+            if index[i] not in options:
+                options[index[i]] = []
+            options[index[i]].append(bytes(view[index[i + 1]:(index[i + 1] + index[i + 2])]))
 
+        self.__option_index = None
+        return options
+
+    # Functie de convertire a unui pachet coap la un sir de octeti / operatiunea inversa parsarii
+    # Imaginea rezultata este salvata in pachet si poate fi refolosita prin cached_bytes()
+    def tobytes(self) -> bytes:
         token_length = len(self.token)
 
         if token_length > 8:
             raise ParseException("Token must be between 0 and 8 bytes (got {0})".format(token_length))
 
-        data = [
-            ((0x3 & self.version) << 6) | ((0x3 & self.type) << 4) | (0xF & token_length),
-            ((self.code[0] & 0x7) << 5) | (self.code[1] & 0x1F), (self.id & 0xFF00) >> 8,
-            self.id & 0x00FF
-        ]
-
-        # Write token (if any)
+        # Flatten options into (number, value) pairs sorted by option number
+        options = []
+        for number, values in sorted(self.options.items(), key=lambda item: item[0]):
+            if isinstance(values, (bytes, bytearray, memoryview)):
+                options.append((number, values))
+            else:
+                for value in values:
+                    options.append((number, value))
 
-        for i in range(0, token_length):
-            data.append(self.token[i])
+        payload = self.payload
+        payload_length = 0 if payload is None else len(payload)
 
-        # Write options
+        # First pass - compute the exact size of the message
 
+        size = 4 + token_length
         saveddelta = 0
 
-        options = sorted(self.options.items(), key=lambda item: item[0])
+        for number, value in options:
+            size += 1 + _ext_size(number - saveddelta) + _ext_size(len(value)) + len(value)
+            saveddelta = number
 
-        for pair in options:
-            deltatouse = pair[0] - saveddelta
-            saveddelta += deltatouse
+        if payload_length > 0:
+            size += 1 + payload_length
 
-            length = len(pair[1])
+        # Second pass - write everything into a preallocated buffer
 
-            firstbyte = 0
+        data = bytearray(size)
 
-            # Write first byte
+        _HEADER.pack_into(
+            data, 0,
+            ((0x3 & self.version) << 6) | ((0x3 & self.type) << 4) | (0xF & token_length),
+            self.__code,
+            self.id & 0xFFFF
+        )
 
-            if deltatouse <= 12:
-                firstbyte |= (0xF & deltatouse) << 4
-            elif deltatouse <= 268:
-                firstbyte |= 13 << 4
-            else:
-                firstbyte |= 14 << 4
+        pos = 4
+        data[pos:(pos + token_length)] = self.token
+        pos += token_length
 
-            if length <= 12:
-                firstbyte |= (0xF & length)
-            elif length <= 268:
-                firstbyte |= 13
-            else:
-                firstbyte |= 14
+        saveddelta = 0
 
-            data.append(firstbyte)
+        for number, value in options:
+            delta = number - saveddelta
+            saveddelta = number
+            length = len(value)
 
-            # Write extended option info
+            delta_nibble, delta_ext = _ext_encode(delta)
+            length_nibble, length_ext = _ext_encode(length)
 
-            if deltatouse >= 269:
-                data.append((0xFF00 & (deltatouse - 269)) >> 4)
-                data.append(0xFF & (deltatouse - 269))
-            elif deltatouse >= 13:
-                data.append(0xFF & (deltatouse - 13))
+            data[pos] = (delta_nibble << 4) | length_nibble
+            pos += 1
 
-            if length >= 269:
-                data.append((0xFF00 & (length - 269)) >> 4)
-                data.append(0xFF & (length - 269))
-            elif length >= 13:
-                data.append(0xFF & (length - 13))
+            # Write extended option info
+            pos = _ext_write(data, pos, delta_nibble, delta_ext)
+            pos = _ext_write(data, pos, length_nibble, length_ext)
 
             # Write the option itself
+            data[pos:(pos + length)] = value
+            pos += length
 
-            for i in range(0, len(pair[1])):
-                data.append(pair[1][i])
-
-        if self.payload is not None and len(self.payload) > 0:
-            data.append(0xFF)  # Payload marker
+        if payload_length > 0:
+            data[pos] = 0xFF  # Payload marker
+            data[(pos + 1):] = payload
 
-            for i in range(0, len(self.payload)):
-                data.append(self.payload[i])
+        self.__wire = bytes(data)
+        return self.__wire
 
-        return bytes(data)
+    # Returns the last encoded image of the packet, encoding it again if the packet changed since then
+    def cached_bytes(self) -> bytes:
+        if self.__wire is None:
+            return self.tobytes()
+        return self.__wire
 
     # Functie de reprezentare scrisa a pachetului
     def __str__(self):
@@ -334,6 +566,37 @@ class Packet:
             return TYPE_ACK
 
 
+# Encodes an unsigned integer option value, using as few bytes as possible (RFC 7252, section 3.2)
+def encode_uint(value: int) -> bytes:
+    if value == 0:
+        return bytes(0)
+    return value.to_bytes((value.bit_length() + 7) // 8, 'big')
+
+
+# Decodes an unsigned integer option value
+def decode_uint(value: bytes) -> int:
+    return int.from_bytes(value, 'big')
+
+
+# Largest block size exponent (SZX) - blocks are 2 ** (SZX + 4) bytes, up to 1024 (RFC 7959, section 2.2)
+BLOCK_MAX_SZX = 6
+
+
+# Encodes a Block1 / Block2 option value
+def encode_block(num: int, more: bool, szx: int) -> bytes:
+    return encode_uint((num << 4) | (0x08 if more else 0) | (szx & 0x07))
+
+
+# Decodes a Block1 / Block2 option value into (block number, more flag, SZX)
+def decode_block(value: bytes):
+    value = decode_uint(value)
+    return value >> 4, (value & 0x08) != 0, value & 0x07
+
+
+def block_size(szx: int) -> int:
+    return 1 << (szx + 4)
+
+
 # Creates a reset reply with the given message ID
 def make_reset(msg_id, msg_token):
     reply = Packet(TYPE_RESET, MSG_EMPTY, msg_id, msg_token)
@@ -387,6 +650,7 @@ def code_str(value):
         MSG_VALID: 'VALID',
         MSG_CHANGED: 'CHANGED',
         MSG_CONTENT: 'CONTENT',
+        MSG_CONTINUE: 'CONTINUE',
 
         MSG_BAD_REQUEST: 'BAD REQUEST',
         MSG_UNAUTHORIZED: 'UNAUTHORIZED',
@@ -0,0 +1,389 @@
+# coap_async_server.py
+# Implements the CoAP Server on top of asyncio
+# Receiving, retransmission timers and handlers all run on a single event loop
+import asyncio
+import inspect
+from threading import Thread, Event
+from typing import Optional, Callable, Dict, Tuple, Any
+
+from coap import *
+from coap_retransmit import PendingReply
+from coap_congestion import CongestionControl
+
+
+# Forwards datagrams from the event loop transport to the server
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+    def error_received(self, exc):
+        print('CoAP socket error: {0}'.format(exc))
+
+
+# Clasa pentru definirea unui server Co-AP bazat pe asyncio
+# Are aceeasi interfata ca Server (packet_receivers, on_*), dar handler-ele pot fi si "async def"
+class AsyncServer:
+    # Initializes CoAP Server using default values for options
+    def __init__(self):
+        self.ip = ''
+        self.port = 5683
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__transport: Optional[asyncio.DatagramTransport] = None
+        self.__thread: Optional[Thread] = None  # Used only when the server runs its own loop
+        self.__started = Event()
+        self.__next_msgid = 225
+        self.__tasks = set()  # Keeps running handler tasks alive
+
+        # Pending CON replies, along with their retransmission timer
+        self.__con_replies: Dict[Tuple[Any, int], Tuple[PendingReply, asyncio.TimerHandle]] = {}
+        self.__congestion = CongestionControl()  # NSTART and RTO estimation for every endpoint
+
+        # Msg Callback dictionary stores callbacks that are called for specific message codes
+        # Callbacks may be regular functions or coroutine functions
+        self.packet_receivers: Dict[Tuple[int, int], Callable[[Packet], Any]] = {}
+
+        # Used for handling replies that were lost
+        self.on_reply_lost: Optional[Callable[[Packet], None]] = None
+
+        # Used for handling RESET messages sent in response to our messages
+        self.on_reset_received: Optional[Callable[[Packet], None]] = None
+
+        # Used to tell which requests are slow to handle (returns True for them)
+        # Slow CON requests are acknowledged right away with an empty ACK, and their reply is sent later as a
+        # separate CON response (RFC 7252 section 5.2.2)
+        # Other CON requests get the same treatment once their handler runs for longer than config['ack_delay']
+        self.is_slow_request: Optional[Callable[[Packet], bool]] = None
+
+        # Used for logging purposes
+        self.on_request_received: Optional[Callable[[Packet], None]] = None
+
+        # Used for logging purposes
+        self.on_reply_sent: Optional[Callable[[Packet], None]] = None
+
+        # Configuration
+        # 'executor_handlers' - run regular (non-async) handlers in the loop's default thread pool
+        # 'nstart' - maximum number of CON messages in flight to one endpoint; the others wait in a queue
+        # 'max_queued' - maximum number of CON messages waiting in the queue of an endpoint; the oldest are dropped
+        # 'ack_delay' - CON requests whose reply isn't ready after this long (seconds) get an empty ACK, and their
+        # reply is sent as a separate response (regular handlers only yield to the loop with 'executor_handlers')
+        self.config: Dict[str, Any] = {
+            'maxdatasize': 65527,
+            'executor_handlers': False,
+            'nstart': COMM_NSTART,
+            'max_queued': 1000,
+            'ack_delay': 1.0
+        }
+
+        return
+
+    # Opens the UDP endpoint on the running event loop
+    async def open(self):
+        if self.__transport is not None:
+            return
+
+        self.__loop = asyncio.get_running_loop()
+        self.__congestion = CongestionControl(self.config['nstart'], self.config['max_queued'])
+        self.__transport, _ = await self.__loop.create_datagram_endpoint(
+            lambda: _ServerProtocol(self), local_addr=(self.ip or '0.0.0.0', self.port)
+        )
+
+        print("Started CoAP server (asyncio).")
+        return
+
+    # Closes the endpoint and cancels all pending retransmissions
+    async def close(self):
+        if self.__transport is None:
+            return
+
+        for reply, handle in self.__con_replies.values():
+            handle.cancel()
+        self.__con_replies.clear()
+
+        # CON messages still waiting for their turn won't be sent
+        self.__report_lost(self.__congestion.clear())
+
+        self.__transport.close()
+        self.__transport = None
+
+        print("Stopped CoAP server (asyncio).")
+        return
+
+    # Runs the server until the task is cancelled
+    async def serve_forever(self):
+        await self.open()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.close()
+
+    # Functie de pornire a serverului
+    # Porneste un event loop propriu intr-un thread separat (pentru aplicatii care nu folosesc asyncio)
+    def start(self):
+        if self.__thread is not None or self.__transport is not None:
+            return
+
+        self.__started.clear()
+        self.__thread = Thread(target=self.__run_loop)
+        self.__thread.start()
+        self.__started.wait()
+        return
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        future = asyncio.run_coroutine_threadsafe(self.close(), self.__loop)
+        future.result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__thread = None
+        return
+
+    def is_active(self):
+        return self.__transport is not None
+
+    # Sends a packet; can be called from any thread
+    def send(self, packet: Packet):
+        if self.__loop is None or self.__transport is None:
+            return
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.__loop:
+            self.__send(packet)
+        else:
+            self.__loop.call_soon_threadsafe(self.__send, packet)
+
+        return
+
+    # Congestion statistics (RTO, RTT, loss) of one endpoint, or of every endpoint if addr is None
+    def peer_stats(self, addr=None):
+        if addr is None:
+            return self.__congestion.all_stats()
+        return self.__congestion.stats(addr)
+
+    def generate_id(self):
+        msgid = self.__next_msgid
+        self.__next_msgid += 1
+        return msgid
+
+    # Called by the protocol for every received datagram
+    def datagram_received(self, data, addr):
+        try:
+            packet = Packet()
+            packet.addr = addr
+            packet.parse(data, lazy=True)
+
+            try:
+                if callable(self.on_request_received):
+                    self.on_request_received(packet)
+            except Exception as e:
+                print('On Request Received event threw an exception for some reason!')
+                print(e)
+
+        except ParseException as e:
+            print('Got a message, but parse failed.')
+            print('Exception message: {0}'.format(e))
+            print('Message contents: {0}'.format(data))
+            return
+        except Exception as e:
+            print('Got a message, but parse failed due to an internal error.')
+            print('Exception message: {0}'.format(e))
+            return
+
+        # Stop retransmission for the packet that matches the ACK's ID.
+        # The round trip time is measured, and the next message queued to the endpoint (if any) is sent
+        if packet.type == TYPE_ACK or packet.type == TYPE_RESET:
+            pending = self.__con_replies.pop((packet.addr, packet.id), None)
+            if pending is not None:
+                pending[1].cancel()
+                self.__start(self.__congestion.finish(pending[0], self.__loop.time(), acked=packet.type == TYPE_ACK,
+                                                      reset=packet.type == TYPE_RESET))
+
+        # RESET messages are only passed on to the reset callback (used to cancel Observe subscriptions)
+        if packet.type == TYPE_RESET:
+            if callable(self.on_reset_received):
+                self.on_reset_received(packet)
+            return
+
+        # EMPTY is not allowed. Intercept and reply with RESET EMPTY if packet is CON or ACK.
+        if packet.code == MSG_EMPTY:
+            if packet.type in [TYPE_CON, TYPE_NON]:
+                reply = make_reset(packet.id, bytes(0))
+                reply.addr = packet.addr
+                self.__send(reply)
+            return
+
+        # We can't parse this - we'll use a server error instead of a non-descriptive RESET
+        if packet.code not in self.packet_receivers:
+            reply = Packet(packet.get_reply_type(), MSG_NOT_IMPLEMENTED, packet.id, packet.token)
+            reply.payload = bytes('Server does not support the request type', 'utf-8')
+            reply.addr = packet.addr
+            self.__send(reply)
+            return
+
+        task = self.__loop.create_task(self.__handle(packet))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return
+
+    # Runs the receiver for a packet and sends its reply
+    async def __handle(self, packet: Packet):
+        receiver = self.packet_receivers[packet.code]
+        separate = packet.type == TYPE_CON and self.__is_slow(packet)
+        late_ack = None
+
+        def acknowledge():
+            nonlocal separate
+            separate = True
+
+            ack = make_empty_ack(packet.id, bytes(0))
+            ack.addr = packet.addr
+            self.__send(ack)
+
+        if separate:
+            acknowledge()
+        elif packet.type == TYPE_CON:
+            late_ack = self.__loop.call_later(self.config['ack_delay'], acknowledge)
+
+        try:
+            if inspect.iscoroutinefunction(receiver):
+                reply = await receiver(packet)
+            elif self.config['executor_handlers']:
+                reply = await self.__loop.run_in_executor(None, receiver, packet)
+            else:
+                reply = receiver(packet)
+                if inspect.isawaitable(reply):
+                    reply = await reply
+        except Exception:
+            reply = Packet(packet.get_reply_type(), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('An unknown internal error happened!', 'utf-8')
+
+        if late_ack is not None:
+            late_ack.cancel()
+
+        # No valid reply, send ACK INTERNAL ERROR if CON
+        if not isinstance(reply, Packet):
+            if packet.type != TYPE_CON:
+                return
+            reply = Packet(TYPE_ACK, MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('An unknown internal error happened!', 'utf-8')
+
+        # The request was already acknowledged, so the reply goes out as a separate CON response, matched by token
+        if separate and reply.type == TYPE_ACK:
+            reply.type = TYPE_CON
+            reply.id = self.generate_id()
+
+        reply.addr = packet.addr
+        self.__send(reply)
+        return
+
+    def __is_slow(self, packet: Packet) -> bool:
+        if not callable(self.is_slow_request):
+            return False
+
+        try:
+            return self.is_slow_request(packet)
+        except Exception as e:
+            print('Is Slow Request callback threw an exception:', e)
+            return False
+
+    def __run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            loop.run_until_complete(self.open())
+        except Exception as e:
+            print("Couldn't start CoAP server due to exception {0}".format(e))
+            self.__thread = None
+            self.__loop = None
+            self.__started.set()
+            loop.close()
+            return
+
+        self.__started.set()
+        loop.run_forever()
+        loop.close()
+        self.__loop = None
+        return
+
+    # Must be called from the event loop
+    # If message is of type CON, use retransmission timers
+    # For other message types, send the packet now
+    def __send(self, packet: Packet):
+        if self.__transport is None:
+            return
+
+        if packet.type == TYPE_CON:
+            reply = PendingReply(packet.tobytes(), packet.addr, packet.id)
+            ready, dropped = self.__congestion.submit(reply, self.__loop.time())
+            self.__start(ready)
+            self.__report_lost(dropped)
+        else:
+            self.__send_data(packet.tobytes(), packet.addr, packet)
+
+        return
+
+    # Must be called from the event loop
+    # Sends CON messages started by the congestion control, and sets their retransmission timers
+    def __start(self, ready):
+        for reply in ready:
+            key = (reply.addr, reply.msg_id)
+            previous = self.__con_replies.pop(key, None)
+            if previous is not None:
+                previous[1].cancel()
+
+            self.__send_data(reply.data, reply.addr, None)
+            handle = self.__loop.call_later(reply.wait_time, self.__retransmit, key)
+            self.__con_replies[key] = (reply, handle)
+
+    def __report_lost(self, lost):
+        if callable(self.on_reply_lost):
+            for reply in lost:
+                self.on_reply_lost(reply.packet)
+
+    # Retransmission timer callback
+    # Messages that exceed MAX_RETRANSMIT sends are removed
+    def __retransmit(self, key):
+        pending = self.__con_replies.get(key)
+        if pending is None:
+            return
+
+        reply = pending[0]
+
+        if reply.attempts_left > 0:
+            reply.attempts_left -= 1
+            self.__congestion.retransmitted(reply)
+            self.__send_data(reply.data, reply.addr, None)
+
+            delay = reply.wait_time * (reply.backoff ** (reply.attempts - reply.attempts_left))
+            self.__con_replies[key] = (reply, self.__loop.call_later(delay, self.__retransmit, key))
+        else:
+            # Giving up on a message makes room for the next one queued to the same endpoint
+            del self.__con_replies[key]
+            self.__start(self.__congestion.finish(reply, self.__loop.time(), acked=False))
+            self.__report_lost([reply])
+
+        return
+
+    def __send_data(self, data: bytes, addr, packet: Optional[Packet]):
+        try:
+            self.__transport.sendto(data, addr)
+
+            if callable(self.on_reply_sent):
+                if packet is None:
+                    packet = Packet()
+                    packet.parse(data, lazy=True)
+                    packet.addr = addr
+                self.on_reply_sent(packet)
+        except Exception as e:
+            print("Couldn't send packet due to exception {0}".format(e))
+
+        return
@@ -0,0 +1,113 @@
+# coap_cache.py
+# Caches encoded reply payloads for files and folders, so hot objects aren't read and encoded again on every request
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Dict, Any
+
+
+# Approximate memory used by an entry, not counting the payload
+ENTRY_OVERHEAD = 200
+
+
+# Stores encoded payloads keyed by normalized path
+# An entry is only used while the object's (st_ino, st_size, st_mtime_ns) match the values it was built from,
+# so a single os.stat validates it; the least recently used entries are evicted when over the memory budget
+# An entry can hold several encodings of the same object (variants, e.g. JSON and CBOR payloads)
+class ResponseCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0  # Payload bytes served from the cache instead of being read and encoded again
+
+        # path -> (fingerprint, {variant: payload})
+        self.__entries: OrderedDict = OrderedDict()
+        self.__size = 0
+        self.__lock = Lock()  # Handlers run on several worker threads
+
+    def __len__(self):
+        return len(self.__entries)
+
+    # Returns the cached payload for path, if it was built from the same version of the object
+    def get(self, path: str, stats, variant=None) -> Optional[bytes]:
+        fingerprint = (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+        with self.__lock:
+            entry = self.__entries.get(path)
+            payload = entry[1].get(variant) if entry is not None and entry[0] == fingerprint else None
+
+            if payload is None:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(path)
+            self.hits += 1
+            self.bytes_saved += len(payload)
+            return payload
+
+    # Saves the payload built for path; stats must have been taken before the object was read
+    def put(self, path: str, stats, payload: bytes, variant=None):
+        if len(payload) + ENTRY_OVERHEAD > self.max_bytes:
+            return
+
+        fingerprint = (stats.st_ino, stats.st_size, stats.st_mtime_ns)
+
+        with self.__lock:
+            entry = self.__entries.get(path)
+            if entry is None or entry[0] != fingerprint:
+                self.__remove(path)
+                entry = (fingerprint, {})
+                self.__entries[path] = entry
+            else:
+                self.__entries.move_to_end(path)
+
+            previous = entry[1].get(variant)
+            if previous is not None:
+                self.__size -= len(previous) + ENTRY_OVERHEAD
+
+            entry[1][variant] = payload
+            self.__size += len(payload) + ENTRY_OVERHEAD
+
+            while self.__size > self.max_bytes and len(self.__entries) > 0:
+                self.__remove(next(iter(self.__entries)))
+
+    # Drops the entry of a path (called by commands that modify it)
+    def invalidate(self, path: str):
+        with self.__lock:
+            self.__remove(path)
+
+    # Drops the entries of a path and of everything inside it
+    def invalidate_tree(self, path: str):
+        prefix = path + '/'
+        with self.__lock:
+            for key in [key for key in self.__entries if key == path or key.startswith(prefix)]:
+                self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    # Memory used by the cache (approximate)
+    def size(self) -> int:
+        return self.__size
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio(),
+            'bytes_saved': self.bytes_saved
+        }
+
+    # Must be called with the lock held
+    def __remove(self, path: str):
+        entry = self.__entries.pop(path, None)
+        if entry is not None:
+            self.__size -= sum(len(payload) + ENTRY_OVERHEAD for payload in entry[1].values())
@@ -0,0 +1,202 @@
+# coap_cbor.py
+# Minimal CBOR (RFC 8949) encoder and decoder, for payloads with Content-Format 60 (application/cbor)
+# Covers the types used by JSON payloads, plus byte strings: None, bool, int, float, str, bytes, list, dict
+import struct
+from typing import Any, Tuple
+
+
+# Nesting deeper than this is rejected, so hostile payloads can't exhaust the stack
+MAX_DEPTH = 64
+
+_BREAK = 0xFF
+
+
+# Raised for values that can't be encoded, and for malformed CBOR data
+class CBORException(ValueError):
+    pass
+
+
+# Writes the initial byte of an item (major type + argument), followed by the argument's extra bytes
+def _head(major: int, value: int, out: bytearray):
+    if value < 24:
+        out.append(major << 5 | value)
+    elif value < 0x100:
+        out.append(major << 5 | 24)
+        out.append(value)
+    elif value < 0x10000:
+        out.append(major << 5 | 25)
+        out += struct.pack('!H', value)
+    elif value < 0x100000000:
+        out.append(major << 5 | 26)
+        out += struct.pack('!I', value)
+    elif value < 0x10000000000000000:
+        out.append(major << 5 | 27)
+        out += struct.pack('!Q', value)
+    else:
+        raise CBORException('Integer is too big for CBOR')
+
+
+def _encode(value: Any, out: bytearray, depth: int):
+    if depth > MAX_DEPTH:
+        raise CBORException('Value is nested too deeply')
+
+    if value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            _head(0, value, out)
+        else:
+            _head(1, -1 - value, out)
+    elif isinstance(value, float):
+        out.append(0xFB)
+        out += struct.pack('!d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        _head(3, len(data), out)
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _head(2, len(value), out)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _head(4, len(value), out)
+        for item in value:
+            _encode(item, out, depth + 1)
+    elif isinstance(value, dict):
+        _head(5, len(value), out)
+        for key, item in value.items():
+            _encode(key, out, depth + 1)
+            _encode(item, out, depth + 1)
+    else:
+        raise CBORException("Can't encode values of type {0}".format(type(value).__name__))
+
+
+def encode(value: Any) -> bytes:
+    out = bytearray()
+    _encode(value, out, 0)
+    return bytes(out)
+
+
+def _read(data: bytes, offset: int, size: int) -> bytes:
+    if offset + size > len(data):
+        raise CBORException('CBOR data is truncated')
+    return data[offset:offset + size]
+
+
+# Reads the argument of an item; returns (argument, new offset), with argument None for indefinite lengths
+def _argument(data: bytes, offset: int, info: int) -> Tuple[Any, int]:
+    if info < 24:
+        return info, offset
+    if info == 24:
+        return _read(data, offset, 1)[0], offset + 1
+    if info == 25:
+        return struct.unpack('!H', _read(data, offset, 2))[0], offset + 2
+    if info == 26:
+        return struct.unpack('!I', _read(data, offset, 4))[0], offset + 4
+    if info == 27:
+        return struct.unpack('!Q', _read(data, offset, 8))[0], offset + 8
+    if info == 31:
+        return None, offset
+    raise CBORException('Invalid CBOR item argument {0}'.format(info))
+
+
+def _is_break(data: bytes, offset: int) -> bool:
+    return _read(data, offset, 1)[0] == _BREAK
+
+
+def _decode(data: bytes, offset: int, depth: int) -> Tuple[Any, int]:
+    if depth > MAX_DEPTH:
+        raise CBORException('CBOR data is nested too deeply')
+
+    initial = _read(data, offset, 1)[0]
+    offset += 1
+    major = initial >> 5
+    info = initial & 0x1F
+
+    # Simple values and floats
+    if major == 7:
+        if info == 20:
+            return False, offset
+        if info == 21:
+            return True, offset
+        if info == 22 or info == 23:
+            return None, offset
+        if info == 25:
+            return struct.unpack('!e', _read(data, offset, 2))[0], offset + 2
+        if info == 26:
+            return struct.unpack('!f', _read(data, offset, 4))[0], offset + 4
+        if info == 27:
+            return struct.unpack('!d', _read(data, offset, 8))[0], offset + 8
+        raise CBORException('Unsupported CBOR simple value {0}'.format(info))
+
+    argument, offset = _argument(data, offset, info)
+
+    if argument is None and major not in [2, 3, 4, 5]:
+        raise CBORException('Indefinite length is not allowed for CBOR major type {0}'.format(major))
+
+    if major == 0:
+        return argument, offset
+
+    if major == 1:
+        return -1 - argument, offset
+
+    if major == 2 or major == 3:
+        if argument is None:
+            # Indefinite length string: definite length chunks of the same type, until a break
+            chunks = []
+            while not _is_break(data, offset):
+                if _read(data, offset, 1)[0] >> 5 != major:
+                    raise CBORException('Invalid chunk in indefinite length CBOR string')
+                chunk, offset = _decode(data, offset, depth + 1)
+                chunks.append(chunk)
+            offset += 1
+            return (b'' if major == 2 else '').join(chunks), offset
+
+        value = _read(data, offset, argument)
+        offset += argument
+
+        if major == 2:
+            return value, offset
+
+        try:
+            return value.decode('utf-8'), offset
+        except UnicodeDecodeError:
+            raise CBORException('CBOR text string is not valid UTF-8')
+
+    if major == 4:
+        items = []
+        while (len(items) < argument) if argument is not None else not _is_break(data, offset):
+            item, offset = _decode(data, offset, depth + 1)
+            items.append(item)
+        if argument is None:
+            offset += 1
+        return items, offset
+
+    if major == 5:
+        items = {}
+        count = 0
+        while (count < argument) if argument is not None else not _is_break(data, offset):
+            key, offset = _decode(data, offset, depth + 1)
+            value, offset = _decode(data, offset, depth + 1)
+            try:
+                items[key] = value
+            except TypeError:
+                raise CBORException('CBOR map keys must be strings, numbers or byte strings')
+            count += 1
+        if argument is None:
+            offset += 1
+        return items, offset
+
+    # Major type 6 - tags are ignored, and the tagged item is returned as it is
+    return _decode(data, offset, depth + 1)
+
+
+def decode(data: bytes) -> Any:
+    data = bytes(data)
+    value, offset = _decode(data, 0, 0)
+    if offset != len(data):
+        raise CBORException('Unexpected data after the CBOR item')
+    return value
@@ -0,0 +1,238 @@
+# coap_cluster.py
+# Runs several CoAP server processes on the same port (SO_REUSEPORT)
+# The kernel spreads clients across the processes, so every core can run its own server
+import multiprocessing
+import os
+import signal
+import time
+from typing import Optional, Dict, List, Any
+
+from coap_server import Server
+from coap_parser import Parser
+
+
+# Raised in a worker process when the supervisor asks it to stop
+class _WorkerStop(Exception):
+    pass
+
+
+def _on_sigterm(signum, frame):
+    raise _WorkerStop()
+
+
+# Entry point of a worker process
+# Every worker has its own Server and Parser, bound on the same address
+# Stats are reported through the worker's own pipe; no locks are shared with other processes,
+# so a worker that gets killed can never block the supervisor or its siblings
+def _worker_main(ip, port, config, stats_conn, stats_interval):
+    signal.signal(signal.SIGTERM, _on_sigterm)
+
+    parser = Parser()
+    server = Server()
+    server.ip = ip
+    server.port = port
+    server.config.update(config)
+    server.config['reuse_port'] = True
+
+    parser.register(server)
+    server.start()
+
+    try:
+        while True:
+            time.sleep(stats_interval)
+            stats_conn.send(dict(server.stats))
+    except (_WorkerStop, KeyboardInterrupt):
+        pass
+    finally:
+        server.stop()
+        parser.close()
+        stats_conn.send(dict(server.stats))
+        stats_conn.close()
+
+    return
+
+
+# Supervisor for a group of server processes
+# Crashed workers are restarted, and their stats are aggregated
+class Cluster:
+    def __init__(self, processes: Optional[int] = None):
+        self.ip = ''
+        self.port = 5683
+        self.processes = processes or os.cpu_count() or 1
+
+        # Server config entries that are applied in every worker
+        self.config: Dict[str, Any] = {}
+
+        # How often workers report their stats (seconds)
+        self.stats_interval = 1.0
+
+        # Minimum delay between two restarts of the same worker (seconds)
+        self.restart_delay = 1.0
+
+        # How often run() prints the cluster-wide stats (seconds; 0 only prints them on shutdown)
+        self.report_interval = 60.0
+
+        self.__context = multiprocessing.get_context('fork')
+        self.__workers: List[Optional[multiprocessing.Process]] = []
+        self.__stats_conns: List[Optional[Any]] = []  # Receiving end of every worker's stats pipe
+        self.__last_start: List[float] = []
+        self.__stopping = False
+
+        # Last stats reported by every worker slot, plus the totals of previous (dead) processes
+        self.__worker_stats: List[Dict[str, int]] = []
+        self.__retired_stats: Dict[str, int] = {}
+        self.restarts = 0
+
+        return
+
+    def start(self):
+        if len(self.__workers) > 0:
+            return
+
+        self.__stopping = False
+        self.__workers = [None] * self.processes
+        self.__stats_conns = [None] * self.processes
+        self.__last_start = [0.0] * self.processes
+        self.__worker_stats = [{} for _ in range(self.processes)]
+        self.__retired_stats = {}
+        self.restarts = 0
+
+        for i in range(self.processes):
+            self.__start_worker(i)
+
+        print("Started CoAP cluster with {0} processes.".format(self.processes))
+        return
+
+    def stop(self):
+        if len(self.__workers) == 0:
+            return
+
+        self.__stopping = True
+
+        # SIGTERM makes workers stop their server and send their final stats
+        for worker in self.__workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+
+        self.__collect_stats()
+
+        for i, worker in enumerate(self.__workers):
+            if worker is not None:
+                worker.join(5)
+                if worker.is_alive():
+                    worker.kill()
+                    worker.join()
+                self.__retire(i)
+
+        self.__workers = []
+        self.__stats_conns = []
+
+        print("Stopped CoAP cluster.")
+        return
+
+    def is_active(self):
+        return len(self.__workers) > 0
+
+    # Collects worker stats and restarts workers that died
+    # Should be called periodically (run() does this)
+    def supervise(self):
+        self.__collect_stats()
+
+        if self.__stopping:
+            return
+
+        now = time.monotonic()
+
+        for i, worker in enumerate(self.__workers):
+            if worker is not None and worker.is_alive():
+                continue
+
+            if now - self.__last_start[i] < self.restart_delay:
+                continue
+
+            if worker is not None:
+                print("CoAP worker {0} (pid {1}) exited with code {2}, restarting.".format(i, worker.pid,
+                                                                                          worker.exitcode))
+                self.__retire(i)
+                self.restarts += 1
+
+            self.__start_worker(i)
+
+        return
+
+    # Runs the supervisor until interrupted, printing the stats every report_interval seconds and on shutdown
+    def run(self):
+        self.start()
+        last_report = time.monotonic()
+        try:
+            while True:
+                time.sleep(self.stats_interval)
+                self.supervise()
+
+                if self.report_interval > 0 and time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self.report()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.report()
+
+    # Prints the totals of stats()
+    def report(self):
+        totals = self.stats()
+        print('CoAP cluster stats: ' + ', '.join('{0}={1}'.format(key, value) for key, value in sorted(totals.items())))
+
+    # Totals of all stats reported by the workers (including restarted ones)
+    def stats(self) -> Dict[str, int]:
+        totals = dict(self.__retired_stats)
+        for worker_stats in self.__worker_stats:
+            for key, value in worker_stats.items():
+                totals[key] = totals.get(key, 0) + value
+        totals['processes'] = sum(1 for worker in self.__workers if worker is not None and worker.is_alive())
+        totals['restarts'] = self.restarts
+        return totals
+
+    def __start_worker(self, index):
+        recv_conn, send_conn = self.__context.Pipe(duplex=False)
+
+        worker = self.__context.Process(
+            target=_worker_main,
+            args=(self.ip, self.port, dict(self.config), send_conn, self.stats_interval),
+            name='CoAP server {0}'.format(index),
+            daemon=True
+        )
+        worker.start()
+        send_conn.close()  # Only the worker writes to it
+
+        self.__workers[index] = worker
+        self.__stats_conns[index] = recv_conn
+        self.__last_start[index] = time.monotonic()
+
+    # Reads the last stats of a dead worker, and moves them to the retired totals
+    def __retire(self, index):
+        self.__read_stats(index)
+
+        for key, value in self.__worker_stats[index].items():
+            self.__retired_stats[key] = self.__retired_stats.get(key, 0) + value
+        self.__worker_stats[index] = {}
+
+        if self.__stats_conns[index] is not None:
+            self.__stats_conns[index].close()
+            self.__stats_conns[index] = None
+
+    def __collect_stats(self):
+        for i in range(len(self.__stats_conns)):
+            self.__read_stats(i)
+
+    # Keeps the most recent stats sent by a worker
+    def __read_stats(self, index):
+        conn = self.__stats_conns[index]
+        if conn is None:
+            return
+
+        try:
+            while conn.poll():
+                self.__worker_stats[index] = conn.recv()
+        except (EOFError, OSError):
+            pass  # Worker exited
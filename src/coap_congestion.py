@@ -0,0 +1,229 @@
+# coap_congestion.py
+# Per-endpoint congestion control for CON messages: NSTART (RFC 7252, section 4.7) and the CoCoA
+# retransmission timeout estimator (draft-ietf-core-cocoa)
+import random
+from collections import OrderedDict, deque
+from typing import Optional, Dict, List, Tuple, Any
+
+from coap import *
+from coap_retransmit import PendingReply
+
+
+# RTT estimator, as in RFC 6298 (SRTT / RTTVAR), with the weight K of RTTVAR in the timeout as a parameter
+class _Estimator:
+    __slots__ = ('k', 'srtt', 'rttvar', 'rto')
+
+    def __init__(self, k: float):
+        self.k = k
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+        self.rto: Optional[float] = None
+
+    def update(self, rtt: float) -> float:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.rto = self.srtt + self.k * self.rttvar
+        return self.rto
+
+
+# Congestion state of one endpoint
+class PeerState:
+    __slots__ = ('strong', 'weak', 'rto', 'rto_updated', 'outstanding', 'queue',
+                 'sent', 'retransmitted', 'acked', 'reset', 'lost', 'dropped')
+
+    def __init__(self, now: float):
+        # The strong estimator uses exchanges that needed no retransmission, the weak one those that needed 1 or 2
+        # (measured from the first transmission, since it's unknown which one was acknowledged)
+        self.strong = _Estimator(4)
+        self.weak = _Estimator(1)
+        self.rto = float(COMM_ACK_TIMEOUT)  # Overall RTO, used for new messages
+        self.rto_updated = now
+
+        self.outstanding = 0  # CON messages sent and not acknowledged yet
+        self.queue = deque()  # CON messages waiting for one of the outstanding ones to finish
+
+        self.sent = 0
+        self.retransmitted = 0
+        self.acked = 0
+        self.reset = 0  # Answered with a RESET (the endpoint is reachable, but rejected the message)
+        self.lost = 0
+        self.dropped = 0  # Messages dropped from a full queue, without being sent
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.acked + self.reset + self.lost
+        return {
+            'rto': self.rto,
+            'srtt': self.strong.srtt,
+            'rttvar': self.strong.rttvar,
+            'outstanding': self.outstanding,
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'retransmitted': self.retransmitted,
+            'acked': self.acked,
+            'reset': self.reset,
+            'lost': self.lost,
+            'dropped': self.dropped,
+            'loss_ratio': self.lost / finished if finished > 0 else 0.0
+        }
+
+
+# Keeps the state of every endpoint the server sends CON messages to
+# At most nstart messages are in flight to an endpoint; the others wait in its queue (at most max_queued of them,
+# the oldest are dropped beyond that), and are started when an outstanding message is acknowledged or given up on
+# Timeouts follow CoCoA: the RTO is estimated from ACK timing, backed off by a factor that depends on it, and
+# drifts back towards the default when an endpoint hasn't been measured in a while
+# Not thread safe; the server calls it with its own lock held
+class CongestionControl:
+    def __init__(self, nstart=COMM_NSTART, max_queued=1000, max_peers=10000):
+        self.nstart = nstart
+        self.max_queued = max_queued
+        self.max_peers = max_peers
+
+        # Bounds of the estimated RTO (seconds)
+        self.min_rto = 0.1
+        self.max_rto = 60.0
+
+        self.__peers: OrderedDict = OrderedDict()  # addr -> PeerState, least recently used first
+
+    def __len__(self):
+        return len(self.__peers)
+
+    # Takes a new CON message
+    # Returns the messages that must be sent now (started with start()), and the ones dropped from a full queue
+    def submit(self, reply: PendingReply, now: float) -> Tuple[List[PendingReply], List[PendingReply]]:
+        peer = self.__peer(reply.addr, now)
+
+        if peer.outstanding < self.nstart and len(peer.queue) == 0:
+            self.__start(peer, reply, now)
+            return [reply], []
+
+        dropped = []
+        peer.queue.append(reply)
+        while len(peer.queue) > self.max_queued:
+            dropped.append(peer.queue.popleft())
+            peer.dropped += 1
+
+        return [], dropped
+
+    # Called when an outstanding message is acknowledged (acked = True), rejected with a RESET (reset = True),
+    # or given up on; only ACKs are used as RTT samples
+    # Returns the queued messages that can be sent now
+    def finish(self, reply: PendingReply, now: float, acked: bool, reset: bool = False) -> List[PendingReply]:
+        peer = self.__peers.get(reply.addr)
+        if peer is None:
+            return []
+
+        peer.outstanding = max(0, peer.outstanding - 1)
+
+        if acked:
+            peer.acked += 1
+            self.__measure(peer, reply, now)
+        elif reset:
+            peer.reset += 1
+        else:
+            peer.lost += 1
+
+        ready = []
+        while len(peer.queue) > 0 and peer.outstanding < self.nstart:
+            queued = peer.queue.popleft()
+            self.__start(peer, queued, now)
+            ready.append(queued)
+
+        return ready
+
+    def retransmitted(self, reply: PendingReply):
+        peer = self.__peers.get(reply.addr)
+        if peer is not None:
+            peer.retransmitted += 1
+
+    # Current RTO of an endpoint (the default one, if nothing was measured yet)
+    def rto(self, addr) -> float:
+        peer = self.__peers.get(addr)
+        return peer.rto if peer is not None else float(COMM_ACK_TIMEOUT)
+
+    # Statistics of one endpoint, or None if it's unknown
+    def stats(self, addr) -> Optional[Dict[str, Any]]:
+        peer = self.__peers.get(addr)
+        return peer.stats() if peer is not None else None
+
+    # Statistics of every known endpoint
+    def all_stats(self) -> Dict[Any, Dict[str, Any]]:
+        return {addr: peer.stats() for addr, peer in self.__peers.items()}
+
+    # Messages waiting in the queues are dropped; they are returned so the server can report them
+    def clear(self) -> List[PendingReply]:
+        queued = [reply for peer in self.__peers.values() for reply in peer.queue]
+        self.__peers.clear()
+        return queued
+
+    def __peer(self, addr, now: float) -> PeerState:
+        peer = self.__peers.get(addr)
+        if peer is not None:
+            self.__peers.move_to_end(addr)
+            return peer
+
+        # Forget the least recently used endpoints that have nothing in flight
+        if len(self.__peers) >= self.max_peers:
+            for old_addr in list(self.__peers.keys()):
+                old = self.__peers[old_addr]
+                if old.outstanding == 0 and len(old.queue) == 0:
+                    del self.__peers[old_addr]
+                    if len(self.__peers) < self.max_peers:
+                        break
+
+        peer = PeerState(now)
+        self.__peers[addr] = peer
+        return peer
+
+    # Sets the timeout and back-off of a message that is about to be sent for the first time
+    def __start(self, peer: PeerState, reply: PendingReply, now: float):
+        self.__age(peer, now)
+
+        # Dithering, so messages started together don't time out together
+        reply.wait_time = peer.rto * ((COMM_ACK_RANDOM_FACTOR - 1) * random.random() + 1)
+        reply.attempts = COMM_MAX_RETRANSMIT
+        reply.attempts_left = reply.attempts
+        reply.sent_at = now
+
+        # Variable back-off factor: short timeouts grow faster, long ones slower
+        if peer.rto < 1:
+            reply.backoff = 3
+        elif peer.rto > 3:
+            reply.backoff = 1.5
+        else:
+            reply.backoff = 2
+
+        peer.outstanding += 1
+        peer.sent += 1
+
+    def __measure(self, peer: PeerState, reply: PendingReply, now: float):
+        transmissions = reply.attempts - reply.attempts_left + 1
+        rtt = now - reply.sent_at
+
+        if transmissions == 1:
+            rto = peer.strong.update(rtt)
+            peer.rto = 0.5 * rto + 0.5 * peer.rto
+        elif transmissions <= 3:
+            rto = peer.weak.update(rtt)
+            peer.rto = 0.25 * rto + 0.75 * peer.rto
+        else:
+            return
+
+        peer.rto = min(self.max_rto, max(self.min_rto, peer.rto))
+        peer.rto_updated = now
+
+    # RTO aging: very short or very long estimates move back towards the default if they aren't refreshed
+    def __age(self, peer: PeerState, now: float):
+        idle = now - peer.rto_updated
+
+        if peer.rto < 1 and idle > 16 * peer.rto:
+            peer.rto = min(1.0, 2 * peer.rto)
+            peer.rto_updated = now
+        elif peer.rto > 3 and idle > 4 * peer.rto:
+            peer.rto = (COMM_ACK_TIMEOUT + peer.rto) / 2
+            peer.rto_updated = now
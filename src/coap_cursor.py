@@ -0,0 +1,93 @@
+# coap_cursor.py
+# Keeps the state of paginated listings, so a client can ask for the next page with an opaque cursor
+import itertools
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Callable, Iterator, List, Tuple, Any
+
+
+# Stores result iterators (e.g. a paused tree walk) under random cursor IDs
+# Cursors expire after lifetime seconds, and the oldest ones are dropped when there are more than capacity
+# A cursor can be used once; the next page gets a new one
+class CursorTable:
+    def __init__(self, capacity=1000, lifetime=60.0):
+        self.capacity = capacity
+        self.lifetime = lifetime
+
+        # cursor -> (expiry time, owner, iterator)
+        self.__cursors: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__cursors)
+
+    # Saves an iterator; owner identifies what is being listed (a cursor can't be used for something else)
+    def create(self, owner, iterator: Iterator) -> str:
+        cursor = secrets.token_urlsafe(12)
+        now = time.monotonic()
+
+        with self.__lock:
+            self.__expire(now)
+            self.__cursors[cursor] = (now + self.lifetime, owner, iterator)
+            while len(self.__cursors) > self.capacity:
+                self.__cursors.popitem(last=False)
+
+        return cursor
+
+    # Removes a cursor and returns its iterator, or None if it doesn't exist, has expired, or belongs to another owner
+    def take(self, cursor: str, owner) -> Optional[Iterator]:
+        with self.__lock:
+            self.__expire(time.monotonic())
+
+            entry = self.__cursors.get(cursor)
+            if entry is None or entry[1] != owner:
+                return None
+
+            del self.__cursors[cursor]
+            return entry[2]
+
+    def clear(self):
+        with self.__lock:
+            self.__cursors.clear()
+
+    # Must be called with the lock held
+    def __expire(self, now: float):
+        while len(self.__cursors) > 0:
+            cursor, entry = next(iter(self.__cursors.items()))
+            if entry[0] > now:
+                return
+            del self.__cursors[cursor]
+
+
+# Takes up to limit items from an iterator, and (if max_bytes is given) only as many as fit in max_bytes, with
+# size(item) giving the encoded size of an item; a page always has at least one item, so listings can't get stuck
+# None items are heartbeats (sent by walkers while they skip over entries); they let a page end early
+# if the deadline passes
+# Returns the items, and an iterator over the remaining ones (None if there are no more)
+def take_page(iterator: Iterator, limit: Optional[int], deadline: Optional[float] = None,
+              max_bytes: Optional[int] = None, size: Optional[Callable[[Any], int]] = None
+              ) -> Tuple[List[Any], Optional[Iterator]]:
+    items = []
+    used = 0
+
+    for item in iterator:
+        if item is None:
+            if deadline is not None and time.monotonic() > deadline:
+                return items, iterator
+            continue
+
+        if limit is not None and len(items) >= limit:
+            # Look-ahead item, put back in front of the rest
+            return items, itertools.chain([item], iterator)
+
+        if max_bytes is not None:
+            item_size = size(item)
+            if len(items) > 0 and used + item_size > max_bytes:
+                return items, itertools.chain([item], iterator)
+            used += item_size
+
+        items.append(item)
+
+    return items, None
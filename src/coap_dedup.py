@@ -0,0 +1,117 @@
+# coap_dedup.py
+# Detects duplicate requests, and replays the reply that was already sent (RFC 7252, section 4.5)
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Any
+
+from coap import *
+
+
+# Approximate memory used by an entry, not counting the encoded reply
+ENTRY_OVERHEAD = 200
+
+
+# Stores the replies sent for recent requests, keyed by (endpoint, message ID)
+# Entries expire after EXCHANGE_LIFETIME (NON_LIFETIME for NON requests), and the least recently used ones
+# are evicted when the cache goes over its memory budget
+class DuplicateCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # key -> [expiry time, encoded reply (None while the request is being handled)]
+        self.__entries: OrderedDict = OrderedDict()
+        self.__size = 0
+
+        # (expiry time, counter, key, entry), kept apart from the LRU order, since hits move entries to the end
+        # while their expiry time stays the same (and CON and NON requests have different lifetimes)
+        # Entries removed by other means are left in the heap, and skipped when they reach the top
+        self.__expiries = []
+        self.__counter = itertools.count()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    # Looks up a request
+    # Returns (True, reply) for duplicates - reply is None if the original request is still being handled
+    # Returns (False, None) for new requests, and remembers them
+    def check(self, packet: Packet, now: Optional[float] = None) -> Tuple[bool, Optional[bytes]]:
+        if now is None:
+            now = time.monotonic()
+
+        self.__expire(now)
+
+        key = (packet.addr, packet.id)
+        entry = self.__entries.get(key)
+
+        if entry is not None and entry[0] > now:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+        if entry is not None:
+            self.__remove(key)
+
+        lifetime = COMM_EXCHANGE_LIFETIME if packet.type == TYPE_CON else COMM_NON_LIFETIME
+        entry = [now + lifetime, None]
+        self.__entries[key] = entry
+        self.__size += ENTRY_OVERHEAD
+        heapq.heappush(self.__expiries, (entry[0], next(self.__counter), key, entry))
+        self.misses += 1
+
+        self.__shrink()
+        return False, None
+
+    # Saves the encoded reply of a request, so duplicates can be answered with it
+    def store(self, addr, msg_id, reply: bytes):
+        entry = self.__entries.get((addr, msg_id))
+        if entry is None:
+            return
+
+        if entry[1] is not None:
+            self.__size -= len(entry[1])
+
+        entry[1] = reply
+        self.__size += len(reply)
+        self.__shrink()
+
+    # Forgets a request (used when it wasn't processed, so a retransmission must be handled again)
+    def forget(self, addr, msg_id):
+        self.__remove((addr, msg_id))
+
+    def clear(self):
+        self.__entries.clear()
+        self.__expiries = []
+        self.__size = 0
+
+    # Memory used by the cache (approximate)
+    def size(self) -> int:
+        return self.__size
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+
+        self.__size -= ENTRY_OVERHEAD
+        if entry[1] is not None:
+            self.__size -= len(entry[1])
+
+    # Drops expired entries, in expiry order
+    def __expire(self, now: float):
+        while len(self.__expiries) > 0 and self.__expiries[0][0] <= now:
+            expiry, _, key, entry = heapq.heappop(self.__expiries)
+            if self.__entries.get(key) is entry:
+                self.__remove(key)
+
+        # Forgotten and evicted entries leave stale items behind; rebuild the heap if they pile up
+        if len(self.__expiries) > 2 * len(self.__entries) + 64:
+            self.__expiries = [(entry[0], next(self.__counter), key, entry) for key, entry in self.__entries.items()]
+            heapq.heapify(self.__expiries)
+
+    def __shrink(self):
+        while self.__size > self.max_bytes and len(self.__entries) > 0:
+            self.__remove(next(iter(self.__entries)))
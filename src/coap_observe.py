@@ -0,0 +1,379 @@
+# coap_observe.py
+# Keeps track of clients observing files and folders, and pushes notifications when they change (RFC 7641)
+import os
+import time
+from threading import Thread, Condition
+from typing import Optional, Callable, Dict, Set, Tuple, Any
+
+from coap import *
+
+# The filesystem watcher is optional; without it, observed paths are polled
+try:
+    from watchdog.observers import Observer as _FileObserver
+    from watchdog.events import FileSystemEventHandler as _FileEventHandler
+except ImportError:
+    _FileObserver = None
+    _FileEventHandler = object
+
+
+# Observe sequence numbers are 24 bit (RFC 7641, section 4.4)
+OBSERVE_SEQ_MASK = 0xFFFFFF
+
+# Observe option values used in GET requests
+OBSERVE_REGISTER = 0
+OBSERVE_DEREGISTER = 1
+
+
+# Normalizes a path the same way the parser does, so paths from different sources can be compared
+def _normalize(path: str) -> str:
+    return os.path.normpath(os.path.normcase(path)).replace('\\', '/')
+
+
+# Cheap fingerprint of a file or folder; a folder's mtime changes whenever an entry is added or removed
+def _snapshot(path: str):
+    try:
+        stats = os.stat(path)
+        return stats.st_ino, stats.st_size, stats.st_mtime_ns
+    except OSError:
+        return None
+
+
+# A client observing a path
+# The request is kept, so notifications can be rendered the same way as the original reply
+class Subscription:
+    __slots__ = ('addr', 'token', 'path', 'request', 'render', 'seq', 'last_sent', 'last_con', 'msg_id')
+
+    def __init__(self, addr, token: bytes, path: str, request: Packet, render: Callable[[Packet], Packet]):
+        self.addr = addr
+        self.token = token
+        self.path = path
+        self.request = request
+        self.render = render  # Builds the current representation for the request
+        self.seq = 0
+        self.last_sent = 0.0
+        self.last_con = time.monotonic()
+        self.msg_id = None  # Message ID of the last notification (a RESET for it cancels the subscription)
+
+
+# Forwards watchdog events to the registry
+class _WatchHandler(_FileEventHandler):
+    def __init__(self, registry):
+        self.registry = registry
+
+    def on_any_event(self, event):
+        self.registry.changed(event.src_path)
+        if getattr(event, 'dest_path', None):
+            self.registry.changed(event.dest_path)
+
+
+# Registry of Observe subscriptions
+# Changes only mark subscriptions as dirty; a pacing thread sends at most one notification per subscription
+# every min_interval seconds, always with the latest state, so a file that changes constantly can't flood the socket
+class ObserveRegistry:
+    def __init__(self):
+        # Smallest delay between two notifications for the same subscription (seconds)
+        self.min_interval = 0.5
+
+        # Notifications are NON, except for one CON every con_interval seconds, which checks that the client is
+        # still there (if it isn't acknowledged, the subscription is dropped)
+        self.con_interval = 60.0
+
+        # How often observed paths are checked for out-of-band changes when no filesystem watcher is available
+        self.poll_interval = 2.0
+
+        self.max_subscriptions = 10000
+
+        # Folder watched by the filesystem watcher (if available)
+        self.root: Optional[str] = None
+
+        self.__server = None
+        self.__cond = Condition()
+        self.__thread: Optional[Thread] = None
+        self.__watcher = None
+        self.__stopping = False
+
+        self.__subscriptions: Dict[Tuple[Any, bytes], Subscription] = {}
+        self.__by_path: Dict[str, Set[Tuple[Any, bytes]]] = {}
+        self.__by_msgid: Dict[Tuple[Any, int], Tuple[Any, bytes]] = {}  # Last notification of each subscription
+        self.__snapshots: Dict[str, Any] = {}
+        self.__dirty: Set[Tuple[Any, bytes]] = set()
+        self.__next_poll = 0.0
+
+        self.stats: Dict[str, int] = {
+            'subscriptions': 0,
+            'notifications': 0,
+            'coalesced': 0
+        }
+
+        return
+
+    def __len__(self):
+        return len(self.__subscriptions)
+
+    # Uses the server for sending notifications, and for learning about lost or rejected ones
+    def attach(self, server):
+        self.__server = server
+
+        previous_lost = server.on_reply_lost
+
+        def on_reply_lost(packet):
+            self.__on_lost(packet)
+            if callable(previous_lost):
+                previous_lost(packet)
+
+        server.on_reply_lost = on_reply_lost
+        server.on_reset_received = self.__on_reset
+        return
+
+    def start(self):
+        with self.__cond:
+            if self.__thread is not None:
+                return
+
+            self.__stopping = False
+            self.__thread = Thread(target=self.__threadloop, name='CoAP observe', daemon=True)
+            self.__thread.start()
+
+        if _FileObserver is not None and self.root is not None:
+            try:
+                self.__watcher = _FileObserver()
+                self.__watcher.schedule(_WatchHandler(self), self.root, recursive=True)
+                self.__watcher.start()
+            except OSError as e:
+                print("Couldn't start filesystem watcher, polling instead: {0}".format(e))
+                self.__watcher = None
+
+        return
+
+    def stop(self):
+        with self.__cond:
+            if self.__thread is None:
+                return
+            self.__stopping = True
+            self.__cond.notify()
+            thread = self.__thread
+
+        thread.join()
+
+        if self.__watcher is not None:
+            self.__watcher.stop()
+            self.__watcher.join()
+            self.__watcher = None
+
+        with self.__cond:
+            self.__thread = None
+            self.__subscriptions.clear()
+            self.__by_path.clear()
+            self.__by_msgid.clear()
+            self.__snapshots.clear()
+            self.__dirty.clear()
+            self.stats['subscriptions'] = 0
+
+        return
+
+    # Handles the Observe option of a GET request that was answered with reply
+    # Registers (or refreshes) the subscription if the reply was successful, and adds the Observe option to it
+    def observe(self, request: Packet, path: str, reply: Packet, render: Callable[[Packet], Packet]) -> Packet:
+        observe = request.get_option(OPT_OBSERVE)
+        key = (request.addr, bytes(request.token))
+
+        # A GET without Observe=0 on the same token ends any previous subscription (RFC 7641, section 3.6)
+        if len(observe) == 0 or decode_uint(observe[0]) != OBSERVE_REGISTER or reply.code[0] != 2:
+            self.cancel(request.addr, request.token)
+            return reply
+
+        with self.__cond:
+            if key not in self.__subscriptions and len(self.__subscriptions) >= self.max_subscriptions:
+                return reply  # Reply without Observe - the client knows it wasn't registered
+
+            path = _normalize(path)
+
+            # Keep a copy of the request; notifications always start from the first block
+            copy = Packet(TYPE_NON, request.code, 0, bytes(request.token))
+            copy.options = {number: list(values) for number, values in request.options.items()
+                            if number not in (OPT_OBSERVE, OPT_BLOCK2)}
+            copy.payload = bytes(request.payload)
+            copy.addr = request.addr
+
+            previous = self.__subscriptions.get(key)
+            if previous is not None:
+                self.__remove(key)
+
+            subscription = Subscription(request.addr, bytes(request.token), path, copy, render)
+            if previous is not None:
+                subscription.seq = previous.seq
+
+            self.__subscriptions[key] = subscription
+            self.__by_path.setdefault(path, set()).add(key)
+            self.__snapshots.setdefault(path, _snapshot(path))
+            self.stats['subscriptions'] = len(self.__subscriptions)
+
+            subscription.seq = (subscription.seq + 1) & OBSERVE_SEQ_MASK
+            subscription.last_sent = time.monotonic()
+
+        reply.options[OPT_OBSERVE] = [encode_uint(subscription.seq)]
+
+        self.start()
+        return reply
+
+    # Removes a subscription
+    def cancel(self, addr, token: bytes):
+        with self.__cond:
+            self.__remove((addr, bytes(token)))
+
+    # Called when something at path was created, modified or deleted
+    # Notifies the observers of the path, of anything inside it, and of its parent folder (unless only the contents
+    # of a file changed, which doesn't affect the folder listing)
+    def changed(self, path: str, parent=True):
+        path = _normalize(path)
+        parent = os.path.dirname(path) if parent else None
+        prefix = path + '/'
+
+        with self.__cond:
+            if len(self.__subscriptions) == 0:
+                return
+
+            for observed, keys in self.__by_path.items():
+                if observed == path or observed == parent or observed.startswith(prefix):
+                    self.__mark(keys)
+                    self.__snapshots[observed] = _snapshot(observed)
+
+            if len(self.__dirty) > 0:
+                self.__cond.notify()
+
+        return
+
+    # Must be called with the lock held
+    def __mark(self, keys):
+        for key in keys:
+            if key in self.__dirty:
+                self.stats['coalesced'] += 1
+            else:
+                self.__dirty.add(key)
+
+    # Must be called with the lock held
+    def __remove(self, key):
+        subscription = self.__subscriptions.pop(key, None)
+        if subscription is None:
+            return
+
+        keys = self.__by_path.get(subscription.path)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.__by_path[subscription.path]
+                self.__snapshots.pop(subscription.path, None)
+
+        if subscription.msg_id is not None:
+            self.__by_msgid.pop((subscription.addr, subscription.msg_id), None)
+
+        self.__dirty.discard(key)
+        self.stats['subscriptions'] = len(self.__subscriptions)
+
+    # A CON notification that was never acknowledged means the client is gone
+    def __on_lost(self, packet: Packet):
+        if len(packet.get_option(OPT_OBSERVE)) > 0:
+            self.cancel(packet.addr, packet.token)
+
+    # A RESET in response to a notification means the client is no longer interested
+    def __on_reset(self, packet: Packet):
+        with self.__cond:
+            key = self.__by_msgid.get((packet.addr, packet.id))
+            if key is not None:
+                self.__remove(key)
+
+    # Pacing thread
+    # Sends notifications for dirty subscriptions once their min_interval has passed, and polls observed paths
+    def __threadloop(self):
+        while True:
+            with self.__cond:
+                if self.__stopping:
+                    return
+
+                now = time.monotonic()
+                due = []
+                wait_time = None
+
+                for key in list(self.__dirty):
+                    subscription = self.__subscriptions[key]
+                    ready = subscription.last_sent + self.min_interval
+                    if ready <= now:
+                        self.__dirty.discard(key)
+                        subscription.last_sent = now
+                        subscription.seq = (subscription.seq + 1) & OBSERVE_SEQ_MASK
+                        due.append(subscription)
+                    elif wait_time is None or ready - now < wait_time:
+                        wait_time = ready - now
+
+                polling = self.__watcher is None and len(self.__subscriptions) > 0
+                if polling:
+                    poll_wait = max(0.0, self.__next_poll - now)
+                    wait_time = poll_wait if wait_time is None else min(wait_time, poll_wait)
+
+                if len(due) == 0 and wait_time != 0.0:
+                    self.__cond.wait(wait_time)
+                    continue
+
+            for subscription in due:
+                self.__notify(subscription, now)
+
+            if polling and now >= self.__next_poll:
+                self.__next_poll = now + self.poll_interval
+                self.__poll()
+
+    # Looks for out-of-band changes by comparing the fingerprints of observed paths
+    def __poll(self):
+        with self.__cond:
+            paths = list(self.__by_path.keys())
+            snapshots = dict(self.__snapshots)
+
+        for path in paths:
+            if _snapshot(path) != snapshots.get(path):
+                self.changed(path)
+
+    # Sends the current representation of a path to one subscriber
+    def __notify(self, subscription: Subscription, now: float):
+        server = self.__server
+        if server is None:
+            return
+
+        try:
+            notification = subscription.render(subscription.request)
+        except Exception as e:
+            print('Failed to render notification for', subscription.path, ':', e)
+            return
+
+        if not isinstance(notification, Packet):
+            return
+
+        notification.type = TYPE_NON
+        if now - subscription.last_con >= self.con_interval:
+            notification.type = TYPE_CON
+            subscription.last_con = now
+
+        notification.id = server.generate_id()
+        notification.token = subscription.token
+        notification.addr = subscription.addr
+
+        key = (subscription.addr, subscription.token)
+        final = notification.code[0] != 2
+
+        with self.__cond:
+            if self.__subscriptions.get(key) is not subscription:
+                return  # Cancelled while the notification was being rendered
+
+            if subscription.msg_id is not None:
+                self.__by_msgid.pop((subscription.addr, subscription.msg_id), None)
+
+            # Error notifications (e.g. the path was deleted) end the subscription
+            if final:
+                self.__remove(key)
+            else:
+                notification.options[OPT_OBSERVE] = [encode_uint(subscription.seq)]
+                subscription.msg_id = notification.id
+                self.__by_msgid[(subscription.addr, notification.id)] = key
+
+            self.stats['notifications'] += 1
+
+        server.send(notification)
+        return
@@ -3,19 +3,224 @@ import os
 
 import shutil
 from coap import *
+from coap_observe import ObserveRegistry
+from coap_cache import ResponseCache
+from coap_tree import TreeIndex
+from coap_trigram import TrigramIndex, KIND_NAMES
+from coap_search import PatternCache, SearchFilter, SearchException, literal_hint, MATCH_SUBSTRING
+from coap_walk import walk
+from coap_cursor import CursorTable, take_page
+import coap_cbor
 import json
 import stat
+import struct
+import hashlib
+import tempfile
+import time
 from pathlib import Path
 from datetime import datetime, timezone
-from queue import LifoQueue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Event
+from typing import Optional
+
+
+# What a batch does when one of its commands fails
+BATCH_CONTINUE = 'continue'  # Run the remaining commands
+BATCH_STOP_ON_ERROR = 'stop_on_error'  # Skip the remaining commands
+BATCH_ALL_OR_NOTHING = 'all_or_nothing'  # Skip the remaining commands, and undo the ones that already ran
+
+BATCH_MODES = [BATCH_CONTINUE, BATCH_STOP_ON_ERROR, BATCH_ALL_OR_NOTHING]
+
+# Commands that can be undone by all-or-nothing batches
+_BATCH_UNDOABLE = ['create', 'delete', 'save', 'rename', 'move', 'details']
+
+# Fields that batch commands need besides "cmd" and "path", with their types
+# (checked before a batch runs, since a command that fails halfway through would leave the others applied)
+_BATCH_FIELDS = {
+    'create': {'type': str},
+    'delete': {},
+    'save': {'content': (str, bytes)},
+    'rename': {'name': str},
+    'move': {'new_path': str},
+    'details': {}
+}
+
+
+# Reads size bytes at the given offset, without moving through the whole file
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+
+    # Windows has no pread
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+# Builds an entity tag from the object's identity, size and modification time, without reading its contents
+# The variant (command name and payload format) is mixed in, since each one is a different representation of it
+# (ETags are at most 8 bytes, RFC 7252 section 5.10.6)
+def _make_etag(stats, variant: str):
+    key = struct.pack('!QQQ', stats.st_ino & 0xFFFFFFFFFFFFFFFF, stats.st_size, stats.st_mtime_ns)
+    return hashlib.blake2b(key + bytes(variant, 'utf-8'), digest_size=8).digest()
+
+
+# Reads the "key=value" Uri-Query options of a request
+def _query_params(packet):
+    params = {}
+    for value in packet.get_option(OPT_URI_QUERY):
+        key, _, param = bytes(value).decode('utf-8').partition('=')
+        params[key] = param
+    return params
+
+
+# Whether a request asks for a single page of a listing
+def _is_paged(p_data):
+    return 'limit' in p_data or 'cursor' in p_data
+
+
+# What a cursor lists: the command, the object, and the rest of the request (e.g. the search pattern and filters)
+def _cursor_owner(p_data, server_path):
+    fields = sorted((key, repr(value)) for key, value in p_data.items() if key not in ['limit', 'cursor'])
+    return server_path, tuple(fields)
+
+
+# State of a Block1 upload that is in progress
+# The blocks are written to a temporary file next to the target, so only one block is ever held in memory
+class _Upload:
+    __slots__ = ('target', 'temp_path', 'fd', 'received', 'last_active', 'lock')
+
+    def __init__(self, target, temp_path, fd):
+        self.target = target
+        self.temp_path = temp_path
+        self.fd = fd  # None once the file is closed
+        self.received = 0  # Bytes written so far
+        self.last_active = time.monotonic()
+        self.lock = Lock()  # Held while writing, so one slow upload doesn't hold up the others
+
+    # Closes and deletes the temporary file
+    def discard(self):
+        with self.lock:
+            if self.fd is not None:
+                try:
+                    os.close(self.fd)
+                except OSError:
+                    pass
+                self.fd = None
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+# A batch request being received block-wise; the body is kept in memory (it's at most max_batch_size bytes)
+class _BatchUpload:
+    __slots__ = ('target', 'data', 'last_active')
+
+    def __init__(self):
+        self.target = 'batch'
+        self.data = bytearray()
+        self.last_active = time.monotonic()
+
+    def discard(self):
+        self.data = bytearray()
 
 
 class Parser:
     def __init__(self):
         self.__jsondecoder = json.JSONDecoder()
         self.__jsonencoder = json.JSONEncoder()
+
+        # Payload formats understood by the parser; CBOR replies carry file contents as byte strings
+        self.payload_formats = [MEDIA_JSON, MEDIA_CBOR]
+
+        # Validated server paths, keyed by the path sent by the client (LRU, at most path_cache_size entries)
+        self.path_cache_size = 4096
+        self.__paths: OrderedDict = OrderedDict()
+        self.__paths_lock = Lock()
+
+        # If enabled, paths are also checked after resolving symbolic links, so links can't point outside the root
+        # The result is cached like the rest of the validation, so it only costs syscalls for new paths (and a link
+        # created by another program in place of an already validated path is only noticed once it leaves the cache)
+        self.__resolve_symlinks = False
+
+        # The root is resolved (against the current working directory) when server_root is set
+        self.__root = ''
+        self.__real_root = ''
         self.server_root = 'server_files/'
 
+        # Files are sent block-wise (RFC 7959), as raw bytes, if the client asks for it with a Block2 option, or if
+        # their JSON / CBOR reply wouldn't fit in one datagram (the server's maxdatasize)
+        # Block size exponent used when the server starts a block-wise transfer (2 ** (6 + 4) = 1024 bytes)
+        self.block_szx = BLOCK_MAX_SZX
+
+        # Uploads that don't receive a block for this long are abandoned, and their temporary file is deleted (seconds)
+        # A background thread started by register() looks for them every housekeeping_interval seconds
+        self.upload_timeout = COMM_EXCHANGE_LIFETIME
+        self.housekeeping_interval = 10.0
+        self.__housekeeping: Optional[Thread] = None
+        self.__stop_event = Event()
+
+        # Block1 uploads in progress, keyed by (endpoint, token)
+        # Handlers can run on several worker threads, so the table is guarded by a lock
+        self.__uploads = {}
+        self.__uploads_lock = Lock()
+
+        # Observe (RFC 7641) subscriptions; GET commands listed here can be observed
+        self.observers = ObserveRegistry()
+        self.observable_commands = ['open', 'details']
+
+        # Replies of these GET commands get an ETag; requests carrying the current ETag are answered with 2.03 Valid
+        self.validated_commands = ['open', 'details']
+
+        # Max-Age (seconds) sent with validated replies, so clients and proxies can cache them
+        self.max_age = 60
+
+        # Encoded 'open' payloads of files and folders, and the blocks of files sent block-wise
+        # (cache.max_bytes is the memory budget; blocks of files bigger than max_cached_file_size aren't cached,
+        # so downloading one huge file can't push every other entry out)
+        self.cache = ResponseCache()
+        self.max_cached_file_size = 4 * 1024 * 1024
+
+        # If enabled, register() indexes server_root in memory, and read-only commands are served from the index
+        # instead of the disk (the index is reconciled with the disk every tree.reconcile_interval seconds)
+        self.use_tree_index = False
+        self.tree: Optional[TreeIndex] = None
+
+        # If enabled, search is answered from a trigram index of object names instead of walking the disk
+        # The index is saved to name_index_file (if set) on close, and loaded from it by register()
+        # (changes made by other programs are picked up every names.reconcile_interval seconds)
+        self.use_name_index = False
+        self.name_index_file: Optional[str] = None
+        self.names: Optional[TrigramIndex] = None
+
+        # Compiled search patterns, and the time a single search may take (seconds)
+        self.patterns = PatternCache()
+        self.search_time_budget = 2.0
+
+        # Threads used to list folders in parallel during searches (0 walks on the handler's thread)
+        # Helps on network filesystems, where every listing waits for a round trip
+        self.search_workers = 0
+        self.__search_pool: Optional[ThreadPoolExecutor] = None
+
+        # Saved state of paginated listings (search results, folder contents), resumed with a "cursor"
+        # Pages hold at most max_page_size entries, whatever "limit" the client asks for, and their payload is kept
+        # under max_page_bytes (and the server's maxdatasize), so a page never needs IP fragmentation
+        self.cursors = CursorTable()
+        self.max_page_size = 1000
+        self.max_page_bytes = 1024
+        self.__max_datasize = 65527  # Taken from the server's config by register()
+
+        # Commands that can take a while (e.g. walking or deleting a whole tree)
+        # The server acknowledges them right away, and sends their reply later as a separate response
+        self.slow_commands = ['search', 'delete', 'batch']
+
+        # Commands that can be run inside a batch, and limits on batch requests
+        # (max_batch_size is the size of a batch body received block-wise, in bytes)
+        self.batch_commands = ['create', 'delete', 'save', 'rename', 'move', 'details']
+        self.max_batch_commands = 256
+        self.max_batch_size = 1024 * 1024
+
         self.get_commands = {
             'open': self.command_open,
             'details': self.command_details,
@@ -28,50 +233,272 @@ class Parser:
             'save': self.command_save,
             'rename': self.command_rename,
             'move': self.command_move,
+            'batch': self.command_batch,
         }
 
         return
 
+    # Registers the parser's method handlers on a server
+    def register(self, server):
+        server.packet_receivers[MSG_GET] = self.onget
+        server.packet_receivers[MSG_POST] = self.onpost
+        server.packet_receivers[MSG_PUT] = self.onput
+        server.packet_receivers[MSG_DELETE] = self.ondelete
+        server.packet_receivers[MSG_SEARCH] = self.onsearch
+        server.is_slow_request = self.is_slow
+        self.__max_datasize = server.config.get('maxdatasize', self.__max_datasize)
+
+        self.observers.root = self.__root_path()
+        self.observers.attach(server)
+
+        if self.use_tree_index and self.tree is None:
+            self.tree = TreeIndex(self.__root_path())
+            self.tree.start()
+
+        if self.search_workers > 0 and self.__search_pool is None:
+            self.__search_pool = ThreadPoolExecutor(self.search_workers, thread_name_prefix='CoAP search')
+
+        if self.use_name_index and self.names is None:
+            self.names = TrigramIndex(self.__root_path())
+            if self.name_index_file is None or not self.names.load(self.name_index_file):
+                self.names.build()
+            self.names.start()
+
+        if self.__housekeeping is None:
+            self.__stop_event.clear()
+            self.__housekeeping = Thread(target=self.__housekeeping_loop, name='CoAP parser housekeeping', daemon=True)
+            self.__housekeeping.start()
+
+    # Stops sending notifications, stops the tree index, and drops unfinished uploads
+    def close(self):
+        self.observers.stop()
+        self.cursors.clear()
+
+        if self.__housekeeping is not None:
+            self.__stop_event.set()
+            self.__housekeeping.join()
+            self.__housekeeping = None
+
+        if self.tree is not None:
+            self.tree.stop()
+
+        if self.__search_pool is not None:
+            self.__search_pool.shutdown()
+            self.__search_pool = None
+
+        if self.names is not None:
+            self.names.stop()
+
+        if self.names is not None and self.name_index_file is not None:
+            try:
+                self.names.save(self.name_index_file)
+            except OSError as e:
+                print("Couldn't save the search index:", e)
+
+        with self.__uploads_lock:
+            uploads = list(self.__uploads.values())
+            self.__uploads.clear()
+
+        for upload in uploads:
+            upload.discard()
+
+    # Tells the response cache, the indexes and the observers that the object at path was modified
+    # parent=False means only the contents of a file changed, which doesn't affect the folder that holds it
+    def __changed(self, path, parent=True):
+        if parent:
+            self.cache.invalidate_tree(path)
+            self.cache.invalidate(os.path.dirname(path))
+        else:
+            self.cache.invalidate(path)
+
+        if self.tree is not None:
+            self.tree.refresh(path)
+
+        # Names only change when objects are created, deleted or moved
+        if self.names is not None and parent:
+            self.names.refresh(path)
+
+        # Symlink checks are cached, so they are dropped when the server's own commands change the tree
+        # Symbolic links swapped in by other programs aren't seen here; they are only caught on a cache miss
+        if self.__resolve_symlinks and parent:
+            self.clear_path_cache()
+
+        self.observers.changed(path, parent)
+
+    # Metadata lookups used by read-only commands; served from the tree index when it's enabled
+    def __stat(self, path):
+        if self.tree is None:
+            return os.stat(path)
+
+        stats = self.tree.stat(path)
+        if stats is None:
+            raise FileNotFoundError(path)
+        return stats
+
+    # Metadata taken from the disk, for ETags and 2.03 Valid decisions
+    # With the tree index, the indexed entry is synced first if it differs (e.g. after a change made by another
+    # program), so the reply the command builds from the index matches the ETag it gets
+    def __fresh_stat(self, path):
+        stats = os.stat(path)
+        if self.tree is not None:
+            self.tree.sync(path, stats)
+        return stats
+
+    def __exists(self, path):
+        if self.tree is None:
+            return os.path.exists(path)
+        return self.tree.stat(path) is not None
+
+    def __listdir(self, path):
+        if self.tree is None:
+            return os.listdir(path)
+
+        contents = self.tree.listdir(path)
+        if contents is None:
+            raise NotADirectoryError(path)
+        return contents
+
+    # Iterator over the names of the objects in a folder (used for paginated listings)
+    # The names are read in one go, and the folder is closed before the first page is sent: the iterator is kept in
+    # a cursor between pages, and an open folder handle per cursor would let clients use up the process's file
+    # descriptors just by abandoning cursors
+    def __iterdir(self, path):
+        if self.tree is not None:
+            return iter(self.__listdir(path))
+
+        with os.scandir(path) as entries:
+            return iter([entry.name for entry in entries])
+
+    # Folder served to clients, relative to the current working directory
+    @property
+    def server_root(self) -> str:
+        return self.__server_root
+
+    @server_root.setter
+    def server_root(self, value: str):
+        root = os.path.join(os.getcwd(), value)
+        root = os.path.normcase(root)
+        root = os.path.normpath(root)
+        root = root.replace('\\', '/')
+
+        self.__server_root = value
+        self.__root = root
+        self.__real_root = os.path.realpath(root).replace('\\', '/')
+        self.clear_path_cache()
+
+    @property
+    def resolve_symlinks(self) -> bool:
+        return self.__resolve_symlinks
+
+    @resolve_symlinks.setter
+    def resolve_symlinks(self, value: bool):
+        self.__resolve_symlinks = value
+        self.clear_path_cache()
+
+    def clear_path_cache(self):
+        with self.__paths_lock:
+            self.__paths.clear()
+
     # Validates paths taken from client requests
     def __validate_path(self, path: str):
-        if path is None:
+        if not isinstance(path, str):
             return None
 
+        with self.__paths_lock:
+            if path in self.__paths:
+                self.__paths.move_to_end(path)
+                return self.__paths[path]
+
+        server_path = self.__resolve_path(path)
+
+        with self.__paths_lock:
+            self.__paths[path] = server_path
+            while len(self.__paths) > self.path_cache_size:
+                self.__paths.popitem(last=False)
+
+        return server_path
+
+    # Maps a client path to a path inside the root, or None if it points outside of it
+    def __resolve_path(self, path: str):
         if len(path) > 0 and path[0] == '/':
             path = path[1:]
 
-        root = os.path.join(os.getcwd(), self.server_root)
-        root = os.path.normcase(root)
-        root = os.path.normpath(root)
-        root = root.replace('\\', '/')
+        root = self.__root
 
         path = os.path.join(root, path)
         path = os.path.normcase(path)
         path = os.path.normpath(path)
         path = path.replace('\\', '/')
 
-        if not path.startswith(root):
+        if path != root and not path.startswith(root + '/'):
             return None
 
+        if self.__resolve_symlinks:
+            real_path = os.path.realpath(path).replace('\\', '/')
+            if real_path != self.__real_root and not real_path.startswith(self.__real_root + '/'):
+                return None
+
         return path
 
     def __root_path(self):
-        root = os.path.join(os.getcwd(), self.server_root)
-        root = os.path.normcase(root)
-        root = os.path.normpath(root)
-        root = root.replace('\\', '/')
+        return self.__root
+
+    # Payload formats accepted in requests (Content-Format) and used for replies (Accept)
+    # Requests without these options use JSON
+    def __check_formats(self, packet: Packet):
+        content_format = packet.get_option(OPT_CONTENT_FORMAT)
+        if len(content_format) > 0 and decode_uint(content_format[0]) not in self.payload_formats:
+            reply = Packet(get_reply_type(packet), MSG_UNSUPPORTED_CONTENT_FORMAT, packet.id, packet.token)
+            reply.payload = bytes('Request payloads must be JSON or CBOR', 'utf-8')
+            return reply
 
-        return root
+        accept = packet.get_option(OPT_ACCEPT)
+        if len(accept) > 0 and decode_uint(accept[0]) not in self.payload_formats:
+            reply = Packet(get_reply_type(packet), MSG_NOT_ACCEPTABLE, packet.id, packet.token)
+            reply.payload = bytes('Replies can only be sent as JSON or CBOR', 'utf-8')
+            return reply
 
-    def onget(self, packet: Packet):
+        return None
 
-        payload = packet.payload.decode('utf-8')
+    # Decodes a request payload according to its Content-Format; returns None if it can't be decoded
+    # The payload can be given separately (e.g. a body received block-wise)
+    def __decode(self, packet: Packet, payload=None):
+        if payload is None:
+            payload = packet.payload
 
-        data = None
         try:
-            data = self.__jsondecoder.decode(payload)
-        except json.JSONDecodeError:
-            pass
+            if self.__format(packet, OPT_CONTENT_FORMAT) == MEDIA_CBOR:
+                return coap_cbor.decode(payload)
+            return self.__jsondecoder.decode(bytes(payload).decode('utf-8'))
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    # Format of a request's payload (OPT_CONTENT_FORMAT) or of its reply (OPT_ACCEPT)
+    # Replies use the request's format, unless the client asked for another one
+    def __format(self, packet: Packet, option: int) -> int:
+        values = packet.get_option(option)
+        if len(values) > 0:
+            return decode_uint(values[0])
+        if option == OPT_ACCEPT:
+            return self.__format(packet, OPT_CONTENT_FORMAT)
+        return MEDIA_JSON
+
+    # Encodes a reply payload in the format the client expects
+    # JSON replies keep having no Content-Format option, like before CBOR was supported
+    def __set_payload(self, reply: Packet, packet: Packet, data):
+        if self.__format(packet, OPT_ACCEPT) == MEDIA_CBOR:
+            reply.payload = coap_cbor.encode(data)
+            reply.options[OPT_CONTENT_FORMAT] = [encode_uint(MEDIA_CBOR)]
+        else:
+            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+
+    def onget(self, packet: Packet):
+
+        error = self.__check_formats(packet)
+        if error is not None:
+            return error
+
+        data = self.__decode(packet)
 
         server_path = self.__validate_path(data['path'])
 
@@ -93,22 +520,59 @@ class Parser:
             return reply
 
         if data['cmd'] in self.get_commands:
-            return self.get_commands[data['cmd']](packet, data, server_path)
+            command = self.get_commands[data['cmd']]
+            reply = self.__run_get(command, packet, data, server_path)
+
+            # Notifications are rendered by running the same command again for the stored request
+            # (single pages can't be observed, since their cursor can only be used once)
+            if data['cmd'] in self.observable_commands and not _is_paged(data) and isinstance(reply, Packet):
+                reply = self.observers.observe(packet, server_path, reply,
+                                               lambda request: self.__run_get(command, request, data, server_path))
+            return reply
         else:  # Couldn't recognize command, send 4.00 Bad Request, with payload 'Client sent an invalid command'
             print('The request command was invalid')
             reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
             reply.payload = bytes('The request command was invalid', 'utf-8')
             return reply
 
+    # Runs a GET command, adding ETag / Max-Age to its reply
+    # If the client already has the current representation (one of its ETags matches), the command isn't run at all
+    def __run_get(self, command, packet, data, server_path):
+        if data['cmd'] not in self.validated_commands or _is_paged(data):
+            return command(packet, data, server_path)
+
+        # The ETag is computed before the command reads the object, so a concurrent change can only make it
+        # stale (causing one extra transfer later), never make new contents look unchanged
+        try:
+            # Block-wise replies are raw bytes, whatever the payload format
+            variant = '{0}/{1}'.format(data['cmd'], self.__format(packet, OPT_ACCEPT))
+            if len(packet.get_option(OPT_BLOCK2)) > 0:
+                variant += '/block'
+            etag = _make_etag(self.__fresh_stat(server_path), variant)
+        except OSError:
+            return command(packet, data, server_path)
+
+        if etag in packet.get_option(OPT_ETAG):
+            reply = Packet(get_reply_type(packet), MSG_VALID, packet.id, packet.token)
+        else:
+            reply = command(packet, data, server_path)
+            if not isinstance(reply, Packet) or reply.code[0] != 2:
+                return reply
+
+        reply.options[OPT_ETAG] = [etag]
+        reply.options[OPT_MAX_AGE] = [encode_uint(self.max_age)]
+        return reply
+
     def onpost(self, packet: Packet):
+        # Block-wise uploads carry the command in Uri-Query options, and raw file contents as payload
+        if len(packet.get_option(OPT_BLOCK1)) > 0:
+            return self.__save_block(packet)
 
-        payload = packet.payload.decode('utf-8')
+        error = self.__check_formats(packet)
+        if error is not None:
+            return error
 
-        data = None
-        try:
-            data = self.__jsondecoder.decode(payload)
-        except json.JSONDecodeError:
-            pass
+        data = self.__decode(packet)
 
         server_path = self.__validate_path(data['path'])
 
@@ -137,6 +601,31 @@ class Parser:
             reply.payload = bytes('The request command was invalid', 'utf-8')
             return reply
 
+    # Tells the server whether a request runs one of the slow_commands, so it can be acknowledged right away
+    # This runs on the network thread, so the payload isn't decoded: search requests are recognized by their
+    # method, and other commands by a "cmd" Uri-Query option (which clients can add to requests that may take long)
+    # Requests that aren't recognized here are still acknowledged by the server once their handler has run for
+    # longer than its 'ack_delay'
+    def is_slow(self, packet: Packet) -> bool:
+        if packet.code == MSG_SEARCH:
+            return 'search' in self.slow_commands
+
+        try:
+            cmd = _query_params(packet).get('cmd')
+        except UnicodeDecodeError:
+            return False
+
+        if cmd not in self.slow_commands:
+            return False
+
+        # Only the last block of a block-wise request runs the command; the others are quick to handle
+        block1 = packet.get_option(OPT_BLOCK1)
+        if len(block1) > 0:
+            num, more, szx = decode_block(block1[0])
+            return not more
+
+        return True
+
     def onput(self, packet: Packet):
         # TODO: Implement this properly
         reply = make_not_implemented(packet.id, packet.token)
@@ -150,13 +639,11 @@ class Parser:
         return reply
 
     def onsearch(self, packet: Packet):
-        payload = packet.payload.decode('utf-8')
+        error = self.__check_formats(packet)
+        if error is not None:
+            return error
 
-        data = None
-        try:
-            data = self.__jsondecoder.decode(payload)
-        except json.JSONDecodeError:
-            pass
+        data = self.__decode(packet)
 
         server_path = self.__validate_path(data['path'])
 
@@ -189,16 +676,17 @@ class Parser:
                     data = {'client_cmd': 'create', 'status': 'created'}
 
                     reply = Packet(get_reply_type(packet), MSG_CREATED, packet.id, packet.token)
-                    reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+                    self.__set_payload(reply, packet, data)
 
                     print('Created file', server_path)
+                    self.__changed(server_path)
                     return reply
 
             except FileExistsError:
                 data = {'client_cmd': 'create', 'status': 'exists'}
 
                 reply = Packet(get_reply_type(packet), MSG_CREATED, packet.id, packet.token)
-                reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+                self.__set_payload(reply, packet, data)
 
                 print('File already exists', server_path)
                 return reply
@@ -217,16 +705,17 @@ class Parser:
                 data = {'client_cmd': 'create', 'status': 'created'}
 
                 reply = Packet(get_reply_type(packet), MSG_CREATED, packet.id, packet.token)
-                reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+                self.__set_payload(reply, packet, data)
 
                 print('Created folder', server_path)
+                self.__changed(server_path)
                 return reply
 
             except FileExistsError:  # in cazul in care deja exista, ma duce in eroarea FileExistsError
                 data = {'client_cmd': 'create', 'status': 'existed'}
 
                 reply = Packet(get_reply_type(packet), MSG_CREATED, packet.id, packet.token)
-                reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+                self.__set_payload(reply, packet, data)
 
                 print('Folder exists', server_path)
                 return reply
@@ -261,9 +750,10 @@ class Parser:
                 return reply
 
             print('Deleted object ', server_path)
+            self.__changed(server_path)
 
             reply = Packet(get_reply_type(packet), MSG_DELETED, packet.id, packet.token)
-            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+            self.__set_payload(reply, packet, data)
             return reply
 
         except OSError:  # tratare eroare ce poate aparea la remove
@@ -273,42 +763,177 @@ class Parser:
             print('Encountered a problem when deleting object', server_path)
             return reply
 
+    # Takes one page of a listing, for requests with "limit" and / or "cursor"
+    # entries is called to start the listing if the request has no cursor (a cursor resumes the saved one)
+    # Returns (items, next cursor or None, error reply or None)
+    def __paginate(self, packet, p_data, server_path, entries, deadline=None):
+        limit = p_data.get('limit', self.max_page_size)
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0:
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('"limit" must be a positive integer', 'utf-8')
+
+            print('Invalid page limit', limit)
+            return None, None, reply
+
+        owner = _cursor_owner(p_data, server_path)
+        cursor = p_data.get('cursor')
+
+        if cursor is None:
+            iterator = iter(entries())
+        else:
+            iterator = self.cursors.take(cursor, owner) if isinstance(cursor, str) else None
+            if iterator is None:
+                reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+                reply.payload = bytes('The cursor is invalid or has expired', 'utf-8')
+
+                print('Invalid cursor for', server_path)
+                return None, None, reply
+
+        # The rest of the reply (command, path, cursor, metadata) gets a fixed allowance besides the entries
+        max_bytes = min(self.max_page_bytes, self.__max_datasize) - 256 - len(str(p_data.get('path')).encode('utf-8'))
+
+        if self.__format(packet, OPT_ACCEPT) == MEDIA_CBOR:
+            size = lambda item: len(coap_cbor.encode(item))
+        else:
+            size = lambda item: len(self.__jsonencoder.encode(item)) + 2  # With the ', ' separator
+
+        items, rest = take_page(iterator, min(limit, self.max_page_size), deadline, max_bytes, size)
+        next_cursor = self.cursors.create(owner, rest) if rest is not None else None
+        return items, next_cursor, None
+
     def command_open(self, packet, p_data, server_path):
-        if not os.path.exists(server_path):
+        # A single stat tells whether the object exists, what it is, and whether the cached reply is still valid
+        # File contents are read from the disk, so with the tree index their replies are checked against the disk
+        # too (the index can lag behind changes made by other programs); folder listings come from the index
+        try:
+            stats = self.__stat(server_path)
+            if self.tree is not None and stat.S_ISREG(stats.st_mode):
+                stats = os.stat(server_path)
+        except OSError:
             reply = Packet(get_reply_type(packet), MSG_NOT_FOUND, packet.id, packet.token)
             reply.payload = bytes('The given path does not exist', 'utf-8')
 
             print('Path does not exist')
             return reply
 
-        if not ( os.path.isfile(server_path) or os.path.isdir(server_path) ):
+        if not ( stat.S_ISREG(stats.st_mode) or stat.S_ISDIR(stats.st_mode) ):
             reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
             reply.payload = bytes('The given path is an unknown object', 'utf-8')
             print('Path is not a file or fordel')
             return reply
 
+        block2 = packet.get_option(OPT_BLOCK2)
+        if stat.S_ISREG(stats.st_mode) and (len(block2) > 0 or stats.st_size > self.__max_payload()):
+            return self.__open_block(packet, server_path, block2, stats)
+
+        reply = Packet(get_reply_type(packet), MSG_CONTENT, packet.id, packet.token)
+
+        if stat.S_ISDIR(stats.st_mode) and _is_paged(p_data):
+            contents, next_cursor, error = self.__paginate(packet, p_data, server_path,
+                                                           lambda: self.__iterdir(server_path))
+            if error is not None:
+                return error
+
+            data = {'client_cmd': 'open', 'response': contents, 'type': 'folder'}
+            if next_cursor is not None:
+                data['next_cursor'] = next_cursor
+
+            self.__set_payload(reply, packet, data)
+            return reply
+
+        media = self.__format(packet, OPT_ACCEPT)
+        payload = self.cache.get(server_path, stats, media)
+        if payload is not None:
+            reply.payload = payload
+            if media == MEDIA_CBOR:
+                reply.options[OPT_CONTENT_FORMAT] = [encode_uint(MEDIA_CBOR)]
+            return reply
+
         try:
-            if os.path.isfile(server_path):
-                with open(server_path, 'r') as file:
-                    contents = file.read(65527)
+            if stat.S_ISREG(stats.st_mode):
+                # CBOR carries file contents as a byte string, without decoding or escaping them
+                # (a file that grew past the limit since the stat is cut there, and sent block-wise below)
+                with open(server_path, 'rb' if media == MEDIA_CBOR else 'r') as file:
+                    contents = file.read(self.__max_payload() + 1)
                     data = {'client_cmd': 'open', 'response': contents, 'type': 'file'}
-
-                    reply = Packet(get_reply_type(packet), MSG_CONTENT, packet.id, packet.token)
-                    reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
-                    return reply
-            elif os.path.isdir(server_path):
-                contents = os.listdir(server_path)
+            else:
+                contents = self.__listdir(server_path)
                 data = {'client_cmd': 'open', 'response': contents, 'type': 'folder'}
 
-                reply = Packet(get_reply_type(packet), MSG_CONTENT, packet.id, packet.token)
-                reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
-                return reply
+            self.__set_payload(reply, packet, data)
+
+            # Escaping can make a JSON reply bigger than the file
+            if stat.S_ISREG(stats.st_mode) and len(reply.payload) > self.__max_payload():
+                return self.__open_block(packet, server_path, block2, stats)
+
+            self.cache.put(server_path, stats, reply.payload, media)
+            return reply
 
         except OSError:
             reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
-            reply.payload = bytes('Failed to open file')
+            reply.payload = bytes('Failed to open file', 'utf-8')
 
             print('Encountered a problem while opening file', server_path)
+            return reply
+
+    # Largest reply payload that fits in one datagram, leaving room for the header, token and options
+    def __max_payload(self):
+        return self.__max_datasize - 128
+
+    # Sends one block of a file (RFC 7959 Block2)
+    # Blocks are read straight from the file at their offset, so large files are never loaded in memory
+    # Blocks of files up to max_cached_file_size are kept in the response cache, validated by stats (taken from the
+    # disk by the caller)
+    def __open_block(self, packet, server_path, block2, stats):
+        num = 0
+        szx = self.block_szx
+
+        if len(block2) > 0:
+            num, _, requested_szx = decode_block(block2[0])
+
+            if requested_szx > BLOCK_MAX_SZX:
+                reply = Packet(get_reply_type(packet), MSG_BAD_OPTION, packet.id, packet.token)
+                reply.payload = bytes('Invalid block size', 'utf-8')
+                return reply
+
+            if requested_szx <= szx:
+                szx = requested_szx
+            else:
+                # Client asked for bigger blocks than we send - keep our size, and convert the block number
+                num = num * block_size(requested_szx) // block_size(szx)
+
+        size = block_size(szx)
+        offset = num * size
+        variant = (MEDIA_OCTET_STREAM, szx, num)
+
+        data = self.cache.get(server_path, stats, variant) if stats.st_size <= self.max_cached_file_size else None
+        if data is not None:
+            total = stats.st_size
+        else:
+            fd = os.open(server_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                stats = os.fstat(fd)
+                total = stats.st_size
+
+                if offset > total or (offset == total and total > 0):
+                    reply = Packet(get_reply_type(packet), MSG_BAD_OPTION, packet.id, packet.token)
+                    reply.payload = bytes('Block number is out of range', 'utf-8')
+                    return reply
+
+                data = _pread(fd, size, offset)
+            finally:
+                os.close(fd)
+
+            if total <= self.max_cached_file_size:
+                self.cache.put(server_path, stats, data, variant)
+
+        reply = Packet(get_reply_type(packet), MSG_CONTENT, packet.id, packet.token)
+        reply.options[OPT_CONTENT_FORMAT] = [encode_uint(MEDIA_OCTET_STREAM)]
+        reply.options[OPT_BLOCK2] = [encode_block(num, offset + len(data) < total, szx)]
+        if num == 0:
+            reply.options[OPT_SIZE2] = [encode_uint(total)]
+        reply.payload = data
+        return reply
 
     def command_save(self, packet, p_data, server_path):
         if not p_data['content']:
@@ -332,13 +957,18 @@ class Parser:
             print('Path is not a file')
             return reply
         try:
-            with open(server_path, 'w') as file:
-                file.write(p_data['content'])
+            # CBOR requests can send the contents as a byte string
+            content = p_data['content']
+            with open(server_path, 'wb' if isinstance(content, bytes) else 'w') as file:
+                file.write(content)
                 data = {'client_cmd': 'open', 'status': 'modified'}
 
-                reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
-                reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
-                return reply
+            # Observers are notified once the file is closed, so they never see a partial write
+            self.__changed(server_path, parent=False)
+
+            reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
+            self.__set_payload(reply, packet, data)
+            return reply
 
         except OSError:
             reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
@@ -346,6 +976,222 @@ class Parser:
 
             print('Encountered a problem while opening file', server_path)
 
+    # Receives one block of a Block1 upload (RFC 7959)
+    # Intermediate blocks are answered with 2.31 Continue; the last one replaces the target file atomically
+    def __save_block(self, packet):
+        params = _query_params(packet)
+        num, more, szx = decode_block(packet.get_option(OPT_BLOCK1)[0])
+        payload = packet.payload
+
+        if params.get('cmd') == 'batch':
+            return self.__batch_block(packet, num, more, szx)
+
+        if params.get('cmd') != 'save' or 'path' not in params:
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('Block-wise uploads need the "cmd=save" and "path" query options', 'utf-8')
+            return reply
+
+        # Every block but the last has exactly the block size, and the last one can't be larger
+        if szx > BLOCK_MAX_SZX or len(payload) > block_size(szx) or (more and len(payload) != block_size(szx)):
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('Invalid block size', 'utf-8')
+            return reply
+
+        server_path = self.__validate_path(params['path'])
+
+        if server_path is None:
+            print('Received an invalid path.')
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('The path requested is invalid, or access has been denied by the server.', 'utf-8')
+            return reply
+
+        key = (packet.addr, bytes(packet.token))
+        offset = num * block_size(szx)
+
+        # The first block (re)starts the upload
+        if num == 0:
+            if not os.path.isfile(server_path):
+                reply = Packet(get_reply_type(packet), MSG_NOT_FOUND, packet.id, packet.token)
+                reply.payload = bytes('The given path does not exist, or is not a file', 'utf-8')
+
+                print('Upload path does not exist or is not a file')
+                return reply
+
+            try:
+                fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(server_path) + '.',
+                                                 suffix='.upload', dir=os.path.dirname(server_path))
+            except OSError:
+                reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+                reply.payload = bytes('Failed to start upload', 'utf-8')
+
+                print('Encountered a problem while starting an upload for', server_path)
+                return reply
+
+            upload = _Upload(server_path, temp_path, fd)
+
+            with self.__uploads_lock:
+                replaced = self.__uploads.get(key)
+                self.__uploads[key] = upload
+
+            if replaced is not None:
+                replaced.discard()
+        else:
+            with self.__uploads_lock:
+                upload = self.__uploads.get(key)
+
+        if upload is None or not isinstance(upload, _Upload) or upload.target != server_path:
+            reply = Packet(get_reply_type(packet), MSG_REQUEST_ENTITY_INCOMPLETE, packet.id, packet.token)
+            reply.payload = bytes('Block was received out of order, or the upload has expired', 'utf-8')
+            return reply
+
+        # The file is only written under the upload's own lock; the uploads table lock is never held during I/O
+        failed = False
+        with upload.lock:
+            # A closed file means the upload was finished, restarted or discarded in the meantime
+            if upload.fd is None or offset > upload.received:
+                reply = Packet(get_reply_type(packet), MSG_REQUEST_ENTITY_INCOMPLETE, packet.id, packet.token)
+                reply.payload = bytes('Block was received out of order, or the upload has expired', 'utf-8')
+                return reply
+
+            upload.last_active = time.monotonic()
+
+            # A block we already have (retransmitted under a new message ID) is acknowledged again
+            if offset + len(payload) <= upload.received:
+                reply = Packet(get_reply_type(packet), MSG_CONTINUE, packet.id, packet.token)
+                reply.options[OPT_BLOCK1] = [encode_block(num, True, szx)]
+                return reply
+
+            try:
+                os.lseek(upload.fd, offset, os.SEEK_SET)
+                os.write(upload.fd, payload)
+                upload.received = offset + len(payload)
+
+                if more:
+                    reply = Packet(get_reply_type(packet), MSG_CONTINUE, packet.id, packet.token)
+                    reply.options[OPT_BLOCK1] = [encode_block(num, True, szx)]
+                    return reply
+
+                os.fsync(upload.fd)
+                os.close(upload.fd)
+                upload.fd = None
+                os.chmod(upload.temp_path, stat.S_IMODE(os.stat(server_path).st_mode))
+                os.replace(upload.temp_path, server_path)
+
+            except OSError:
+                failed = True
+
+        with self.__uploads_lock:
+            if self.__uploads.get(key) is upload:
+                del self.__uploads[key]
+
+        if failed:
+            upload.discard()
+
+            reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('Failed to write file', 'utf-8')
+
+            print('Encountered a problem while uploading file', server_path)
+            return reply
+
+        print('Uploaded', upload.received, 'bytes to', server_path)
+        self.__changed(server_path, parent=False)
+
+        data = {'client_cmd': 'save', 'status': 'modified'}
+
+        reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
+        reply.options[OPT_BLOCK1] = [encode_block(num, False, szx)]
+        self.__set_payload(reply, packet, data)
+        return reply
+
+    # Receives one block of a batch request (Uri-Query "cmd=batch"); the batch runs once the last block arrives
+    def __batch_block(self, packet, num, more, szx):
+        payload = packet.payload
+
+        # Every block but the last has exactly the block size, and the last one can't be larger
+        if szx > BLOCK_MAX_SZX or len(payload) > block_size(szx) or (more and len(payload) != block_size(szx)):
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('Invalid block size', 'utf-8')
+            return reply
+
+        # Checked on every block (the first one is stored, the last one decides how the body is decoded and replied to)
+        error = self.__check_formats(packet)
+        if error is not None:
+            return error
+
+        key = (packet.addr, bytes(packet.token))
+        offset = num * block_size(szx)
+
+        with self.__uploads_lock:
+            upload = self.__uploads.get(key)
+
+            # The first block (re)starts the batch
+            if num == 0:
+                if upload is not None:
+                    upload.discard()
+                upload = _BatchUpload()
+                self.__uploads[key] = upload
+
+            if upload is None or not isinstance(upload, _BatchUpload) or offset > len(upload.data):
+                reply = Packet(get_reply_type(packet), MSG_REQUEST_ENTITY_INCOMPLETE, packet.id, packet.token)
+                reply.payload = bytes('Block was received out of order, or the upload has expired', 'utf-8')
+                return reply
+
+            upload.last_active = time.monotonic()
+
+            if more and offset + len(payload) <= len(upload.data):
+                reply = Packet(get_reply_type(packet), MSG_CONTINUE, packet.id, packet.token)
+                reply.options[OPT_BLOCK1] = [encode_block(num, True, szx)]
+                return reply
+
+            del upload.data[offset:]
+            upload.data += payload
+
+            if len(upload.data) > self.max_batch_size:
+                del self.__uploads[key]
+
+                reply = Packet(get_reply_type(packet), MSG_REQUEST_ENTITY_TOO_LARGE, packet.id, packet.token)
+                reply.options[OPT_SIZE1] = [encode_uint(self.max_batch_size)]
+                reply.payload = bytes('The batch is too large', 'utf-8')
+                return reply
+
+            if more:
+                reply = Packet(get_reply_type(packet), MSG_CONTINUE, packet.id, packet.token)
+                reply.options[OPT_BLOCK1] = [encode_block(num, True, szx)]
+                return reply
+
+            del self.__uploads[key]
+
+        data = self.__decode(packet, upload.data)
+
+        if not isinstance(data, dict) or data.get('cmd') != 'batch':
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('Received a malformatted request', 'utf-8')
+            return reply
+
+        reply = self.command_batch(packet, data, self.__root_path())
+        reply.options[OPT_BLOCK1] = [encode_block(num, False, szx)]
+        return reply
+
+    # Deletes the temporary files of uploads that haven't received a block in a while
+    def expire_uploads(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        with self.__uploads_lock:
+            expired = [key for key, upload in self.__uploads.items() if now - upload.last_active > self.upload_timeout]
+            expired = [self.__uploads.pop(key) for key in expired]
+
+        # Discarded outside the table lock (an upload's file may be busy)
+        for upload in expired:
+            upload.discard()
+            print('Upload to', upload.target, 'was abandoned')
+
+        return len(expired)
+
+    def __housekeeping_loop(self):
+        while not self.__stop_event.wait(self.housekeeping_interval):
+            self.expire_uploads()
+
     def command_rename(self, packet, p_data, server_path: str):
         if not p_data['name'] or '/' in p_data['name']:
             reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
@@ -375,9 +1221,11 @@ class Parser:
             data = {'client_cmd': 'rename', 'status': 'renamed'}
 
             reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
-            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+            self.__set_payload(reply, packet, data)
 
             print('Renamed object', server_path, 'to', new_path)
+            self.__changed(server_path)
+            self.__changed(new_path)
             return reply
         except OSError:
             reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
@@ -414,9 +1262,11 @@ class Parser:
             data = {'client_cmd': 'move', 'status': 'moved'}
 
             reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
-            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+            self.__set_payload(reply, packet, data)
 
             print('Moved object', server_path, 'to', new_path)
+            self.__changed(server_path)
+            self.__changed(new_path)
             return reply
         except OSError:
             reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
@@ -424,8 +1274,198 @@ class Parser:
 
             print('Failed to move object', server_path, 'to', new_path)
 
+    # Runs a list of commands in order, and returns all of their results in one reply
+    # Each command has the same fields as when it's sent on its own; "mode" (one of BATCH_MODES) decides what
+    # happens when a command fails (gets a reply other than 2.xx)
+    # All-or-nothing batches back up what each command changes, and restore it if a command fails; this isn't
+    # isolated from other requests that change the same objects in the meantime
+    def command_batch(self, packet, p_data, server_path):
+        mode = p_data.get('mode', BATCH_CONTINUE)
+        commands = p_data.get('commands')
+
+        if mode not in BATCH_MODES:
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('Unknown batch mode, expected one of: {0}'.format(', '.join(BATCH_MODES)), 'utf-8')
+            return reply
+
+        if not isinstance(commands, list) or len(commands) == 0 or len(commands) > self.max_batch_commands:
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes('A batch needs a list of 1 to {0} commands'.format(self.max_batch_commands), 'utf-8')
+            return reply
+
+        # Every command is checked before any of them runs
+        paths = []
+        for i, item in enumerate(commands):
+            path, error = self.__batch_check(item, mode)
+            if error is not None:
+                reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+                reply.payload = bytes('Command {0} of the batch is invalid: {1}'.format(i, error), 'utf-8')
+
+                print('Received an invalid batch command at index', i)
+                return reply
+            paths.append(path)
+
+        staging = None
+        undo = []
+        results = []
+        status = 'completed'
+
+        try:
+            if mode == BATCH_ALL_OR_NOTHING:
+                staging = self.__make_staging()
+
+            for item, path in zip(commands, paths):
+                if staging is not None:
+                    undo.append(self.__batch_backup(item, path, staging, len(undo)))
+
+                reply = self.__batch_run(packet, item, path)
+                results.append(self.__batch_result(item, reply))
+
+                if isinstance(reply, Packet) and reply.code[0] == 2:
+                    continue
+
+                if mode == BATCH_STOP_ON_ERROR:
+                    status = 'stopped'
+                    break
+
+                if mode == BATCH_ALL_OR_NOTHING:
+                    # The failed command is undone too, in case it changed something before failing
+                    status = 'rolled_back'
+                    self.__batch_undo(undo)
+                    break
+
+        except OSError:
+            if staging is not None:
+                self.__batch_undo(undo)
+
+            reply = Packet(get_reply_type(packet), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('Failed to run the batch', 'utf-8')
+
+            print('Encountered a problem while running a batch')
+            return reply
+
+        finally:
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+
+        print('Ran a batch of', len(results), 'commands, status:', status)
+
+        data = {'client_cmd': 'batch', 'status': status, 'results': results}
+
+        reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
+        self.__set_payload(reply, packet, data)
+        return reply
+
+    # Checks a batch command; returns (server path, None), or (None, error message) if the command is invalid
+    def __batch_check(self, item, mode):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            return None, 'a command needs a "path"'
+
+        cmd = item.get('cmd')
+        if cmd == 'batch' or cmd not in self.batch_commands or cmd not in _BATCH_FIELDS:
+            return None, 'unknown command'
+
+        if mode == BATCH_ALL_OR_NOTHING and cmd not in _BATCH_UNDOABLE:
+            return None, '"{0}" can\'t be undone'.format(cmd)
+
+        for field, field_type in _BATCH_FIELDS[cmd].items():
+            if not isinstance(item.get(field), field_type):
+                return None, '"{0}" needs the "{1}" field'.format(cmd, field)
+
+        path = self.__validate_path(item['path'])
+        if path is None and item['path'] == '/' and cmd == 'details':
+            path = self.__root_path()
+        if path is None:
+            return None, 'the path is invalid, or access has been denied by the server'
+        return path, None
+
+    # Runs a batch command with the handler it has when sent on its own
+    # Errors the handlers don't turn into replies themselves (OSError) are left to command_batch
+    def __batch_run(self, packet, item, server_path):
+        command = self.post_commands.get(item['cmd']) or self.get_commands.get(item['cmd'])
+        return command(packet, item, server_path)
+
+    def __batch_result(self, item, reply):
+        if not isinstance(reply, Packet):
+            return {'cmd': item['cmd'], 'path': item['path'], 'code': '5.00',
+                    'response': 'An unknown internal error happened!'}
+
+        if reply.code[0] == 2:
+            response = self.__decode(reply)
+        else:
+            response = bytes(reply.payload).decode('utf-8', errors='replace')
+
+        return {'cmd': item['cmd'], 'path': item['path'], 'code': '{0}.{1:02d}'.format(*reply.code),
+                'response': response}
+
+    # Temporary folder for the backups of an all-or-nothing batch
+    # It's created next to the root if possible, so backups can be moved back without copying them again
+    def __make_staging(self):
+        try:
+            return tempfile.mkdtemp(prefix='.batch-', dir=os.path.dirname(self.__root_path()))
+        except OSError:
+            return tempfile.mkdtemp(prefix='coap-batch-')
+
+    # Saves what a command is about to change, and returns how to restore it:
+    # ('restore', path, backup) puts the backup (or nothing, if it's None) back at path,
+    # ('move', new_path, path) moves an object back to where it was
+    # Both only look at the current state, so they're safe to run even if the command didn't change anything
+    def __batch_backup(self, item, server_path, staging, index):
+        cmd = item['cmd']
+
+        if cmd == 'rename':
+            name = item.get('name')
+            if not isinstance(name, str) or name == '' or '/' in name:
+                return None
+            return 'move', server_path[:(server_path.rindex('/') + 1)] + name, server_path
+
+        if cmd == 'move':
+            new_path = self.__validate_path(item.get('new_path'))
+            return ('move', new_path, server_path) if new_path is not None else None
+
+        if cmd == 'create':
+            return None if os.path.lexists(server_path) else ('restore', server_path, None)
+
+        if cmd in ['save', 'delete']:
+            if not os.path.lexists(server_path):
+                return None
+
+            backup = os.path.join(staging, str(index))
+            if os.path.isdir(server_path) and not os.path.islink(server_path):
+                shutil.copytree(server_path, backup, symlinks=True)
+            else:
+                shutil.copy2(server_path, backup, follow_symlinks=False)
+            return 'restore', server_path, backup
+
+        return None
+
+    # Restores the backups of a batch, newest first
+    def __batch_undo(self, undo):
+        for step in reversed(undo):
+            if step is None:
+                continue
+
+            try:
+                if step[0] == 'move':
+                    _, new_path, path = step
+                    if os.path.lexists(new_path) and not os.path.lexists(path):
+                        shutil.move(new_path, path)
+                        self.__changed(new_path)
+                        self.__changed(path)
+                else:
+                    _, path, backup = step
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    elif os.path.lexists(path):
+                        os.remove(path)
+                    if backup is not None:
+                        shutil.move(backup, path)
+                    self.__changed(path)
+            except OSError as e:
+                print('Failed to undo a batch command:', e)
+
     def command_details(self, packet, p_data, server_path):
-        if not os.path.exists(server_path):
+        if not self.__exists(server_path):
             reply = Packet(get_reply_type(packet), MSG_NOT_FOUND, packet.id, packet.token)
             reply.payload = bytes('Path was not found', 'utf-8')
 
@@ -435,12 +1475,23 @@ class Parser:
         try:
             data = {'client_cmd': 'details', 'path': p_data['path']}
 
-            stats = os.stat(server_path)
+            stats = self.__stat(server_path)
 
             if stat.S_ISDIR(stats.st_mode):
 
                 data['type'] = 'folder'
-                data['dir_contents'] = os.listdir(server_path)
+
+                if _is_paged(p_data):
+                    contents, next_cursor, error = self.__paginate(packet, p_data, server_path,
+                                                                   lambda: self.__iterdir(server_path))
+                    if error is not None:
+                        return error
+
+                    data['dir_contents'] = contents
+                    if next_cursor is not None:
+                        data['next_cursor'] = next_cursor
+                else:
+                    data['dir_contents'] = self.__listdir(server_path)
                 # data['last_modified'] = datetime.fromtimestamp(stats.st_mtime, tz=timezone.utc)
                 data['last_accessed'] = stats.st_atime
                 data['last_modified'] = stats.st_mtime
@@ -456,7 +1507,7 @@ class Parser:
                 data['type'] = 'unknown'
 
             reply = Packet(get_reply_type(packet), MSG_CHANGED, packet.id, packet.token)
-            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+            self.__set_payload(reply, packet, data)
 
             print('Sent data about object', server_path)
             return reply
@@ -466,21 +1517,105 @@ class Parser:
 
             print('Failed to send data about object', server_path)
 
+    # Yields the results of a search from the trigram index; only entries that contain the query's literal text
+    # are checked against the pattern (here, not while the index is locked)
+    # None is yielded every 256 candidates, so the caller can stop when the search runs out of time
+    def __search_index(self, server_path, matcher, literal, search_filter):
+        prefix = self.names.relative(server_path)
+        skip = len(prefix) + 1 if prefix != '' else 0
+
+        for i, (path, name, kind) in enumerate(self.names.search(literal, prefix)):
+            if i % 256 == 0:
+                yield None
+
+            if not matcher(name):
+                continue
+
+            type_name = KIND_NAMES[kind]
+            if search_filter.needs_stats:
+                try:
+                    if not search_filter.accepts(type_name, self.__stat(self.names.root + '/' + path)):
+                        continue
+                except OSError:
+                    continue
+            elif not search_filter.accepts(type_name):
+                continue
+
+            yield {
+                'name': name,
+                'type': type_name,
+                'path': path[skip:]
+            }
+
+    # Yields the results of a search by walking the folder (from the tree index if it's enabled, otherwise with
+    # scandir); the walk only goes as far as the caller reads, so a page can be sent before it's done
+    # None is yielded every 256 entries, so the caller can stop when the search runs out of time
+    def __search_walk(self, server_path, matcher, search_filter):
+        if self.tree is not None:
+            entries = self.tree.walk(server_path)
+        else:
+            entries = walk(server_path, self.__search_pool)
+
+        for i, (rel_path, entry) in enumerate(entries):
+            if i % 256 == 0:
+                yield None
+
+            if not matcher(entry.name):
+                continue
+
+            if entry.is_dir():
+                type_name = 'folder'
+            elif entry.is_file():
+                type_name = 'file'
+            else:
+                type_name = 'unknown'
+
+            # Only stat the objects that matched, and only if a filter needs it
+            stats = None
+            if search_filter.needs_stats:
+                try:
+                    stats = entry.stat()
+                except OSError:
+                    continue
+
+            if search_filter.accepts(type_name, stats):
+                yield {
+                    'name': entry.name,
+                    'type': type_name,
+                    'path': rel_path
+                }
+
     def command_search(self, packet, p_data, server_path):
-        if not os.path.exists(server_path):
+        if not self.__exists(server_path):
             reply = Packet(get_reply_type(packet), MSG_NOT_FOUND, packet.id, packet.token)
             reply.payload = bytes('Path was not found', 'utf-8')
 
             print('Path was not found')
             return reply
 
+        # Build the matcher and filters first, so bad requests are rejected before touching the disk
+        mode = p_data.get('match', MATCH_SUBSTRING)
+        pattern = p_data.get('target_name_regex')
+
         try:
+            matcher = self.patterns.get(mode, pattern)
+            search_filter = SearchFilter(p_data)
+        except SearchException as e:
+            reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
+            reply.payload = bytes(str(e), 'utf-8')
+
+            print('Invalid search request:', e)
+            return reply
+
+        # Searches that run out of time return the results found so far, with "truncated": true
+        # (or with a cursor to the rest, if the client asked for pages)
+        deadline = time.monotonic() + self.search_time_budget
 
-            data = {'client_cmd': 'search', 'path': p_data['path'], 'results': []}
+        try:
 
-            search_path = server_path
+            data = {'client_cmd': 'search', 'path': p_data['path']}
 
-            root_stats = os.stat(server_path)
+            root_stats = self.__stat(server_path)
 
             if not stat.S_ISDIR(root_stats.st_mode):
                 reply = Packet(get_reply_type(packet), MSG_BAD_REQUEST, packet.id, packet.token)
@@ -489,55 +1624,25 @@ class Parser:
                 print('Search path is not a folder', server_path)
                 return reply
 
-            stack = LifoQueue()
-
-            # Put the folder and its relative path together, so we can keep track of stuff.
-            stack.put(('', os.listdir(search_path)))
-
-            while not stack.empty():  # cat timp am elemente in stack
-                rel_path, folder_contents = stack.get()  # scot element / update ultim element
-
-                for obj in folder_contents:
-                    # update la stats
-
-                    full_path = os.path.normpath(os.path.join(server_path, rel_path, obj)).replace('\\', '/')
-                    rel_obj_path = os.path.normpath(os.path.join(rel_path, obj)).replace('\\', '/')
-                    object_stats = os.stat(full_path)
-
-                    # verific ce tip este
-                    if stat.S_ISDIR(object_stats.st_mode):  # daca e director
-                        # desfac folder pentru a cauta mai departe
-                        # adaug toate fisierele din folderul scos
-                        stack.put((rel_obj_path, os.listdir(full_path)))
-
-                        # verific daca gasesc regex si aici
-                        if p_data['target_name_regex'] in obj:
-                            # adaug in data
-                            data['results'].append({
-                                'name': obj,
-                                'type': 'folder',
-                                'path': rel_obj_path
-                            })
-
-                    elif stat.S_ISREG(object_stats.st_mode):  # altfel daca e fisier
-                        if p_data['target_name_regex'] in obj:
-                            # adaug in data
-                            data['results'].append({
-                                'name': obj,
-                                'type': 'file',
-                                'path': rel_obj_path
-                            })
-
-                    else:
-                        if p_data['target_name_regex'] in obj:
-                            data['results'].append({
-                                'name': obj,
-                                'type': 'unknown',
-                                'path': rel_obj_path
-                            })
+            if self.names is not None:
+                results = lambda: self.__search_index(server_path, matcher, literal_hint(mode, pattern), search_filter)
+            else:
+                results = lambda: self.__search_walk(server_path, matcher, search_filter)
+
+            if _is_paged(p_data):
+                data['results'], next_cursor, error = self.__paginate(packet, p_data, server_path, results, deadline)
+                if error is not None:
+                    return error
+
+                if next_cursor is not None:
+                    data['next_cursor'] = next_cursor
+            else:
+                data['results'], rest = take_page(results(), None, deadline)
+                if rest is not None:
+                    data['truncated'] = True
 
             reply = Packet(get_reply_type(packet), MSG_CONTENT, packet.id, packet.token)
-            reply.payload = bytes(self.__jsonencoder.encode(data), 'utf-8')
+            self.__set_payload(reply, packet, data)
 
             print('Sent data about object', server_path)
             return reply
@@ -0,0 +1,138 @@
+# coap_retransmit.py
+# Schedules retransmissions of CON messages (RFC 7252, section 4.2)
+import heapq
+import random
+from typing import Optional, Dict, List, Tuple, Any
+
+from coap import *
+
+
+# Defines the current state of a CoAP packet waiting to be sent
+# Only the encoded message is kept alive during the retransmission window, not the whole Packet
+class PendingReply:
+    __slots__ = ('data', 'addr', 'msg_id', 'attempts', 'wait_time', 'attempts_left', 'deadline', 'backoff', 'sent_at')
+
+    def __init__(self, data=bytes(0), addr=('127.0.0.1', 5683), msg_id=0):
+        self.data = data
+        self.addr = addr
+        self.msg_id = msg_id
+        self.attempts = 0
+        self.wait_time = 0
+        self.attempts_left = 0
+        self.deadline = 0  # Absolute time (time.monotonic()) of the next retransmission
+        self.backoff = 2  # The timeout is multiplied by this after every retransmission
+        self.sent_at = 0  # Time of the first transmission (used to measure the round trip time)
+
+    # Rebuilds the packet from the encoded message (used for callbacks)
+    @property
+    def packet(self) -> Packet:
+        packet = Packet()
+        packet.parse(self.data, lazy=True)
+        packet.addr = self.addr
+        return packet
+
+
+# Initial retransmission timeout, randomized between ACK_TIMEOUT and ACK_TIMEOUT * ACK_RANDOM_FACTOR
+def initial_timeout() -> float:
+    return COMM_ACK_TIMEOUT * ((COMM_ACK_RANDOM_FACTOR - 1) * random.random() + 1)
+
+
+# Keeps pending CON messages in a min-heap ordered by their next deadline
+# Messages are also indexed by (addr, message ID), so ACKs cancel them in O(1)
+# Cancelled messages are left in the heap and skipped when they reach the top
+class RetransmitScheduler:
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.__pending: Dict[Tuple[Any, int], PendingReply] = {}  # Insertion ordered, oldest first
+        self.__heap: List[Tuple[float, int, PendingReply]] = []
+        self.__counter = 0  # Tie breaker for equal deadlines
+
+    def __len__(self):
+        return len(self.__pending)
+
+    # Schedules the first retransmission of a message that was just sent at time "now"
+    # If the scheduler is full, the oldest message is evicted and returned
+    def add(self, reply: PendingReply, now: float) -> Optional[PendingReply]:
+        evicted = None
+        key = (reply.addr, reply.msg_id)
+
+        if key in self.__pending:
+            del self.__pending[key]
+        elif len(self.__pending) >= self.capacity:
+            evicted = self.__pending.pop(next(iter(self.__pending)))
+
+        if reply.wait_time == 0:
+            reply.wait_time = initial_timeout()
+        if reply.attempts == 0:
+            reply.attempts = COMM_MAX_RETRANSMIT
+            reply.attempts_left = reply.attempts
+
+        reply.deadline = now + reply.wait_time
+        self.__pending[key] = reply
+        self.__push(reply)
+
+        return evicted
+
+    # Stops retransmission of a message (called when an ACK or RESET is received)
+    def cancel(self, addr, msg_id) -> Optional[PendingReply]:
+        reply = self.__pending.pop((addr, msg_id), None)
+        if reply is not None:
+            self.__compact()
+        return reply
+
+    # Time of the earliest retransmission, or None if nothing is pending
+    def next_deadline(self) -> Optional[float]:
+        self.__discard_stale()
+        if len(self.__heap) == 0:
+            return None
+        return self.__heap[0][0]
+
+    # Collects the messages whose deadline has passed
+    # Returns the messages that must be resent now, and the ones that exceeded MAX_RETRANSMIT
+    def pop_due(self, now: float) -> Tuple[List[PendingReply], List[PendingReply]]:
+        resend = []
+        lost = []
+        heap = self.__heap
+
+        while len(heap) > 0 and heap[0][0] <= now:
+            deadline, _, reply = heapq.heappop(heap)
+
+            if not self.__is_current(deadline, reply):
+                continue
+
+            if reply.attempts_left > 0:
+                # Exponential back-off: the timeout is multiplied by the back-off factor after every retransmission
+                # The next deadline counts from now, so a late wakeup never sends the same message twice in a row
+                reply.attempts_left -= 1
+                reply.deadline = now + reply.wait_time * (reply.backoff ** (reply.attempts - reply.attempts_left))
+                self.__push(reply)
+                resend.append(reply)
+            else:
+                del self.__pending[(reply.addr, reply.msg_id)]
+                lost.append(reply)
+
+        self.__compact()
+        return resend, lost
+
+    def clear(self):
+        self.__pending.clear()
+        self.__heap.clear()
+
+    def __push(self, reply: PendingReply):
+        self.__counter += 1
+        heapq.heappush(self.__heap, (reply.deadline, self.__counter, reply))
+
+    def __is_current(self, deadline: float, reply: PendingReply) -> bool:
+        return self.__pending.get((reply.addr, reply.msg_id)) is reply and reply.deadline == deadline
+
+    def __discard_stale(self):
+        heap = self.__heap
+        while len(heap) > 0 and not self.__is_current(heap[0][0], heap[0][2]):
+            heapq.heappop(heap)
+
+    # Rebuilds the heap when most of its entries belong to cancelled messages
+    def __compact(self):
+        if len(self.__heap) > 64 and len(self.__heap) > 2 * len(self.__pending):
+            self.__heap = [(reply.deadline, i, reply) for i, reply in enumerate(self.__pending.values())]
+            heapq.heapify(self.__heap)
+            self.__counter = len(self.__heap)
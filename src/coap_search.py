@@ -0,0 +1,245 @@
+# coap_search.py
+# Name matching and metadata filters for the search command
+import fnmatch
+import re
+import stat
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+
+MATCH_SUBSTRING = 'substring'
+MATCH_GLOB = 'glob'
+MATCH_REGEX = 'regex'
+
+MATCH_MODES = [MATCH_SUBSTRING, MATCH_GLOB, MATCH_REGEX]
+
+# Counted repetition in a regex ("{2}", "{1,}", "{,3}", "{1,5}"); other braces are literal
+_REGEX_COUNT = re.compile(r'\{(\d*)(,?)(\d*)\}')
+
+
+# Raised for search requests that can't be run (bad pattern, unknown mode, invalid filter values)
+class SearchException(Exception):
+    pass
+
+
+# Compiles search patterns into matcher functions (name -> bool)
+# Compiled patterns are kept in an LRU cache keyed by (mode, pattern), since clients tend to repeat the same searches
+class PatternCache:
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.max_length = 256  # Longer patterns are rejected
+        self.hits = 0
+        self.misses = 0
+
+        self.__matchers: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, mode: str, pattern: str) -> Callable[[str], bool]:
+        key = (mode, pattern)
+
+        with self.__lock:
+            matcher = self.__matchers.get(key)
+            if matcher is not None:
+                self.__matchers.move_to_end(key)
+                self.hits += 1
+                return matcher
+
+        matcher = self.__compile(mode, pattern)
+
+        with self.__lock:
+            self.misses += 1
+            self.__matchers[key] = matcher
+            while len(self.__matchers) > self.capacity:
+                self.__matchers.popitem(last=False)
+
+        return matcher
+
+    def __compile(self, mode: str, pattern: str) -> Callable[[str], bool]:
+        if not isinstance(pattern, str):
+            raise SearchException('The search pattern must be a string')
+
+        if len(pattern) > self.max_length:
+            raise SearchException('The search pattern is too long')
+
+        if mode == MATCH_SUBSTRING:
+            return lambda name: pattern in name
+
+        if mode == MATCH_GLOB:
+            # Case sensitive on every platform, like the other modes
+            return re.compile(fnmatch.translate(pattern)).match
+
+        if mode == MATCH_REGEX:
+            try:
+                compiled = re.compile(pattern)
+            except re.error as e:
+                raise SearchException('Invalid regex: {0}'.format(e))
+            if _nested_repeat(pattern):
+                raise SearchException('Nested quantifiers (like "(a+)+") are not allowed in search patterns')
+            return compiled.search
+
+        raise SearchException('Unknown match mode, expected one of: {0}'.format(', '.join(MATCH_MODES)))
+
+
+# Checks if a regex has a repetition inside another one (like "(a+)+" or "(a|b*)*")
+# Those can take exponential time to fail on a single name, and a regex evaluation can't be interrupted, so they
+# are rejected instead of being given a time budget
+# The pattern is scanned as text (it must already compile): groups are tracked on a stack, along with whether
+# something inside them repeats, and a group that holds a repetition can't be repeated itself
+def _nested_repeat(pattern: str) -> bool:
+    stack = [False]  # For every open group: whether it holds a repetition
+    group_repeats = None  # For the atom just before a quantifier: whether it's a group holding a repetition
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c == '\\':
+            i += 2
+            group_repeats = False
+        elif c == '[':
+            i = _class_end(pattern, i)
+            group_repeats = False
+        elif c == '(':
+            stack.append(False)
+            i += 1
+            if pattern.startswith('?', i):
+                i += 1  # Extension ("(?:", "(?P<name>", lookarounds), not a quantifier
+            group_repeats = None
+        elif c == ')':
+            inner = stack.pop() if len(stack) > 1 else False
+            stack[-1] = stack[-1] or inner
+            group_repeats = inner
+            i += 1
+        elif c in '*+?{':
+            count = _REGEX_COUNT.match(pattern, i) if c == '{' else None
+            if c == '{' and count is None:
+                group_repeats = False  # Literal brace
+                i += 1
+                continue
+
+            if count is not None:
+                low, comma, high = count.groups()
+                repeats = comma == '' and low not in ['', '0', '1'] or comma != '' and high not in ['0', '1']
+                i = count.end()
+            else:
+                repeats = c != '?'
+                i += 1
+
+            if repeats:
+                if group_repeats:
+                    return True
+                stack[-1] = True
+
+            # Lazy and possessive modifiers ("+?", "*+") belong to the same quantifier
+            if i < len(pattern) and pattern[i] in '?+':
+                i += 1
+            group_repeats = None
+        else:
+            group_repeats = False
+            i += 1
+
+    return False
+
+
+# Index just past the character class that starts at pattern[start] ("[")
+# A "]" right after "[" or "[^" is a member of the class, like in the re module
+def _class_end(pattern: str, start: int) -> int:
+    i = start + 1
+    if pattern.startswith('^', i):
+        i += 1
+    if pattern.startswith(']', i):
+        i += 1
+
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+
+
+# Text that every name matching the pattern must contain (used to narrow down candidates in the name index)
+# Returns '' if there is no such text
+def literal_hint(mode: str, pattern: str) -> str:
+    if mode == MATCH_SUBSTRING:
+        return pattern
+
+    if mode == MATCH_GLOB:
+        return _glob_literal(pattern)
+
+    return ''
+
+
+# Longest run of plain characters in a glob pattern
+# Brackets are split off with the rules of fnmatch.translate(): a "]" right after "[" or "[!" is a member of the
+# class, and a "[" without a closing "]" is a literal character
+def _glob_literal(pattern: str) -> str:
+    runs = ['']
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+
+        if c in '*?':
+            runs.append('')
+        elif c == '[':
+            j = i
+            if j < len(pattern) and pattern[j] == '!':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+
+            if j < 0:
+                runs[-1] += c
+            else:
+                runs.append('')
+                i = j + 1
+        else:
+            runs[-1] += c
+
+    return max(runs, key=len)
+
+
+# Optional filters on the type, size and modification time of results
+# Request fields: "type" ("file" / "folder"), "min_size", "max_size" (bytes),
+# "modified_after", "modified_before" (UNIX timestamps)
+class SearchFilter:
+    def __init__(self, p_data: Dict):
+        self.type: Optional[str] = p_data.get('type')
+        self.min_size = self.__number(p_data, 'min_size')
+        self.max_size = self.__number(p_data, 'max_size')
+        self.modified_after = self.__number(p_data, 'modified_after')
+        self.modified_before = self.__number(p_data, 'modified_before')
+
+        if self.type not in [None, 'file', 'folder']:
+            raise SearchException('Invalid "type" filter, expected "file" or "folder"')
+
+        # Size and time filters need the metadata of every candidate
+        self.needs_stats = any(value is not None for value in
+                               [self.min_size, self.max_size, self.modified_after, self.modified_before])
+
+    # type_name is 'file', 'folder' or 'unknown'; stats is only needed if needs_stats is True
+    def accepts(self, type_name: str, stats=None) -> bool:
+        if self.type is not None and type_name != self.type:
+            return False
+
+        if not self.needs_stats:
+            return True
+
+        if self.min_size is not None and (not stat.S_ISREG(stats.st_mode) or stats.st_size < self.min_size):
+            return False
+        if self.max_size is not None and (not stat.S_ISREG(stats.st_mode) or stats.st_size > self.max_size):
+            return False
+        if self.modified_after is not None and stats.st_mtime < self.modified_after:
+            return False
+        if self.modified_before is not None and stats.st_mtime > self.modified_before:
+            return False
+
+        return True
+
+    @staticmethod
+    def __number(p_data: Dict, key: str):
+        value = p_data.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise SearchException('Filter "{0}" must be a number'.format(key))
+        return value
@@ -1,23 +1,39 @@
 # coap_server.py
 # Implements the CoAP Server
-import random
 import select
-from threading import Thread, Event, Semaphore
+from collections import deque
+from queue import Queue, Full, Empty
+from threading import Thread, Event, Semaphore, get_ident
 import time
 from socket import *
 from typing import Optional, Callable, Dict, List, Tuple, Any
 
 from coap import *
+from coap_retransmit import PendingReply, RetransmitScheduler
+from coap_dedup import DuplicateCache
+from coap_congestion import CongestionControl
+
+
+# Pool of preallocated receive buffers
+# Datagrams are received straight into a buffer, and packets parsed from it keep referencing it
+# until their handler is done; the buffer is then reused for the next datagram
+class BufferPool:
+    def __init__(self, count=64, size=65527):
+        self.size = size
+        self.capacity = count
+        self.__free = deque(bytearray(size) for _ in range(count))
+
+    # Takes a buffer from the pool (or allocates one, if all of them are in use)
+    def acquire(self) -> bytearray:
+        try:
+            return self.__free.pop()
+        except IndexError:
+            return bytearray(self.size)
 
-
-# Defines the current state of a CoAP packet waiting to be sent
-class PendingReply:
-    def __init__(self):
-        self.packet = Packet()
-        self.attempts = 0
-        self.wait_time = 0
-        self.attempts_left = 0
-        self.time_left = 0
+    # Gives a buffer back; extra buffers allocated while the pool was empty are dropped
+    def release(self, buffer: bytearray):
+        if len(self.__free) < self.capacity:
+            self.__free.append(buffer)
 
 
 # Clasa pentru definirea unui server Co-AP
@@ -31,9 +47,29 @@ class Server:
         self.__stop_event.set()
         self.__mutex = Semaphore(1)
         self.__sock: Optional[socket] = None
+        self.__wake_recv: Optional[socket] = None  # Wakeup pair, used to interrupt select()
+        self.__wake_send: Optional[socket] = None
         self.__next_msgid = 225
-        self.__con_replies: List[PendingReply] = []
-        self.__last_time = 0
+        self.__con_replies = RetransmitScheduler()
+        self.__congestion = CongestionControl()  # NSTART and RTO estimation for every endpoint
+        self.__duplicates = DuplicateCache()  # Replies sent for recent requests
+
+        # Handler worker pool (only used if config['workers'] > 0)
+        self.__requests: Optional[Queue] = None  # Requests waiting for a worker
+        self.__workers: List[Thread] = []
+        self.__outbox = deque()  # (request, reply) pairs produced by workers, sent by the update thread
+
+        # Requests that got an empty ACK, and whose reply must be sent as a separate CON response
+        self.__separate = set()
+
+        # CON requests handed to the workers, with the time at which they get an empty ACK if their reply isn't
+        # ready by then (insertion ordered, so the earliest deadline is first); only used by the update thread
+        self.__inflight: Dict[Tuple[Any, int], float] = {}
+
+        # Receive buffers, and messages waiting to be sent at the end of the current loop turn
+        self.__buffers: Optional[BufferPool] = None
+        self.__burst: List[Tuple[bytes, Any, Optional[Packet]]] = []
+        self.__loop_ident: Optional[int] = None  # Thread ID of the update thread
 
         # Msg Callback dictionary stores callbacks that are called for specific message codes
         self.packet_receivers: Dict[Tuple[int, int], Callable[[Packet], Packet]] = {}
@@ -41,6 +77,16 @@ class Server:
         # Used for handling replies that were lost
         self.on_reply_lost: Optional[Callable[[Packet], None]] = None
 
+        # Used for handling RESET messages sent in response to our messages
+        self.on_reset_received: Optional[Callable[[Packet], None]] = None
+
+        # Used to tell which requests are slow to handle (returns True for them)
+        # Slow CON requests are acknowledged right away with an empty ACK, and their reply is sent later as a
+        # separate CON response (RFC 7252 section 5.2.2), so clients don't retransmit while the handler runs
+        # With handler workers, other CON requests get the same treatment once their handler runs for longer
+        # than config['ack_delay']
+        self.is_slow_request: Optional[Callable[[Packet], bool]] = None
+
         # Used for logging purposes
         self.on_request_received: Optional[Callable[[Packet], None]] = None
 
@@ -48,9 +94,45 @@ class Server:
         self.on_reply_sent: Optional[Callable[[Packet], None]] = None
 
         # Configuration
+        # 'max_pending' - maximum number of CON messages waiting for an ACK; the oldest ones are dropped beyond it
+        # 'workers' - number of threads that run packet_receivers; 0 runs them on the update thread
+        # 'queue_size' - maximum number of requests waiting for a worker; requests beyond it get 5.03
+        # 'retry_after' - Max-Age (in seconds) sent with 5.03 replies when the queue is full
+        # 'reuse_port' - bind with SO_REUSEPORT, so several processes can share the port (see coap_cluster.py)
+        # 'buffers' - number of receive buffers kept in the pool
+        # 'max_batch' - maximum number of datagrams read per wakeup
+        # 'dedup_max_bytes' - memory budget of the duplicate detection cache
+        # 'nstart' - maximum number of CON messages in flight to one endpoint; the others wait in a queue
+        # 'max_queued' - maximum number of CON messages waiting in the queue of an endpoint; the oldest are dropped
+        # 'ack_delay' - CON requests whose reply isn't ready after this long (seconds) get an empty ACK, and their
+        # reply is sent as a separate response; shorter than ACK_TIMEOUT, so clients don't retransmit meanwhile
+        # (needs 'workers' > 0: without workers, handlers run on the update thread, which can't send the ACK)
         self.config: Dict[str, Any] = {
-            'timeout': 0.1,
-            'maxdatasize': 65527
+            'maxdatasize': 65527,
+            'max_pending': 100000,
+            'workers': 0,
+            'queue_size': 256,
+            'retry_after': 1,
+            'reuse_port': False,
+            'buffers': 64,
+            'max_batch': 64,
+            'dedup_max_bytes': 16 * 1024 * 1024,
+            'nstart': COMM_NSTART,
+            'max_queued': 1000,
+            'ack_delay': 1.0
+        }
+
+        # Counters, used for monitoring (see also coap_cluster.py)
+        self.stats: Dict[str, int] = {
+            'received': 0,
+            'parse_errors': 0,
+            'sent': 0,
+            'retransmitted': 0,
+            'lost': 0,
+            'rejected': 0,
+            'dedup_hits': 0,
+            'dedup_misses': 0,
+            'separate': 0
         }
 
         return
@@ -63,11 +145,35 @@ class Server:
 
         # Prepare stuff
         self.__stop_event.clear()
-        self.__last_time = time.time()
+        self.__con_replies.clear()
+        self.__con_replies.capacity = self.config['max_pending']
+        self.__congestion = CongestionControl(self.config['nstart'], self.config['max_queued'])
+        self.__buffers = BufferPool(self.config['buffers'], self.config['maxdatasize'])
+        self.__burst = []
+        self.__separate.clear()
+        self.__inflight.clear()
+        self.__duplicates.clear()
+        self.__duplicates.max_bytes = self.config['dedup_max_bytes']
 
         # Create socket
         self.__sock = socket(AF_INET, SOCK_DGRAM)
+        if self.config['reuse_port']:
+            self.__sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.__sock.bind((self.ip, self.port))
+        self.__sock.setblocking(False)
+
+        # The update thread blocks in select(); writing to this pair wakes it up
+        self.__wake_recv, self.__wake_send = socketpair()
+        self.__wake_recv.setblocking(False)
+        self.__wake_send.setblocking(False)
+
+        # Start handler workers
+        if self.config['workers'] > 0:
+            self.__requests = Queue(self.config['queue_size'])
+            for i in range(self.config['workers']):
+                worker = Thread(target=self.__workerloop, name='CoAP worker {0}'.format(i))
+                worker.start()
+                self.__workers.append(worker)
 
         # Start update thread
         self.__thread = Thread(target=self.__threadloop)
@@ -82,12 +188,36 @@ class Server:
 
         # Stop update thread
         self.__stop_event.set()
+        self.__wakeup()
         self.__thread.join()
         self.__thread = None
 
+        # CON messages still waiting for their turn won't be sent
+        self.__mutex.acquire()
+        queued = self.__congestion.clear()
+        self.__mutex.release()
+
+        self.__transmit([], queued)
+
+        # Stop handler workers; requests still in the queue are dropped
+        if self.__requests is not None:
+            self.__discard_requests()
+            for worker in self.__workers:
+                self.__requests.put(None)
+            for worker in self.__workers:
+                worker.join()
+            self.__workers = []
+            self.__requests = None
+            self.__outbox.clear()
+            self.__inflight.clear()
+
         # Stop network connections
         self.__sock.close()
         self.__sock = None
+        self.__wake_recv.close()
+        self.__wake_send.close()
+        self.__wake_recv = None
+        self.__wake_send = None
 
         print("Stopped CoAP server.")
         return
@@ -99,24 +229,34 @@ class Server:
         if self.__thread is None:
             return
 
-        # If message is of type CON, use retransmission
+        # If message is of type CON, use retransmission (and congestion control)
         # For other message types, send the packet now
         if packet.type == TYPE_CON:
-            reply = PendingReply()
-            reply.packet = packet
-            reply.wait_time = COMM_ACK_TIMEOUT * ((COMM_ACK_RANDOM_FACTOR - 1) * random.random() + 1)
-            reply.attempts = COMM_MAX_RETRANSMIT
-            reply.send_cooldown = 0
-            reply.attempts_left = reply.attempts
+            reply = PendingReply(packet.tobytes(), packet.addr, packet.id)
+            now = time.monotonic()
 
+            # Registered before the first transmission, so an ACK that arrives right away can cancel it
             self.__mutex.acquire()
-            self.__con_replies += reply
+            ready, dropped = self.__congestion.submit(reply, now)
+            sent, evicted = self.__schedule(ready, now)
             self.__mutex.release()
+
+            self.__transmit(sent, dropped + evicted)
         else:
             self.__send_packet(packet)
 
         return
 
+    # Congestion statistics (RTO, RTT, loss) of one endpoint, or of every endpoint if addr is None
+    def peer_stats(self, addr=None):
+        self.__mutex.acquire()
+        try:
+            if addr is None:
+                return self.__congestion.all_stats()
+            return self.__congestion.stats(addr)
+        finally:
+            self.__mutex.release()
+
     def generate_id(self):
         msgid = self.__next_msgid
         self.__next_msgid += 1
@@ -124,122 +264,390 @@ class Server:
 
     # The server's update thread
     # It receives requests, and manages pending CON replies
+    # The thread sleeps in select() until a datagram arrives, a wakeup is requested, or the next retransmission is due
+    # Every wakeup drains all the datagrams that are ready, and the replies produced during a turn are sent in one burst
     def __threadloop(self):
+        self.__loop_ident = get_ident()
+
         while not self.__stop_event.is_set():
 
-            # Get elapsed time
-            now = time.time()
-            time_delta = now - self.__last_time
-            self.__last_time = now
+            # Send replies produced by the handler workers
+            while len(self.__outbox) > 0:
+                self.__send_reply(*self.__outbox.popleft())
 
             # Update messages that are waiting for ACK replies
             # Messages that exceed MAX_RETRANSMIT sends are removed
+            now = time.monotonic()
+
+            # Messages that were given up on make room for the ones queued to the same endpoint
             self.__mutex.acquire()
+            resend, lost = self.__con_replies.pop_due(now)
+            ready = []
+            for reply in resend:
+                self.__congestion.retransmitted(reply)
+            for reply in lost:
+                ready.extend(self.__congestion.finish(reply, now, acked=False))
+            sent, evicted = self.__schedule(ready, now)
+            deadline = self.__con_replies.next_deadline()
+            self.__mutex.release()
 
-            for reply in self.__con_replies:
-                reply.time_left -= time_delta
+            for reply in resend:
+                self.__send_pending(reply)
+                self.stats['retransmitted'] += 1
 
-                if reply.time_left <= 0:
-                    if reply.attempts_left > 0:
-                        reply.attempts_left -= 1
-                        reply.time_left += reply.wait_time * (2 ** (reply.attempts - reply.attempts_left))
-                        self.__send_packet(reply.packet)
-                    else:
-                        self.__con_replies.remove(reply)
-                        if callable(self.on_reply_lost):
-                            self.on_reply_lost(reply.packet)
+            self.__transmit(sent, lost + evicted)
 
-            self.__mutex.release()
+            # Requests that are taking long get their empty ACK now
+            ack_deadline = self.__acknowledge_late(now)
+            if ack_deadline is not None and (deadline is None or ack_deadline < deadline):
+                deadline = ack_deadline
 
-            # Receive messages
+            self.__flush_burst()
 
-            data = None
+            # Sleep until the earliest retransmission deadline (or indefinitely if nothing is pending)
+            wait_time = None
+            if deadline is not None:
+                wait_time = max(0.0, deadline - time.monotonic())
 
-            try:
-                self.__sock.settimeout(self.config['timeout'])
+            # Receive messages
 
-                packet = Packet()
-                data, packet.addr = self.__sock.recvfrom(self.config['maxdatasize'])
-                packet.parse(data)
+            readable, _, _ = select.select([self.__sock, self.__wake_recv], [], [], wait_time)
 
-                try:
-                    if callable(self.on_request_received):
-                        self.on_request_received(packet)
-                except Exception as e:
-                    print('On Request Received event threw an exception for some reason!')
-                    print(e)
+            if self.__wake_recv in readable:
+                self.__drain_wakeup()
 
-            except timeout:
-                continue
-            except ParseException as e:
-                print('Got a message, but parse failed.')
-                print('Exception message: {0}'.format(e))
-                print('Message contents: {0}'.format(data))
+            if self.__sock not in readable:
                 continue
+
+            for i in range(self.config['max_batch']):
+                if not self.__receive():
+                    break
+
+            self.__flush_burst()
+
+        self.__flush_burst()
+        self.__loop_ident = None
+        return
+
+    # Receives and processes a single datagram
+    # Returns False if there was nothing left to read
+    def __receive(self) -> bool:
+        buffer = self.__buffers.acquire()
+        data = None
+
+        try:
+            packet = Packet()
+            length, packet.addr = self.__sock.recvfrom_into(buffer)
+            data = memoryview(buffer)[:length]
+            packet.parse(data, lazy=True)
+            self.stats['received'] += 1
+
+            try:
+                if callable(self.on_request_received):
+                    self.on_request_received(packet)
             except Exception as e:
-                print('Got a message, but parse failed due to an internal error.')
-                print('Exception message: {0}'.format(e))
-                continue
+                print('On Request Received event threw an exception for some reason!')
+                print(e)
+
+        except (BlockingIOError, InterruptedError):
+            self.__buffers.release(buffer)
+            return False
+        except ParseException as e:
+            self.stats['parse_errors'] += 1
+            print('Got a message, but parse failed.')
+            print('Exception message: {0}'.format(e))
+            print('Message contents: {0}'.format(bytes(data) if data is not None else None))
+            self.__buffers.release(buffer)
+            return True
+        except Exception as e:
+            print('Got a message, but parse failed due to an internal error.')
+            print('Exception message: {0}'.format(e))
+            self.__buffers.release(buffer)
+            return True
+
+        # The buffer goes back to the pool once the packet is no longer needed
+        # If the packet was handed to a worker, the worker releases it
+        if not self.__process(packet, buffer):
+            packet.detach()
+            self.__buffers.release(buffer)
+
+        return True
+
+    # Handles a received packet
+    # Returns True if the packet (and its buffer) was handed over to a worker
+    def __process(self, packet: Packet, buffer: bytearray) -> bool:
+        # Stop retransmission for all (one?) packets that match the ACK's ID.
+        # The round trip time is measured, and the next message queued to the endpoint (if any) is sent
+        if packet.type == TYPE_ACK or packet.type == TYPE_RESET:
+            now = time.monotonic()
+            sent, evicted = [], []
 
-            # Stop retransmission for all (one?) packets that match the ACK's ID.
-            if packet.type == TYPE_ACK or packet.type == TYPE_RESET:
-                self.__mutex.acquire()
-                self.__con_replies = [msg for msg in self.__con_replies if msg.id != packet.id]
-                self.__mutex.release()
+            self.__mutex.acquire()
+            reply = self.__con_replies.cancel(packet.addr, packet.id)
+            if reply is not None:
+                ready = self.__congestion.finish(reply, now, acked=packet.type == TYPE_ACK,
+                                                 reset=packet.type == TYPE_RESET)
+                sent, evicted = self.__schedule(ready, now)
+            self.__mutex.release()
 
-            # Ignore RESET messages - we don't do much with them
-            if packet.type == TYPE_RESET:
-                continue
+            self.__transmit(sent, evicted)
 
-            # EMPTY is not allowed. Intercept and reply with RESET EMPTY if packet is CON or ACK.
-            if packet.code == MSG_EMPTY:
-                if packet.type in [TYPE_CON, TYPE_NON]:
-                    reply = make_reset(packet.id, bytes(0))
-                    self.send(reply)
-                continue
+        # RESET messages are only passed on to the reset callback (used to cancel Observe subscriptions)
+        if packet.type == TYPE_RESET:
+            if callable(self.on_reset_received):
+                self.on_reset_received(packet)
+            return False
 
-            # Check if we know how to parse the packet
-            if packet.code in self.packet_receivers:
-                try:
-                    reply = self.packet_receivers[packet.code](packet)
-                except Exception:
-                    reply = Packet(packet.get_reply_type(), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
-                    reply.payload = bytes('An unknown internal error happened!', 'utf-8')
-                    reply.addr = packet.addr
-                    self.send(reply)
-
-                # If the receiver returned a reply, send it
-                if isinstance(reply, Packet):
-                    reply.addr = packet.get_reply_type()
-                    reply.addr = packet.addr
-                    self.send(reply)
-
-                # No valid reply, send ACK INTERNAL ERROR if CON
-                elif packet.type == TYPE_CON:
-                    reply = Packet(TYPE_ACK, MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
-                    reply.payload = bytes('An unknown internal error happened!', 'utf-8')
-                    reply.addr = packet.addr
-                    self.send(reply)
-
-            # We can't parse this - we'll use a server error instead of a non-descriptive RESET
-            else:
-                reply = Packet(packet.get_reply_type(), MSG_NOT_IMPLEMENTED, packet.id, packet.token)
-                reply.payload = bytes('Server does not support the request type', 'utf-8')
+        # EMPTY is not allowed. Intercept and reply with RESET EMPTY if packet is CON or ACK.
+        if packet.code == MSG_EMPTY:
+            if packet.type in [TYPE_CON, TYPE_NON]:
+                reply = make_reset(packet.id, bytes(0))
                 reply.addr = packet.addr
                 self.send(reply)
+            return False
+
+        # Only requests go past this point
+        if packet.type == TYPE_ACK:
+            return False
+
+        # Duplicate requests are answered with the reply that was already sent, without running the receiver
+        # If the original is still being handled, the duplicate is dropped
+        duplicate, data = self.__duplicates.check(packet)
+        self.stats['dedup_hits'] = self.__duplicates.hits
+        self.stats['dedup_misses'] = self.__duplicates.misses
+
+        if duplicate:
+            if data is not None:
+                self.__send_data(data, packet.addr, None)
+            return False
+
+        # We can't parse this - we'll use a server error instead of a non-descriptive RESET
+        if packet.code not in self.packet_receivers:
+            reply = Packet(packet.get_reply_type(), MSG_NOT_IMPLEMENTED, packet.id, packet.token)
+            reply.payload = bytes('Server does not support the request type', 'utf-8')
+            reply.addr = packet.addr
+            self.__send_reply(packet, reply)
+            return False
+
+        separate = packet.type == TYPE_CON and self.__is_slow(packet)
+
+        # Run the receiver here, or hand the packet over to the workers
+        if self.__requests is None:
+            if separate:
+                self.__acknowledge(packet.addr, packet.id)
+                self.__flush_burst()
+
+            reply = self.__handle_request(packet)
+            if reply is not None:
+                self.__send_reply(packet, reply)
+            return False
 
-        return
+        try:
+            self.__requests.put_nowait((packet, buffer))
+            if separate:
+                self.__acknowledge(packet.addr, packet.id)
+            elif packet.type == TYPE_CON:
+                self.__inflight[(packet.addr, packet.id)] = time.monotonic() + self.config['ack_delay']
+            return True
+        except Full:
+            # Workers can't keep up - tell the client to retry later
+            self.stats['rejected'] += 1
+            reply = Packet(packet.get_reply_type(), MSG_SERVICE_UNAVAILABLE, packet.id, packet.token)
+            reply.options[OPT_MAX_AGE] = [encode_uint(self.config['retry_after'])]
+            reply.payload = bytes('Server is busy, try again later', 'utf-8')
+            reply.addr = packet.addr
+            self.send(reply)
+
+            # The request wasn't processed, so its retransmissions must not be treated as duplicates
+            self.__duplicates.forget(packet.addr, packet.id)
+            return False
+
+    def __is_slow(self, packet: Packet) -> bool:
+        if not callable(self.is_slow_request):
+            return False
+
+        try:
+            return self.is_slow_request(packet)
+        except Exception as e:
+            print('Is Slow Request callback threw an exception:', e)
+            return False
+
+    # Sends an empty ACK for a request whose reply will be a separate response
+    # Retransmissions of the request are answered with the same ACK
+    def __acknowledge(self, addr, msg_id: int):
+        ack = make_empty_ack(msg_id, bytes(0))
+        ack.addr = addr
+        self.send(ack)
+
+        self.__duplicates.store(addr, msg_id, ack.cached_bytes())
+        self.__separate.add((addr, msg_id))
+        self.stats['separate'] += 1
+
+    # Acknowledges the requests handed to the workers whose ack_delay has passed without a reply
+    # Returns the time at which the next one is due (None if no request is waiting)
+    def __acknowledge_late(self, now: float) -> Optional[float]:
+        while len(self.__inflight) > 0:
+            key, deadline = next(iter(self.__inflight.items()))
+            if deadline > now:
+                return deadline
+
+            del self.__inflight[key]
+            self.__acknowledge(*key)
+
+        return None
+
+    # Sends the reply to a request, and remembers it for duplicate detection
+    # Replies to requests that were already acknowledged go out as separate CON responses, with their own
+    # message ID (matched to the request by token), and are retransmitted until the client ACKs them
+    def __send_reply(self, request: Packet, reply: Packet):
+        key = (request.addr, request.id)
+        self.__inflight.pop(key, None)
+
+        if key in self.__separate:
+            self.__separate.discard(key)
+            if reply.type == TYPE_ACK:
+                reply.type = TYPE_CON
+                reply.id = self.generate_id()
+            self.send(reply)
+            return
+
+        self.send(reply)
+        self.__duplicates.store(request.addr, request.id, reply.cached_bytes())
+
+    # Handler worker thread
+    # Runs receivers for queued requests, and leaves the replies to the update thread (which owns the socket)
+    def __workerloop(self):
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                return
+
+            packet, buffer = request
+            reply = self.__handle_request(packet)
+
+            packet.detach()
+            self.__buffers.release(buffer)
+
+            if reply is not None:
+                self.__outbox.append((packet, reply))
+                self.__wakeup()
+
+    def __discard_requests(self):
+        try:
+            while True:
+                self.__requests.get_nowait()
+        except Empty:
+            pass
+
+    # Runs the receiver for a packet, and returns the reply that must be sent (if any)
+    def __handle_request(self, packet: Packet) -> Optional[Packet]:
+        try:
+            reply = self.packet_receivers[packet.code](packet)
+        except Exception:
+            reply = Packet(packet.get_reply_type(), MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('An unknown internal error happened!', 'utf-8')
+
+        # If the receiver returned a reply, send it
+        if isinstance(reply, Packet):
+            reply.addr = packet.addr
+            return reply
+
+        # No valid reply, send ACK INTERNAL ERROR if CON
+        elif packet.type == TYPE_CON:
+            reply = Packet(TYPE_ACK, MSG_INTERNAL_SERVER_ERROR, packet.id, packet.token)
+            reply.payload = bytes('An unknown internal error happened!', 'utf-8')
+            reply.addr = packet.addr
+            return reply
+
+        return None
+
+    # Must be called with the mutex held
+    # Schedules the retransmissions of CON messages started by the congestion control
+    # Returns the messages to send, and the ones evicted because too many messages are pending
+    def __schedule(self, ready: List[PendingReply], now: float) -> Tuple[List[PendingReply], List[PendingReply]]:
+        sent = []
+        evicted = []
+
+        while len(ready) > 0:
+            reply = ready.pop(0)
+            sent.append(reply)
+
+            oldest = self.__con_replies.add(reply, now)
+            if oldest is not None:
+                evicted.append(oldest)
+                ready.extend(self.__congestion.finish(oldest, now, acked=False))
+
+        return sent, evicted
+
+    # Sends CON messages for the first time, and reports the ones that won't be sent anymore
+    def __transmit(self, sent: List[PendingReply], lost: List[PendingReply]):
+        for reply in sent:
+            self.__send_pending(reply)
+
+        # Let the update thread pick up the new retransmission deadlines
+        if len(sent) > 0:
+            self.__wakeup()
+
+        self.stats['lost'] += len(lost)
+        if callable(self.on_reply_lost):
+            for reply in lost:
+                self.on_reply_lost(reply.packet)
 
     def __send_packet(self, packet: Packet):
+        self.__send_data(packet.tobytes(), packet.addr, packet)
+
+    # Sends (or resends) the encoded message of a pending CON reply
+    def __send_pending(self, reply: PendingReply):
+        self.__send_data(reply.data, reply.addr, None)
+
+    # Messages sent from the update thread are queued, and go out together at the end of the loop turn
+    # Other threads send directly
+    def __send_data(self, data: bytes, addr, packet: Optional[Packet]):
         if self.__sock is None:
             raise
 
+        if get_ident() == self.__loop_ident:
+            self.__burst.append((data, addr, packet))
+            return
+
+        self.__sendto(data, addr, packet)
+
+    def __flush_burst(self):
+        if len(self.__burst) == 0:
+            return
+
+        burst = self.__burst
+        self.__burst = []
+
+        for data, addr, packet in burst:
+            self.__sendto(data, addr, packet)
+
+    def __sendto(self, data: bytes, addr, packet: Optional[Packet]):
         try:
-            self.__sock.sendto(packet.tobytes(), packet.addr)
+            self.__sock.sendto(data, addr)
+            self.stats['sent'] += 1
 
             if callable(self.on_reply_sent):
+                if packet is None:
+                    packet = Packet()
+                    packet.parse(data, lazy=True)
+                    packet.addr = addr
                 self.on_reply_sent(packet)
         except Exception as e:
             print("Couldn't send packet due to exception {0}".format(e))
 
         return
+
+    # Interrupts the update thread's select() call
+    def __wakeup(self):
+        try:
+            self.__wake_send.send(b'\x00')
+        except (BlockingIOError, AttributeError, OSError):
+            pass  # Already signalled (buffer full), or the server is stopping
+
+    def __drain_wakeup(self):
+        try:
+            while self.__wake_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
@@ -0,0 +1,361 @@
+# coap_tree.py
+# In-memory index of the server's file tree, so read-only commands can be answered without touching the disk
+import os
+import stat
+import time
+from array import array
+from threading import Thread, RLock, Event
+from typing import Optional, List, Dict, Tuple
+
+
+# Metadata of an indexed object, with the same attribute names as os.stat_result
+class NodeStat:
+    __slots__ = ('st_mode', 'st_ino', 'st_size', 'st_mtime_ns', 'st_atime', 'st_mtime', 'st_ctime')
+
+    def __init__(self, mode, ino, size, mtime_ns, atime, ctime):
+        self.st_mode = mode
+        self.st_ino = ino
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self.st_atime = atime
+        self.st_mtime = mtime_ns / 1e9
+        self.st_ctime = ctime
+
+
+# An indexed object, with the same methods as os.DirEntry (so walkers can use either)
+class NodeEntry:
+    __slots__ = ('name', 'path', '__stats')
+
+    def __init__(self, name: str, path: str, stats: NodeStat):
+        self.name = name
+        self.path = path
+        self.__stats = stats
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.__stats.st_mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.__stats.st_mode)
+
+    def stat(self):
+        return self.__stats
+
+
+# Nodes are stored column-wise in typed arrays, indexed by node number; node 0 is the root folder
+# Only the names and the child tables of folders are Python objects
+class _NodeStore:
+    def __init__(self):
+        self.names: List[str] = []
+        self.parents = array('q')
+        self.modes = array('Q')
+        self.inodes = array('Q')
+        self.sizes = array('q')
+        self.mtimes = array('q')  # Nanoseconds
+        self.atimes = array('d')
+        self.ctimes = array('d')
+        self.children: List[Optional[Dict[str, int]]] = []  # Folder contents: name -> node (None for files)
+        self.free: List[int] = []  # Slots of removed nodes, reused by new ones
+
+    def add(self, parent: int, name: str, stats) -> int:
+        children = {} if stat.S_ISDIR(stats.st_mode) else None
+        values = (parent, stats.st_mode, stats.st_ino & 0xFFFFFFFFFFFFFFFF, stats.st_size, stats.st_mtime_ns,
+                  stats.st_atime, stats.st_ctime)
+
+        if len(self.free) > 0:
+            node = self.free.pop()
+            self.names[node] = name
+            self.children[node] = children
+            self.set(node, values)
+        else:
+            node = len(self.names)
+            self.names.append(name)
+            self.children.append(children)
+            for column, value in zip(self.__columns(), values):
+                column.append(value)
+
+        if parent >= 0:
+            self.children[parent][name] = node
+        return node
+
+    def update(self, node: int, stats):
+        self.set(node, (self.parents[node], stats.st_mode, stats.st_ino & 0xFFFFFFFFFFFFFFFF, stats.st_size,
+                        stats.st_mtime_ns, stats.st_atime, stats.st_ctime))
+
+    def set(self, node: int, values):
+        for column, value in zip(self.__columns(), values):
+            column[node] = value
+
+    # Removes a node and everything below it
+    def remove(self, node: int):
+        parent = self.parents[node]
+        if parent >= 0:
+            self.children[parent].pop(self.names[node], None)
+
+        stack = [node]
+        while len(stack) > 0:
+            current = stack.pop()
+            if self.children[current] is not None:
+                stack.extend(self.children[current].values())
+            self.names[current] = ''
+            self.children[current] = None
+            self.modes[current] = 0
+            self.free.append(current)
+
+    def stat(self, node: int) -> NodeStat:
+        return NodeStat(self.modes[node], self.inodes[node], self.sizes[node], self.mtimes[node],
+                        self.atimes[node], self.ctimes[node])
+
+    def __columns(self):
+        return self.parents, self.modes, self.inodes, self.sizes, self.mtimes, self.atimes, self.ctimes
+
+    # Adds the contents of a folder node (and of all its subfolders) from disk
+    # Symbolic links to folders are indexed (with the metadata of their target), but their contents aren't:
+    # they could lead outside of the root, or into a loop
+    def scan(self, node: int, path: str):
+        if os.path.islink(path):
+            return
+
+        stack = [(node, path)]
+        while len(stack) > 0:
+            parent, folder = stack.pop()
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        try:
+                            stats = entry.stat()
+                            walk_into = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        child = self.add(parent, entry.name, stats)
+                        if walk_into:
+                            stack.append((child, entry.path))
+            except OSError:
+                pass
+
+
+# Index of everything below a root folder
+# Lookups walk one child table per path component, so they cost O(path depth) and never make a syscall
+# Commands that modify the disk call refresh() for the paths they touched; a background thread also rebuilds
+# the whole index every reconcile_interval seconds, to pick up changes made by other programs
+class TreeIndex:
+    def __init__(self, root: str):
+        self.root = os.path.normpath(root).replace('\\', '/')
+        self.reconcile_interval = 60.0
+
+        self.__store = _NodeStore()
+        self.__lock = RLock()
+        self.__building = False
+        self.__refreshed: List[str] = []  # Paths refreshed while a rebuild was scanning the disk
+        self.__thread: Optional[Thread] = None
+        self.__stop_event = Event()
+
+    def __len__(self):
+        store = self.__store
+        return len(store.names) - len(store.free)
+
+    # Scans the whole tree from disk, and replaces the index with the result
+    def build(self):
+        with self.__lock:
+            self.__building = True
+            self.__refreshed = []
+
+        store = _NodeStore()
+        try:
+            store.add(-1, '', os.stat(self.root))
+            store.scan(0, self.root)
+        except OSError as e:
+            print("Couldn't index", self.root, ':', e)
+
+        with self.__lock:
+            self.__store = store
+            self.__building = False
+
+            # Changes made during the scan may have been missed by it
+            for path in self.__refreshed:
+                self.refresh(path)
+            self.__refreshed = []
+
+        return
+
+    # Starts the reconcile thread (the index is built first, if needed)
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        if len(self.__store.names) == 0:
+            self.build()
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__reconcile_loop, name='CoAP tree index', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    # Metadata of the object at path, or None if it doesn't exist
+    def stat(self, path: str) -> Optional[NodeStat]:
+        with self.__lock:
+            node = self.__lookup(path)
+            if node < 0:
+                return None
+            return self.__store.stat(node)
+
+    # Names of the objects inside a folder, or None if path isn't an indexed folder
+    def listdir(self, path: str) -> Optional[List[str]]:
+        with self.__lock:
+            node = self.__lookup(path)
+            if node < 0 or self.__store.children[node] is None:
+                return None
+            return list(self.__store.children[node].keys())
+
+    # Lists everything below a folder, as (relative path, NodeEntry) pairs, like coap_walk.walk()
+    def walk(self, path: str) -> List[Tuple[str, NodeEntry]]:
+        results = []
+
+        with self.__lock:
+            node = self.__lookup(path)
+            store = self.__store
+            if node < 0 or store.children[node] is None:
+                return results
+
+            path = os.path.normpath(path).replace('\\', '/')
+            stack = [(node, '')]
+            while len(stack) > 0:
+                folder, rel = stack.pop()
+                prefix = rel + '/' if rel != '' else ''
+
+                for name, child in store.children[folder].items():
+                    rel_path = prefix + name
+                    if store.children[child] is not None:
+                        stack.append((child, rel_path))
+                    results.append((rel_path, NodeEntry(name, path + '/' + rel_path, store.stat(child))))
+
+        return results
+
+    # Updates the index from disk for one path (and everything below it), and for the folder holding it
+    def refresh(self, path: str):
+        components = self.__split(path)
+        if components is None:
+            return
+
+        with self.__lock:
+            if self.__building:
+                self.__refreshed.append(path)
+
+            store = self.__store
+            if len(store.names) == 0:
+                return
+
+            if len(components) == 0:
+                self.__update_node(0, self.root)
+                return
+
+            parent_path = self.root + '/' + '/'.join(components[:-1]) if len(components) > 1 else self.root
+            parent = self.__lookup(parent_path)
+            if parent < 0 or store.children[parent] is None:
+                # The parent folder isn't indexed either - refresh from the closest indexed ancestor
+                self.refresh(parent_path)
+                return
+
+            name = components[-1]
+            node = store.children[parent].get(name, -1)
+            if node >= 0:
+                store.remove(node)
+
+            try:
+                stats = os.stat(path)
+                node = store.add(parent, name, stats)
+                if stat.S_ISDIR(stats.st_mode):
+                    store.scan(node, path)
+            except OSError:
+                pass  # Deleted
+
+            self.__update_node(parent, parent_path)
+
+        return
+
+    # Brings the entry of one path up to date with stats taken from the disk, if the index differs from them
+    # A folder whose entry changed gets its list of children synced (new children are scanned, removed ones
+    # dropped); the children that were already indexed are left as they are, so this is cheaper than refresh()
+    def sync(self, path: str, stats):
+        with self.__lock:
+            if self.__building:
+                self.__refreshed.append(path)
+
+            node = self.__lookup(path)
+            store = self.__store
+            if node >= 0 and (store.modes[node], store.inodes[node], store.sizes[node], store.mtimes[node]) == \
+                    (stats.st_mode, stats.st_ino & 0xFFFFFFFFFFFFFFFF, stats.st_size, stats.st_mtime_ns):
+                return
+
+            if node < 0 or (store.children[node] is None) != (not stat.S_ISDIR(stats.st_mode)):
+                self.refresh(path)
+                return
+
+            store.update(node, stats)
+            if store.children[node] is None or os.path.islink(path):
+                return
+
+            try:
+                names = set(os.listdir(path))
+            except OSError:
+                return
+
+            children = store.children[node]
+            for name in [name for name in children if name not in names]:
+                store.remove(children[name])
+
+            for name in names:
+                if name in children:
+                    continue
+                try:
+                    child_stats = os.stat(path + '/' + name)
+                except OSError:
+                    continue
+                child = store.add(node, name, child_stats)
+                if stat.S_ISDIR(child_stats.st_mode):
+                    store.scan(child, path + '/' + name)
+
+    # Must be called with the lock held
+    def __update_node(self, node: int, path: str):
+        try:
+            self.__store.update(node, os.stat(path))
+        except OSError:
+            pass
+
+    # Path components relative to the root, or None if path is outside the root
+    def __split(self, path: str) -> Optional[List[str]]:
+        path = os.path.normpath(path).replace('\\', '/')
+        if path == self.root:
+            return []
+        if not path.startswith(self.root + '/'):
+            return None
+        return path[len(self.root) + 1:].split('/')
+
+    # Must be called with the lock held
+    def __lookup(self, path: str) -> int:
+        components = self.__split(path)
+        store = self.__store
+        if components is None or len(store.names) == 0:
+            return -1
+
+        node = 0
+        for name in components:
+            children = store.children[node]
+            if children is None:
+                return -1
+            node = children.get(name, -1)
+            if node < 0:
+                return -1
+        return node
+
+    def __reconcile_loop(self):
+        while not self.__stop_event.wait(self.reconcile_interval):
+            start = time.monotonic()
+            self.build()
+            print('Reconciled file index ({0} objects, {1:.2f} s)'.format(len(self), time.monotonic() - start))
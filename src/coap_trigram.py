@@ -0,0 +1,352 @@
+# coap_trigram.py
+# Inverted trigram index over object names, used to answer substring searches without walking the tree
+import json
+import os
+import stat
+import time
+from threading import Thread, RLock, Event
+from typing import Optional, List, Dict, Set, Tuple
+
+
+KIND_FILE = 1
+KIND_FOLDER = 2
+KIND_OTHER = 3
+
+# Names used for kinds in search results
+KIND_NAMES = {KIND_FILE: 'file', KIND_FOLDER: 'folder', KIND_OTHER: 'unknown'}
+
+INDEX_FORMAT_VERSION = 1
+
+
+def _kind(mode) -> int:
+    if stat.S_ISDIR(mode):
+        return KIND_FOLDER
+    if stat.S_ISREG(mode):
+        return KIND_FILE
+    return KIND_OTHER
+
+
+def _trigrams(name: str) -> Set[str]:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+# Maps every trigram of every name below the root to the entries that contain it
+# A substring query intersects the posting lists of its trigrams (smallest first), so only candidate entries
+# are compared against the query; queries shorter than 3 characters check every entry below the search folder
+# Entries are identified by their path relative to the root ('a/b/c.txt')
+# Commands that modify the disk call refresh() for the paths they touched; a background thread also lists again
+# every folder whose mtime changed, every reconcile_interval seconds, to pick up changes made by other programs
+class TrigramIndex:
+    def __init__(self, root: str):
+        self.root = os.path.normpath(root).replace('\\', '/')
+        self.reconcile_interval = 60.0
+
+        self.__paths: List[Optional[str]] = []  # Entry ID -> relative path (None for free slots)
+        self.__kinds = bytearray()
+        self.__ids: Dict[str, int] = {}
+        self.__free: List[int] = []
+        self.__postings: Dict[str, Set[int]] = {}
+        self.__children: Dict[str, Set[str]] = {'': set()}  # Folder -> relative paths of its entries
+        self.__folder_mtimes: Dict[str, int] = {}  # Used to validate a persisted index
+        self.__lock = RLock()
+        self.__thread: Optional[Thread] = None
+        self.__stop_event = Event()
+
+    def __len__(self):
+        return len(self.__ids)
+
+    # Path relative to the root, or None if path is outside the root
+    def relative(self, path: str) -> Optional[str]:
+        path = os.path.normpath(path).replace('\\', '/')
+        if path == self.root:
+            return ''
+        if not path.startswith(self.root + '/'):
+            return None
+        return path[len(self.root) + 1:]
+
+    # Indexes the whole tree from disk
+    def build(self):
+        with self.__lock:
+            self.__clear()
+            self.__scan('')
+
+    # Starts the reconcile thread
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop_event.clear()
+        self.__thread = Thread(target=self.__reconcile_loop, name='CoAP name index', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+
+    # Brings the index up to date with the disk: folders whose mtime changed are listed again (a folder's mtime
+    # changes when an object is created, deleted or renamed inside it), so this costs one stat per folder
+    # The lock is only held while a changed folder is synced, so searches and refreshes can run in between
+    def reconcile(self):
+        with self.__lock:
+            folders = list(self.__folder_mtimes.items())
+
+        for folder, mtime in folders:
+            try:
+                current = os.stat(self.__absolute(folder)).st_mtime_ns
+            except OSError:
+                current = None
+
+            if current == mtime:
+                continue
+
+            with self.__lock:
+                # Skip folders that were refreshed (or removed) in the meantime
+                if self.__folder_mtimes.get(folder) == mtime:
+                    self.__sync_folder(folder)
+
+    # Finds the entries below the folder prefix whose name contains text
+    # Returns (relative path, name, kind) tuples; callers that match names against a pattern do it on this list,
+    # outside the lock (a slow pattern mustn't block refresh())
+    def search(self, text: str, prefix: str = '') -> List[Tuple[str, str, int]]:
+        results = []
+
+        with self.__lock:
+            if len(text) < 3:
+                candidates = self.__subtree(prefix)
+            else:
+                postings = []
+                for trigram in _trigrams(text):
+                    posting = self.__postings.get(trigram)
+                    if posting is None:
+                        return results
+                    postings.append(posting)
+
+                postings.sort(key=len)
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    candidates &= posting
+                    if len(candidates) == 0:
+                        return results
+
+            scope = prefix + '/' if prefix != '' else ''
+
+            for entry in candidates:
+                path = self.__paths[entry]
+                if not path.startswith(scope):
+                    continue
+
+                name = path[path.rfind('/') + 1:]
+                if text in name:
+                    results.append((path, name, self.__kinds[entry]))
+
+        return results
+
+    # Updates the index from disk for one path and everything below it (called by commands that modify the disk)
+    def refresh(self, path: str):
+        rel = self.relative(path)
+        if rel is None:
+            return
+
+        with self.__lock:
+            if rel == '':
+                self.build()
+                return
+
+            parent = rel[:rel.rfind('/')] if '/' in rel else ''
+            if parent not in self.__children:
+                # The parent folder isn't indexed either
+                self.refresh(self.__absolute(parent))
+                return
+
+            self.__remove_tree(rel)
+
+            try:
+                stats = os.stat(self.__absolute(rel))
+                self.__add(rel, _kind(stats.st_mode))
+                if stat.S_ISDIR(stats.st_mode) and not os.path.islink(self.__absolute(rel)):
+                    self.__folder_mtimes[rel] = stats.st_mtime_ns
+                    self.__scan(rel)
+            except OSError:
+                pass  # Deleted
+
+            self.__update_mtime(parent)
+
+        return
+
+    # Writes the index to a file, so the next start doesn't need a full scan
+    def save(self, file_path: str):
+        with self.__lock:
+            data = {
+                'version': INDEX_FORMAT_VERSION,
+                'root': self.root,
+                'entries': [[path, self.__kinds[entry]] for path, entry in self.__ids.items()],
+                'folders': self.__folder_mtimes
+            }
+
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(temp_path, file_path)
+
+    # Loads an index written by save()
+    # Only folders whose mtime changed since then are scanned again (one stat per folder, instead of a full scan)
+    # Returns False if the file can't be used
+    def load(self, file_path: str) -> bool:
+        try:
+            with open(file_path, 'r') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('version') != INDEX_FORMAT_VERSION or data.get('root') != self.root:
+            return False
+
+        with self.__lock:
+            self.__clear()
+
+            for path, kind in data['entries']:
+                self.__add(path, kind)
+
+            self.__folder_mtimes = {path: mtime for path, mtime in data['folders'].items()}
+            self.reconcile()
+
+        return True
+
+    # Must be called with the lock held
+    def __clear(self):
+        self.__paths = []
+        self.__kinds = bytearray()
+        self.__ids = {}
+        self.__free = []
+        self.__postings = {}
+        self.__children = {'': set()}
+        self.__folder_mtimes = {}
+        self.__update_mtime('')
+
+    def __absolute(self, rel: str) -> str:
+        return self.root + '/' + rel if rel != '' else self.root
+
+    # Must be called with the lock held
+    def __add(self, rel: str, kind: int):
+        if rel in self.__ids:
+            return
+
+        if len(self.__free) > 0:
+            entry = self.__free.pop()
+            self.__paths[entry] = rel
+            self.__kinds[entry] = kind
+        else:
+            entry = len(self.__paths)
+            self.__paths.append(rel)
+            self.__kinds.append(kind)
+
+        self.__ids[rel] = entry
+
+        slash = rel.rfind('/')
+        for trigram in _trigrams(rel[slash + 1:]):
+            self.__postings.setdefault(trigram, set()).add(entry)
+
+        self.__children.setdefault(rel[:slash] if slash >= 0 else '', set()).add(rel)
+        if kind == KIND_FOLDER:
+            self.__children.setdefault(rel, set())
+
+    # Must be called with the lock held
+    def __remove_tree(self, rel: str):
+        slash = rel.rfind('/')
+        parent = self.__children.get(rel[:slash] if slash >= 0 else '')
+        if parent is not None:
+            parent.discard(rel)
+
+        stack = [rel]
+        while len(stack) > 0:
+            path = stack.pop()
+            stack.extend(self.__children.pop(path, ()))
+            self.__folder_mtimes.pop(path, None)
+
+            entry = self.__ids.pop(path, None)
+            if entry is None:
+                continue
+
+            for trigram in _trigrams(path[path.rfind('/') + 1:]):
+                posting = self.__postings.get(trigram)
+                if posting is not None:
+                    posting.discard(entry)
+                    if len(posting) == 0:
+                        del self.__postings[trigram]
+
+            self.__paths[entry] = None
+            self.__free.append(entry)
+
+    # Must be called with the lock held
+    # Adds everything inside a folder from disk; symbolic links to folders are added, but not walked into
+    def __scan(self, rel: str):
+        stack = [rel]
+        while len(stack) > 0:
+            folder = stack.pop()
+            prefix = folder + '/' if folder != '' else ''
+            try:
+                with os.scandir(self.__absolute(folder)) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                            kind = KIND_FOLDER if is_dir else (KIND_FILE if entry.is_file() else KIND_OTHER)
+                            walk_into = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+
+                        path = prefix + entry.name
+                        self.__add(path, kind)
+                        if walk_into:
+                            self.__update_mtime(path)
+                            stack.append(path)
+            except OSError:
+                pass
+
+    # Must be called with the lock held
+    # Brings the direct contents of a folder up to date
+    def __sync_folder(self, rel: str):
+        prefix = rel + '/' if rel != '' else ''
+        try:
+            with os.scandir(self.__absolute(rel)) as entries:
+                names = {prefix + entry.name for entry in entries}
+        except OSError:
+            if rel != '':
+                self.__remove_tree(rel)
+            return
+
+        current = self.__children.get(rel, set())
+
+        for path in current - names:
+            self.__remove_tree(path)
+
+        for path in names - current:
+            self.refresh(self.__absolute(path))
+
+        self.__update_mtime(rel)
+
+    # Must be called with the lock held
+    def __update_mtime(self, rel: str):
+        try:
+            self.__folder_mtimes[rel] = os.stat(self.__absolute(rel)).st_mtime_ns
+        except OSError:
+            self.__folder_mtimes.pop(rel, None)
+
+    # Must be called with the lock held
+    def __subtree(self, rel: str) -> List[int]:
+        entries = []
+        stack = list(self.__children.get(rel, ()))
+        while len(stack) > 0:
+            path = stack.pop()
+            entries.append(self.__ids[path])
+            stack.extend(self.__children.get(path, ()))
+        return entries
+
+    def __reconcile_loop(self):
+        while not self.__stop_event.wait(self.reconcile_interval):
+            start = time.monotonic()
+            self.reconcile()
+            print('Reconciled search index ({0} entries, {1:.2f} s)'.format(len(self), time.monotonic() - start))
@@ -0,0 +1,58 @@
+# coap_walk.py
+# Walks folder trees with os.scandir, optionally listing several folders in parallel
+import os
+from collections import deque
+from concurrent.futures import Executor
+from typing import Optional, Iterator, List, Tuple
+
+
+# Lists a folder; folders that can't be read are treated as empty
+def _list(path: str) -> List[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except OSError:
+        return []
+
+
+# Yields (relative path, entry) for everything below root
+# Entries are os.DirEntry objects: is_dir() / is_file() use the type cached by scandir, so no stat is made
+# unless the caller asks for entry.stat(); relative paths are built by joining names, without normalization
+# Symbolic links to folders are listed, but not walked into: they could lead outside of root, or into a loop
+# If an executor is given, up to max_inflight folders are listed at the same time (useful on high-latency storage);
+# otherwise the tree is walked depth-first on the calling thread
+def walk(root: str, executor: Optional[Executor] = None, max_inflight=16) -> Iterator[Tuple[str, os.DirEntry]]:
+    if executor is None:
+        stack = [('', root)]
+        while len(stack) > 0:
+            rel, path = stack.pop()
+            prefix = rel + '/' if rel != '' else ''
+
+            for entry in _list(path):
+                rel_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((rel_path, entry.path))
+                yield rel_path, entry
+        return
+
+    folders = deque([('', root)])
+    inflight = deque()
+
+    try:
+        while len(folders) > 0 or len(inflight) > 0:
+            while len(folders) > 0 and len(inflight) < max_inflight:
+                rel, path = folders.popleft()
+                inflight.append((rel, executor.submit(_list, path)))
+
+            rel, future = inflight.popleft()
+            prefix = rel + '/' if rel != '' else ''
+
+            for entry in future.result():
+                rel_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append((rel_path, entry.path))
+                yield rel_path, entry
+    finally:
+        # The caller may stop early (e.g. when the search runs out of time)
+        for rel, future in inflight:
+            future.cancel()
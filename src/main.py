@@ -1,7 +1,15 @@
+import sys
 from application import *
+from coap_cluster import Cluster
 
 
 def main():
+    # 'python3 main.py --cluster <processes>' runs headless server processes that share the CoAP port
+    if len(sys.argv) == 3 and sys.argv[1] == '--cluster':
+        cluster = Cluster(int(sys.argv[2]))
+        cluster.run()
+        return
+
     app = Application()
     app.run()
 
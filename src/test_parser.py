@@ -0,0 +1,179 @@
+# test_parser.py
+# Unit tests for the parser (run with 'python3 -m unittest test_parser' from the src folder)
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from coap import *
+from coap_server import Server
+from coap_parser import Parser
+
+
+class ParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='coap_test_')
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        os.mkdir('server_files')
+
+        self.parser = Parser()
+        self.server = Server()  # Only used for registering the handlers, it's never started
+        self.next_id = 1
+
+    def tearDown(self):
+        self.parser.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def register(self):
+        self.parser.register(self.server)
+
+    # Builds a request the way the server receives it (parsed from its encoded form)
+    def request(self, code, payload=b'', options=None, token=b'tk'):
+        packet = Packet(TYPE_CON, code, self.next_id, token)
+        self.next_id += 1
+        for option, values in (options or {}).items():
+            packet.options[option] = values
+        packet.payload = payload
+
+        received = Packet()
+        received.parse(packet.tobytes())
+        received.addr = ('127.0.0.1', 5683)
+        return received
+
+    def upload_block(self, path, num, more, data):
+        options = {
+            OPT_URI_QUERY: [bytes('cmd=save', 'utf-8'), bytes('path=' + path, 'utf-8')],
+            OPT_BLOCK1: [encode_block(num, more, 6)]
+        }
+        return self.parser.onpost(self.request(MSG_POST, data, options))
+
+    def temp_files(self):
+        return [name for name in os.listdir('server_files') if name.endswith('.upload')]
+
+
+class UploadExpiryTest(ParserTestCase):
+    def setUp(self):
+        super().setUp()
+        with open('server_files/target.txt', 'w') as file:
+            file.write('old')
+
+    def test_expire_without_new_blocks(self):
+        self.register()
+
+        reply = self.upload_block('/target.txt', 0, True, bytes(1024))
+        self.assertEqual(reply.code, MSG_CONTINUE)
+        self.assertEqual(len(self.temp_files()), 1)
+
+        # Nothing is reclaimed before the timeout
+        self.assertEqual(self.parser.expire_uploads(time.monotonic() + self.parser.upload_timeout / 2), 0)
+        self.assertEqual(len(self.temp_files()), 1)
+
+        self.assertEqual(self.parser.expire_uploads(time.monotonic() + self.parser.upload_timeout + 1), 1)
+        self.assertEqual(self.temp_files(), [])
+
+        # The next block finds no upload to continue
+        reply = self.upload_block('/target.txt', 1, False, b'end')
+        self.assertEqual(reply.code, MSG_REQUEST_ENTITY_INCOMPLETE)
+        with open('server_files/target.txt') as file:
+            self.assertEqual(file.read(), 'old')
+
+    def test_idle_server_reclaims_uploads(self):
+        self.parser.upload_timeout = 0.2
+        self.parser.housekeeping_interval = 0.05
+        self.register()
+
+        self.upload_block('/target.txt', 0, True, bytes(1024))
+        self.assertEqual(len(self.temp_files()), 1)
+
+        # No other request arrives; the housekeeping thread has to find the abandoned upload on its own
+        deadline = time.monotonic() + 5
+        while len(self.temp_files()) > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(self.temp_files(), [])
+
+
+class PaginationTest(ParserTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir('server_files/sub')
+        for i in range(20):
+            open('server_files/sub/file_{0}.txt'.format(i), 'w').close()
+
+    def open_page(self, cursor=None):
+        data = {'cmd': 'open', 'path': '/sub', 'limit': 1}
+        if cursor is not None:
+            data['cursor'] = cursor
+        reply = self.parser.onget(self.request(MSG_GET, bytes(json.dumps(data), 'utf-8')))
+        self.assertEqual(reply.code, MSG_CONTENT)
+        return json.loads(bytes(reply.payload).decode('utf-8'))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc/self/fd')
+    def test_abandoned_cursors_keep_no_files_open(self):
+        self.register()
+        before = len(os.listdir('/proc/self/fd'))
+
+        # Every request starts a listing, and its cursor is never used
+        for i in range(200):
+            self.assertIn('next_cursor', self.open_page())
+
+        self.assertEqual(len(self.parser.cursors), 200)
+        self.assertLessEqual(len(os.listdir('/proc/self/fd')), before + 2)
+
+    def test_pages_cover_the_folder(self):
+        self.register()
+
+        names = []
+        page = self.open_page()
+        while True:
+            names.extend(page['response'])
+            if 'next_cursor' not in page:
+                break
+            page = self.open_page(page['next_cursor'])
+
+        self.assertEqual(sorted(names), sorted(os.listdir('server_files/sub')))
+
+
+class SymlinkSearchTest(ParserTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir('outside')
+        open('outside/secret.txt', 'w').close()
+        os.mkdir('server_files/inside')
+        open('server_files/inside/secret_copy.txt', 'w').close()
+        os.symlink(os.path.join(self.root, 'outside'), 'server_files/out')
+        os.symlink('.', 'server_files/inside/loop')
+        self.parser.resolve_symlinks = True
+
+    def search(self):
+        data = {'cmd': 'search', 'path': '/', 'target_name_regex': 'secret'}
+        reply = self.parser.onsearch(self.request(MSG_SEARCH, bytes(json.dumps(data), 'utf-8')))
+        self.assertEqual(reply.code, MSG_CONTENT)
+        return [result['path'] for result in json.loads(bytes(reply.payload).decode('utf-8'))['results']]
+
+    def check_search(self):
+        self.register()
+        self.assertEqual(self.search(), ['inside/secret_copy.txt'])
+
+    def test_walk(self):
+        self.check_search()
+
+    def test_walk_workers(self):
+        self.parser.search_workers = 2
+        self.check_search()
+
+    def test_tree_index(self):
+        self.parser.use_tree_index = True
+        self.check_search()
+
+    def test_name_index(self):
+        self.parser.use_name_index = True
+        self.check_search()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ import json
 SOCKET_ADDR = ('', 1337)
 TARGET_ADDR = ('127.0.0.1', 5683)
 REPLY_TIMEOUT = 10
+BLOCK_SZX = 6  # Block size used when downloading files block-wise (1024 bytes)
 
 json_encoder = json.JSONEncoder()
 json_decoder = json.JSONDecoder()
@@ -33,21 +34,52 @@ def showhelp():
     print('> \'python3 {0} delete <path>\' to delete an object.'.format(name))
     print('> \'python3 {0} open <path>\' to open file contents.'.format(name))
     print('> \'python3 {0} save <path> <content>\' to save file contents.'.format(name))
+    print('> \'python3 {0} upload <path> <local file>\' to upload file contents block-wise.'.format(name))
     print('> \'python3 {0} rename <path> <new name>\' to rename an object.'.format(name))
     print('> \'python3 {0} move <path> <new path>\' to move an object.'.format(name))
     print('> \'python3 {0} details <path>\' to receive details about an object.'.format(name))
     print('> \'python3 {0} search <path> <regex>\' to search the folder contents for objects matching regex.'.format(name))
+    print('> \'python3 {0} batch <json file> [mode]\' to run a list of commands in one request.'.format(name))
     exit(0)
 
 
-def wait_for_reply(sock):
-    try:
-        print('Waiting for reply; timeout =', REPLY_TIMEOUT, 'seconds')
-        sock.settimeout(REPLY_TIMEOUT)
+# Receives a message, skipping the empty ACK of a separate response
+# Separate responses arrive as CON messages, and are acknowledged here
+def _receive(sock):
+    while True:
         data, addr = sock.recvfrom(65527)
         packet = Packet()
         packet.addr = addr
         packet.parse(data)
+
+        if packet.type == TYPE_ACK and packet.code == MSG_EMPTY:
+            continue
+
+        if packet.type == TYPE_CON:
+            sock.sendto(make_empty_ack(packet.id, bytes(0)).tobytes(), addr)
+
+        return packet
+
+
+# Receives a reply without printing it; returns None if it times out or can't be parsed
+def receive_reply(sock):
+    try:
+        sock.settimeout(REPLY_TIMEOUT)
+        return _receive(sock)
+    except socket.timeout:
+        print('Request timed out!')
+    except TimeoutError:
+        print('Request timed out!')
+    except ParseException as e:
+        print('Packet caused a CoAP exception! Error message: ', e)
+    return None
+
+
+def wait_for_reply(sock):
+    try:
+        print('Waiting for reply; timeout =', REPLY_TIMEOUT, 'seconds')
+        sock.settimeout(REPLY_TIMEOUT)
+        packet = _receive(sock)
         print('Received message from', packet.addr)
         print('ID', packet.id, 'Type', packet.type, 'Code', packet.code, 'Token: ', packet.token)
         print()
@@ -115,8 +147,48 @@ def openfile(sock, path):
 
     # Wait for a reply
 
-    wait_for_reply(sock)
-    pass
+    print('Waiting for reply; timeout =', REPLY_TIMEOUT, 'seconds')
+    reply = receive_reply(sock)
+    if reply is None:
+        return
+
+    if len(reply.get_option(OPT_BLOCK2)) == 0:
+        print('Received message from', reply.addr)
+        print('ID', reply.id, 'Type', reply.type, 'Code', reply.code, 'Token: ', reply.token)
+        print()
+        try:
+            print('Payload: ', json.dumps(json_decoder.decode(reply.payload.decode('utf-8')), sort_keys=True, indent=2))
+        except json.decoder.JSONDecodeError:
+            print('Message: ', reply.payload.decode('utf-8'))
+        print()
+        return
+
+    # Large files are sent block-wise - keep asking for the next block until the server says it was the last one
+    content = bytearray()
+
+    while reply is not None:
+        if reply.code != MSG_CONTENT:
+            print('Block transfer failed with code', reply.code, ':', reply.payload.decode('utf-8'))
+            return
+
+        num, more, szx = decode_block(reply.get_option(OPT_BLOCK2)[0])
+        content += reply.payload
+        print('Received block', num, '(', len(reply.payload), 'bytes )')
+
+        if not more:
+            break
+
+        request = Packet(TYPE_NON, MSG_GET, randomize_id(), request.token)
+        request.payload = bytes(json_encoder.encode(payload), 'utf-8')
+        request.options[OPT_BLOCK2] = [encode_block(len(content) // block_size(BLOCK_SZX), False, BLOCK_SZX)]
+
+        sock.sendto(request.tobytes(), TARGET_ADDR)
+        reply = receive_reply(sock)
+
+    print()
+    print('File contents (', len(content), 'bytes ):')
+    print(content.decode('utf-8', errors='replace'))
+    print()
 
 
 def savefile(sock, path, content):
@@ -136,6 +208,46 @@ def savefile(sock, path, content):
     pass
 
 
+def upload(sock, path, local_file):
+    with open(local_file, 'rb') as file:
+        content = file.read()
+
+    size = block_size(BLOCK_SZX)
+    token = randomize_token()
+    num = 0
+
+    print('Using token', token)
+
+    # Send the file one block at a time, waiting for 2.31 Continue after each one
+    while True:
+        block = content[num * size:(num + 1) * size]
+        more = (num + 1) * size < len(content)
+
+        request = Packet(TYPE_NON, MSG_POST, randomize_id(), token)
+        request.options[OPT_URI_QUERY] = [bytes('cmd=save', 'utf-8'), bytes('path=' + path, 'utf-8')]
+        request.options[OPT_BLOCK1] = [encode_block(num, more, BLOCK_SZX)]
+        request.payload = block
+
+        sock.sendto(request.tobytes(), TARGET_ADDR)
+        print('Sent block', num, '(', len(block), 'bytes )')
+
+        if not more:
+            break
+
+        reply = receive_reply(sock)
+        if reply is None:
+            return
+
+        if reply.code != MSG_CONTINUE:
+            print('Upload failed with code', reply.code, ':', reply.payload.decode('utf-8'))
+            return
+
+        num += 1
+
+    wait_for_reply(sock)
+    pass
+
+
 def rename(sock, path, name):
     payload = {'cmd': 'rename', 'path': path, 'name': name}
 
@@ -204,6 +316,25 @@ def searchcommand(sock, path, target_name_regex):
     pass
 
 
+def batch(sock, commands_file, mode):
+    with open(commands_file, 'r') as file:
+        commands = json_decoder.decode(file.read())
+
+    payload = {'cmd': 'batch', 'path': '/', 'mode': mode, 'commands': commands}
+
+    request = Packet(TYPE_CON, MSG_POST, randomize_id(), randomize_token())
+    request.options[OPT_URI_QUERY] = [bytes('cmd=batch', 'utf-8')]  # Lets the server send a separate response
+    request.payload = bytes(json_encoder.encode(payload), 'utf-8')
+
+    print('Using token', request.token, 'and ID', request.id)
+
+    sock.sendto(request.tobytes(), TARGET_ADDR)
+    print('Sent request')
+
+    wait_for_reply(sock)
+    pass
+
+
 def main():
     argc = len(sys.argv)
 
@@ -223,6 +354,8 @@ def main():
         openfile(sock, sys.argv[2])
     elif cmd == 'save' and argc >= 3:
         savefile(sock, sys.argv[2], ' '.join(sys.argv[3:]))
+    elif cmd == 'upload' and argc == 4:
+        upload(sock, sys.argv[2], sys.argv[3])
     elif cmd == 'rename' and argc == 4:
         rename(sock, sys.argv[2], sys.argv[3])
     elif cmd == 'move' and argc == 4:
@@ -231,6 +364,8 @@ def main():
         details(sock, sys.argv[2])
     elif cmd == 'search' and argc == 4:
         searchcommand(sock, sys.argv[2], sys.argv[3])
+    elif cmd == 'batch' and argc in [3, 4]:
+        batch(sock, sys.argv[2], sys.argv[3] if argc == 4 else 'continue')
     else:
         print('Command was not understood!')
         showhelp()